@@ -1,24 +1,100 @@
 import sys
 from statemachine import StateMachine
-from lxml import etree
-import xml.parsers.expat
-import html
-import argparse
-import urllib.request
-from urllib.parse import urljoin
+import urllib.parse
 import pathlib
-import codecs
+import importlib
 import os
+import gc
 import io
+import glob
+import time
+import functools
+import threading
+import contextlib
+from array import array
 from abc import ABC, abstractmethod
+from collections.abc import Mapping
 
 from urllib.parse import urlparse
 
+
+class LazyImport:
+    """
+    Stands in for a module that is only imported the first time one of its
+    attributes is used. Modules that are slow to import and that many runs do
+    not need, such as lxml.etree, are imported this way so that they do not
+    add to the start up time of every run.
+    """
+    def __init__(self, name):
+        self.__name__ = name
+
+    def __getattr__(self, attribute):
+        value = getattr(importlib.import_module(self.__name__), attribute)
+        # Later uses of the attribute find it here without calling __getattr__.
+        setattr(self, attribute, value)
+        return value
+
+
+etree = LazyImport('lxml.etree')
+
 try:
     import regex as re
 except ImportError:
     import re
 
+
+class LazyPatterns(dict):
+    """
+    A table of regular expressions by name that compiles each expression the
+    first time it is looked up, so that importing the module does not pay for
+    compiling expressions that a run never uses. Patterns must be looked up
+    by name, since the table only holds those compiled so far.
+    """
+    def __init__(self, expressions):
+        """
+        :param expressions: The expressions and their flags, by name.
+        """
+        super().__init__()
+        self.expressions = expressions
+
+    def __missing__(self, name):
+        expression, flags = self.expressions[name]
+        pattern = self[name] = re.compile(expression, flags)
+        return pattern
+
+
+class LazySubstitutions(Mapping):
+    """
+    A set of substitutions, from compiled regular expressions to the text
+    that replaces their matches, whose expressions are compiled the first
+    time the set is used.
+    """
+    def __init__(self, substitutions):
+        """
+        :param substitutions: A list of (expression, replacement) tuples, in
+        the order in which the substitutions are made.
+        """
+        self.substitutions = substitutions
+        self.compiled = None
+
+    def _compile(self):
+        if self.compiled is None:
+            self.compiled = {re.compile(expression): replacement
+                             for expression, replacement in self.substitutions}
+        return self.compiled
+
+    def __getitem__(self, pattern):
+        return self._compile()[pattern]
+
+    def __iter__(self):
+        return iter(self._compile())
+
+    def __len__(self):
+        return len(self.substitutions)
+
+    def items(self):
+        return self._compile().items()
+
 # Block regex component expressions
 re_indent = r'(?P<indent>\s*)'
 re_attributes = r'(?P<attributes>((\((.*?(?<!\\))\))|(\[(.*?(?<!\\])\])))*)'
@@ -33,47 +109,85 @@ re_one_space = r'\s'
 re_comment = r'#(?P<comment>.*)'
 re_citation = r'(\[\s*(?P<citation>.*?)\])'
 
-
-block_patterns = {
-            'comment': re.compile(re_indent + re_comment, re.U),
-            'remark-start': re.compile(
+# XML names without a colon, which is what a block name must be to be used as
+# the name of an element. The same names are accepted as by lxml, but checking
+# them does not require lxml to be imported. The pattern for names that are not
+# all ASCII is slow to compile, so it is only compiled if such a name is used.
+re_xml_name_start_char = ('A-Z_a-z\u00C0-\u00D6\u00D8-\u00F6\u00F8-\u02FF\u0370-\u037D\u037F-\u1FFF'
+                          '\u200C-\u200D\u2070-\u218F\u2C00-\u2FEF\u3001-\uD7FF\uF900-\uFDCF'
+                          '\uFDF0-\uFFFD\U00010000-\U000EFFFF')
+xml_name_patterns = LazyPatterns({
+            'ascii': (r'[A-Z_a-z][A-Z_a-z\-.0-9]*', 0),
+            'unicode': ('[{0}][{0}\\-.0-9\u00B7\u0300-\u036F\u203F-\u2040]*'.format(re_xml_name_start_char), 0)
+        })
+
+
+block_patterns = LazyPatterns({
+            'comment': (re_indent + re_comment, re.U),
+            'remark-start': (
                 re_indent + r'(?P<flag>!!!)(' + re_attributes + ')?\s*(?P<unexpected>.*)',
                 re.U),
-            'declaration': re.compile(re_indent + '!' + re_name + r'(?<!\\):' + re_content + r'?', re.U),
-            'block-start': re.compile(re_indent + re_name + r'(?<!\\):' + re_attributes +
-                                      '((\s' + re_content + r'?)|$)', re.U),
-            'codeblock-start': re.compile(
+            'declaration': (re_indent + '!' + re_name + r'(?<!\\):' + re_content + r'?', re.U),
+            'block-start': (re_indent + re_name + r'(?<!\\):' + re_attributes +
+                            '((\s' + re_content + r'?)|$)', re.U),
+            'codeblock-start': (
                 re_indent + r'(?P<flag>```)(' + re_attributes + ')?\s*(?P<unexpected>.*)',
                 re.U),
-            'grid-start': re.compile(re_indent + r'\+\+\+' + re_attributes, re.U),
-            'blockquote-start': re.compile(
+            'grid-start': (re_indent + r'\+\+\+' + re_attributes, re.U),
+            'blockquote-start': (
                 re_indent + r'"""(' + re_remainder + r')?',
                 re.U),
-            'alt-blockquote-start': re.compile(
+            'alt-blockquote-start': (
                 re_indent + r"'''(" + re_remainder + r')?',
                 re.U),
-            'fragment-start': re.compile(re_indent + r'~~~' + re_attributes, re.U),
-            'paragraph-start': re.compile(r'\w*', re.U),
-            'line-start': re.compile(re_indent + r'\|' + re_attributes + re_one_space + re_content, re.U),
-            'blank-line': re.compile(r'^\s*$'),
-            'record-start': re.compile(re_indent + re_name + r'(?<!\\)::' + re_attributes +
-                                       '(?P<field_names>.*)', re.U),
-            'list-item': re.compile(re_indent + re_ul_marker + re_attributes + re_spaces + re_content, re.U),
-            'num-list-item': re.compile(re_indent + re_ol_marker + re_attributes + re_spaces + re_content, re.U),
-            'labeled-list-item': re.compile(re_indent + re_ll_marker + re_attributes + re_spaces + re_content, re.U),
-            'block-insert': re.compile(re_indent + r'>>>((\((?P<insert>.+?)\))|(\[(?P<ref>.*?(?<!\\))\]))'
-                                                   r'(' + re_attributes + ')?\s*(?P<unexpected>.*)', re.U),
-            'include': re.compile(re_indent + r'<<<' + re_attributes, re.U),
-            'variable-def': re.compile(re_indent + r'\$' + re_name + '\s*=\s*' + re_content, re.U)
-        }
+            'fragment-start': (re_indent + r'~~~' + re_attributes, re.U),
+            'paragraph-start': (r'\w*', re.U),
+            'line-start': (re_indent + r'\|' + re_attributes + re_one_space + re_content, re.U),
+            'blank-line': (r'^\s*$', 0),
+            'record-start': (re_indent + re_name + r'(?<!\\)::' + re_attributes +
+                             '(?P<field_names>.*)', re.U),
+            'list-item': (re_indent + re_ul_marker + re_attributes + re_spaces + re_content, re.U),
+            'num-list-item': (re_indent + re_ol_marker + re_attributes + re_spaces + re_content, re.U),
+            'labeled-list-item': (re_indent + re_ll_marker + re_attributes + re_spaces + re_content, re.U),
+            'block-insert': (re_indent + r'>>>((\((?P<insert>.+?)\))|(\[(?P<ref>.*?(?<!\\))\]))'
+                                         r'(' + re_attributes + ')?\s*(?P<unexpected>.*)', re.U),
+            'include': (re_indent + r'<<<' + re_attributes, re.U),
+            'variable-def': (re_indent + r'\$' + re_name + '\s*=\s*' + re_content, re.U)
+        })
+
+# Line kinds recognized by the line lexer, in the order of precedence in which
+# they are tried, each paired with the class of character that the first
+# non-space character of a line must belong to for the pattern to match.
+# Only the patterns whose lead character fits are tried against a line.
+# Blank lines are recognized before any pattern is tried.
+line_kinds = [('declaration', r'!'),
+              ('remark-start', r'!'),
+              ('comment', r'#'),
+              ('record-start', r'\w'),
+              ('codeblock-start', r'`'),
+              ('blockquote-start', r'"'),
+              ('alt-blockquote-start', r"'"),
+              ('fragment-start', r'~'),
+              ('grid-start', r'\+'),
+              ('list-item', r'\*'),
+              ('num-list-item', r'[0-9]'),
+              ('labeled-list-item', r'\|'),
+              ('block-insert', r'>'),
+              ('include', r'<'),
+              ('variable-def', r'\$'),
+              ('line-start', r'\|'),
+              ('block-start', r'\w'),
+              ('paragraph-start', r'.')]
 
 
 
 # Flow patterns
-flow_patterns = {
-            'escape': re.compile(r'\\', re.U),
-            'phrase': re.compile(r'(?<!\\)\{(?P<text>.*?)(?<!\\)\}'),
-            'annotation': re.compile(
+# These are matched at the position of the flow source where a construct may
+# start, so they must not look behind the start of the construct.
+flow_patterns = LazyPatterns({
+            'escape': (r'\\', re.U),
+            'phrase': (r'\{(?P<text>.*?)(?<!\\)\}', 0),
+            'annotation': (
                 r'''
                 (
                     (?P<flag>[-\+]?)                         #flag
@@ -92,14 +206,19 @@ flow_patterns = {
                 )
                 ''',
                 re.VERBOSE | re.U),
-            'bold': re.compile(r'\*(?P<text>((?<=\\)\*|[^\*])*)(?<!\\)\*', re.U),
-            'italic': re.compile(r'_(?P<text>((?<=\\)_|[^_])*)(?<!\\)_', re.U),
-            'code': re.compile(r'`(?P<text>(``|[^`])*)`', re.U),
-            'inline-insert': re.compile(r'>((\((?P<insert>.+?)\)))' + re_attributes, re.U),
-            'citation': re.compile(
+            'bold': (r'\*(?P<text>((?<=\\)\*|[^\*])*)(?<!\\)\*', re.U),
+            'italic': (r'_(?P<text>((?<=\\)_|[^_])*)(?<!\\)_', re.U),
+            'code': (r'`(?P<text>(``|[^`])*)`', re.U),
+            'inline-insert': (r'>((\((?P<insert>.+?)\)))' + re_attributes, re.U),
+            'citation': (
                 r'(\[\s*(?P<citation>.*?)\])',
-                re.U)
-        }
+                re.U),
+            # Characters that can start an inline markup construct in a flow
+            'markup': (r'[\\{\[*_`>&]', re.U),
+            # Characters that a backslash escapes
+            'escaped-character': ('[:\\\(\)\{\}\[\]_\*,\.\*`"&\<\>' + "']", re.U),
+            'character-entity': (r'&(\#[0-9]+|#[xX][0-9a-fA-F]+|[\w]+);', re.U)
+        })
 
 insert_reference_symbols = {'nameref': '#',
                             'idref': '*',
@@ -129,14 +248,16 @@ re_apostrophe = "(?<=[\w`\*_\}\)])'(?=\w)"
 re_en_dash = "(?<=[\w\*_`\"\'\.\)\}\]]\s)--(?=\s[\w\*_`\"\'\{\(\[])"
 re_em_dash = "(?<=[\w\*_`\"\'\.\)\}\]])---(?=[\w\*_`\"\'\{\(\[])"
 
-smart_quote_subs = {re.compile(re_double_quote_close):'”',
-                    re.compile(re_double_quote_open): '“',
-                    re.compile(re_single_quote_close):'’',
-                    re.compile(re_single_quote_open): '‘',
-                    re.compile(re_apostrophe): '’',
-                    re.compile(re_en_dash): '–',
-                    re.compile(re_em_dash): '—'}
+smart_quote_subs = LazySubstitutions([(re_double_quote_close, '”'),
+                                      (re_double_quote_open, '“'),
+                                      (re_single_quote_close, '’'),
+                                      (re_single_quote_open, '‘'),
+                                      (re_apostrophe, '’'),
+                                      (re_en_dash, '–'),
+                                      (re_em_dash, '—')])
 
+# The smart quote substitution sets every ParseContext starts with, by name.
+# Sets added here are available to parses with contexts made afterwards.
 smart_quote_sets = {'on': smart_quote_subs}
 
 known_insert_types = ["image", "video", "audio", "feed", "app", "object"]
@@ -208,10 +329,107 @@ def get_object_with_id(this, ID):
     return result
 
 
-included_files = []
+class ParseContext:
+    """
+    The state of one parse, shared by the SAM parser, its flow parser and the
+    parsers of the files the document includes. The parsers keep no state in
+    module globals, so documents can be parsed in several threads at once as
+    long as each parse has its own context.
+    """
+    def __init__(self, extra_smart_quote_sets=None, include_cache=None, prefetch=True, parse_cache=None):
+        """
+        :param extra_smart_quote_sets: Smart quote substitution sets, by name, to use
+        in addition to those in the module's smart_quote_sets. The sets are not changed.
+        :param include_cache: An IncludeCache to get included files from, which
+        may be shared with other contexts. Included files are parsed every time
+        they are included if there is none.
+        :param prefetch: Whether to fetch the files a document includes
+        concurrently, before the parser reaches the includes.
+        :param parse_cache: A ParseCache that SamParser.parse_file loads parsed
+        documents from and stores them in.
+        """
+        self.smart_quote_sets = dict(smart_quote_sets)
+        if extra_smart_quote_sets:
+            self.smart_quote_sets.update(extra_smart_quote_sets)
+        self.include_cache = include_cache
+        self.prefetch = prefetch
+        self.parse_cache = parse_cache
+        # The stack of files being included, used to detect recursive includes.
+        self.included_files = []
+        # The files included so far by each document being parsed, by URL
+        self.include_dependencies = []
+        # The fetches of included files started by prefetch_includes, by URL
+        self.prefetched = {}
+        # The stamps of included files being got by prefetch_includes, by URL
+        self.prefetched_stamps = {}
+
+    def prefetch_includes(self, urls):
+        """
+        Starts fetching included files in the background. A file the include
+        cache has an entry for is likely not to have changed, so only the
+        stamps of it and the files it depends on are got, which for a remote
+        file that has not changed takes no download.
+        :param urls: The resolved URLs of the files.
+        """
+        for url in urls:
+            dependencies = self.include_cache.dependencies(url) if self.include_cache is not None else []
+            if dependencies:
+                for x in dependencies:
+                    if x not in self.prefetched_stamps:
+                        self.prefetched_stamps[x] = prefetch_pool().submit(IncludeCache.stamp, x)
+            elif url not in self.prefetched:
+                self.prefetched[url] = prefetch_pool().submit(fetch_include, url)
+
+    def fetch(self, url):
+        """
+        Gets the content of an included file, waiting for it if it is being
+        prefetched and fetching it if not. Errors are raised here, whether they
+        occurred in the background or not.
+        :param url: The resolved URL of the file.
+        :return: The same as fetch_include.
+        """
+        future = self.prefetched.get(url)
+        if future is None:
+            return fetch_include(url)
+        return future.result()
+
+    def stamp(self, url):
+        """
+        Gets the IncludeCache stamp of an included file, using the prefetched
+        content or stamp if there is any.
+        :param url: The resolved URL of the file.
+        """
+        future = self.prefetched.get(url)
+        if future is None:
+            future = self.prefetched_stamps.get(url)
+            return IncludeCache.stamp(url) if future is None else future.result()
+        try:
+            return future.result()[2]
+        except OSError:
+            return None
+
 
 class SamParser:
-    def __init__(self):
+    # The state the SAM state hands a line over to, by the kind of the line.
+    line_kind_states = {'remark-start': "REMARK-START",
+                        'record-start': "RECORD-START",
+                        'codeblock-start': "CODEBLOCK-START",
+                        'blockquote-start': "BLOCKQUOTE-START",
+                        'alt-blockquote-start': "BLOCKQUOTE-START",
+                        'fragment-start': "FRAGMENT-START",
+                        'grid-start': "GRID-START",
+                        'list-item': "LIST-ITEM",
+                        'num-list-item': "NUM-LIST-ITEM",
+                        'labeled-list-item': "LABELED-LIST-ITEM",
+                        'block-insert': "BLOCK-INSERT",
+                        'include': "INCLUDE",
+                        'variable-def': "VARIABLE-DEF",
+                        'line-start': "LINE-START",
+                        'block-start': "BLOCK",
+                        'paragraph-start': "PARAGRAPH-START"}
+
+    def __init__(self, context=None):
+        self.context = ParseContext() if context is None else context
         self.stateMachine = StateMachine()
         self.stateMachine.add_state("SAM", self._sam)
         self.stateMachine.add_state("BLOCK", self._block)
@@ -239,46 +457,221 @@ class SamParser:
         self.doc = None
         self.source = None
         self.source_url = None
-        self.flow_parser = FlowParser()
+        # The IncludeCache stamps of the files the document includes, directly
+        # or through other includes, by URL
+        self.includes = {}
+        self.flow_parser = FlowParser(self.context)
 
-    def parse(self, source):
-        self.source = StringSource(source)
-        try:
-            self.source_url = source.geturl()
-        except AttributeError:
+    def parse(self, source, source_url=None, lazy=False):
+        """
+        Parses a SAM document into a document tree. This gives the same tree as
+        passing the events of the document to a TreeBuilder, but builds the
+        tree directly, which is faster.
+        :param source: A file-like object containing the SAM document to parse,
+        in text mode, or in binary mode if it is encoded in UTF-8.
+        :param source_url: The URL of the document, if it cannot be found from the source.
+        :param lazy: Whether to put off parsing the text of paragraphs, titles,
+        labels, record fields and grid cells until it is used. The flows are
+        then LazyFlows, which parse themselves the first time they are read
+        or serialized, so errors and warnings in them are reported then
+        rather than by this method. Included files are parsed in full.
+        See DocStructure.resolve_flows().
+        :return: The DocStructure of the document.
+        """
+        for state in self._parse_steps(source, source_url, lazy=lazy):
+            pass
+        return self.doc
+
+    def events(self, source, source_url=None):
+        """
+        Parses a SAM document, generating its events as (event, node) tuples as
+        it goes. Blocks are taken out of the document tree once they have ended,
+        so the memory used does not grow with the size of the document, apart
+        from the indexes of IDs, names and annotated phrases the parser needs.
+        Included files are parsed in full before their events are generated.
+
+        The events are:
+
+        * start-document and end-document, with the DocStructure.
+        * start-block and end-block, with a Block. Lists are started implicitly
+          before their first item. A Block has no child blocks by the time it
+          ends, but its flows stay with it.
+        * record, with a Record, which has no start or end.
+        * start-flow and end-flow, with a Flow that is part of the current
+          block, such as the text of a paragraph or a codeblock.
+        * flow-text, with a string, phrase, with a Phrase (or Code),
+          annotation, with an Annotation, citation, with a Citation, and
+          insert, with an InlineInsert or a BlockInsert, for the contents of
+          flows. The annotations and citations of a phrase follow it.
+        * codeblock-line, with a line of the text of a codeblock.
+
+        The block flows of a block, such as its title, generate their content
+        events right after its start-block event, together with its citations.
+        The field values of a record follow its record event.
+
+        :param source: A file-like object containing the SAM document to parse,
+        in text mode, or in binary mode if it is encoded in UTF-8.
+        :param source_url: The URL of the document, if it cannot be found from the source.
+        """
+        steps = self._parse_steps(source, source_url, streaming=True)
+        for state in steps:
+            if self.doc.pending:
+                pending, self.doc.pending = self.doc.pending, []
+                yield from pending
+        self.doc.close()
+        yield from self.doc.pending
+        self.doc.pending = []
+
+    def push_events(self, source, handler, source_url=None):
+        """
+        Parses a SAM document, calling the method of an EventHandler for each of
+        its events as it goes. See events().
+        :param source: A file-like object containing the SAM document to parse,
+        in text mode, or in binary mode if it is encoded in UTF-8.
+        :param handler: The EventHandler.
+        :param source_url: The URL of the document, if it cannot be found from the source.
+        :return: The handler.
+        """
+        for event, node in self.events(source, source_url):
+            getattr(handler, event_handler_methods[event])(node)
+        return handler
+
+    def _parse_steps(self, source, source_url, streaming=False, lazy=False):
+        """
+        Parses a SAM document one state of the parser at a time, yielding the
+        name of each state as the parser enters it.
+        :param streaming: Whether to read the source a line at a time into a
+        StreamingDocStructure, rather than all at once into a DocStructure.
+        Included files are not prefetched when streaming, since that takes
+        finding them in the whole source first.
+        :param lazy: Whether to defer parsing flows. See parse().
+        """
+        self.source = StreamSource(source) if streaming else StringSource(source)
+        if source_url is not None:
+            self.source_url = source_url
+        else:
             try:
-                self.source_url = pathlib.Path(os.path.abspath(source.name)).as_uri()
+                self.source_url = source.geturl()
             except AttributeError:
-                self.source_url = None
-        self.doc = DocStructure(self.source_url)
+                try:
+                    self.source_url = pathlib.Path(os.path.abspath(source.name)).as_uri()
+                except AttributeError:
+                    self.source_url = None
+        self.doc = StreamingDocStructure(self.source_url) if streaming else DocStructure(self.source_url)
+        if lazy:
+            self.doc.deferred_flows = []
+        if self.context.prefetch and not streaming:
+            if not self.context.included_files:
+                # Fetches left over from an earlier parse may be out of date.
+                self.context.prefetched.clear()
+                self.context.prefetched_stamps.clear()
+            self._prefetch_includes()
+        dependencies = self.context.include_dependencies
+        dependencies.append({})
         try:
-            self.stateMachine.run((self.source, None))
+            yield from self.stateMachine.steps((self.source, None))
         except SAMParserStructureError as err:
             raise SAMParserError("Structure error: {0} at line {1}:\n\n {2}\n".format(
                 ' '.join(err.args), self.source.current_line_number,  self.source.current_line))
         except EOFError:
             raise SAMParserError("Document ended before structure was complete.")
-        all_id_refs = self.doc.find_all(get_idrefs)
-        unmatched_idrefs = set(all_id_refs) - set(self.doc.ids)
+        finally:
+            self.includes = dependencies.pop()
+        if lazy:
+            # The deferred flows are parsed with the smart quotes the document
+            # declares, by a flow parser of their own.
+            self.doc.flow_parser = FlowParser(self.context)
+            self.doc.flow_parser.smart_quotes = self.flow_parser.smart_quotes
+            return
+        unmatched_idrefs = self.doc.unmatched_idrefs()
         if unmatched_idrefs:
             raise SAMParserError("Idrefs found with no corresponding IDs: {0}".format(", ".join(unmatched_idrefs)))
-        return self.doc
 
     def parse_file(self, inputfile):
         try:
-            with open(inputfile, "r", encoding="utf-8-sig") as inf:
+            if self.context.parse_cache is not None:
+                return self._parse_file_cached(inputfile, self.context.parse_cache)
+            with open(inputfile, "rb") as inf:
                 SAM_parser_info("Parsing " + os.path.abspath(inf.name), blank_line=True)
                 self.parse(inf)
         except FileNotFoundError:
             raise SAMParserError("No input file specified.")
 
+    def _parse_file_cached(self, inputfile, parse_cache):
+        """
+        Parses a file, or loads it from a parse cache if it has been parsed
+        before. The messages printed while parsing the file are printed again
+        when it is loaded from the cache.
+        """
+        with open(inputfile, "rb") as inf:
+            data = inf.read()
+        SAM_parser_info("Parsing " + os.path.abspath(inputfile), blank_line=True)
+        self.source_url = pathlib.Path(os.path.abspath(inputfile)).as_uri()
+        key = parse_cache.key(data, self.source_url, self.context)
+        cached = parse_cache.load(key)
+        if cached is not None:
+            self.doc, self.includes, messages = cached
+            for message in messages:
+                print_message(message)
+            return self.doc
+
+        with recorded_messages() as messages:
+            self.parse(io.BytesIO(data), self.source_url)
+        parse_cache.store(key, self.doc, self.includes, messages)
+        return self.doc
+
+    def _prefetch_includes(self):
+        """
+        Starts fetching the files the document includes, so that they are
+        fetched concurrently rather than one at a time as the parser reaches
+        each include. Includes are found from the kinds of the source lines.
+        Lines in code and embed blocks are text, so a line in one that looks
+        like an include is not fetched.
+        """
+        lexer = self.source.lexer
+        code_ranges = iter(lexer.codeblock_line_ranges())
+        code_range = next(code_ranges, None)
+        urls = []
+        for line_index in lexer.line_indexes('include'):
+            while code_range is not None and code_range[1] <= line_index:
+                code_range = next(code_ranges, None)
+            if code_range is not None and code_range[0] <= line_index:
+                continue
+            href = lexer.matches[line_index].group("attributes")[1:-1]
+            urls.append(urllib.parse.urljoin(self.source_url, href))
+        self.context.prefetch_includes(urls)
+
+    def _parse_include(self, fullhref):
+        """
+        Parses an included file.
+        :param fullhref: The resolved URL of the file.
+        :return: The DocStructure of the file, and the IncludeCache stamps of
+        the file and the files it includes in turn, by URL.
+        """
+        data, source_url, stamp = self.context.fetch(fullhref)
+        includeparser = SamParser(self.context)
+        includeparser.parse(io.BytesIO(data), source_url)
+        dependencies = dict(includeparser.includes)
+        dependencies[fullhref] = stamp
+        return includeparser.doc, dependencies
+
+    def _parse_flow(self, text, strip=True):
+        """
+        Parses the text of a flow, or defers parsing it if the document is
+        being parsed lazily.
+        :return: The Flow or LazyFlow, or None if there is no text.
+        """
+        if self.doc.deferred_flows is None:
+            return self.flow_parser.parse(text, self.doc, strip)
+        return self.doc.defer_flow(text, strip)
+
     def _block(self, context):
         source, match = context
         indent = match.end("indent")
         block_name = match.group("name").strip()
         attributes, citations = parse_attributes(match.group("attributes"))
         content = match.group("content").strip()
-        parsed_content = None if content == '' else self.flow_parser.parse(content, self.doc)
+        parsed_content = None if content == '' else self._parse_flow(content)
         b = Block(block_name, indent, attributes, parsed_content, citations)
         self.doc.add_block(b)
         return "SAM", context
@@ -311,8 +704,8 @@ class SamParser:
             self.current_text_block = None
             return "END", context
 
-        indent = len(line) - len(line.lstrip())
-        if block_patterns['blank-line'].match(line):
+        indent = source.current_indent
+        if source.current_kind == 'blank-line':
             self.current_text_block.append(line)
             return "CODEBLOCK", context
         if indent <= self.doc.ancestor_or_self_type([Codeblock, Embedblock]).indent:
@@ -355,7 +748,7 @@ class SamParser:
     def _paragraph_start(self, context):
         source, match = context
         line = source.current_line
-        local_indent = len(line) - len(line.lstrip())
+        local_indent = source.current_indent
         b = Paragraph(local_indent)
         self.doc.add_block(b)
         self.current_text_block = UnparsedTextBlock(line)
@@ -366,32 +759,30 @@ class SamParser:
         try:
             line = source.next_line
         except EOFError:
-            f = self.flow_parser.parse(self.current_text_block.text, self.doc)
+            f = self._parse_flow(self.current_text_block.text)
             self.current_text_block = None
             self.doc.add_flow(f)
             return "END", context
 
         para_indent = self.doc.current_block.indent
-        first_line_indent = len(match.string) - len(match.string.lstrip())
-        this_line_indent = len(line) - len(line.lstrip())
+        this_line_indent = source.current_indent
 
-        if block_patterns['blank-line'].match(line):
-            f = self.flow_parser.parse(self.current_text_block.text, self.doc)
+        if source.current_kind == 'blank-line':
+            f = self._parse_flow(self.current_text_block.text)
             self.current_text_block = None
             self.doc.add_flow(f)
             return "SAM", context
 
         if this_line_indent < para_indent:
-            f = self.flow_parser.parse(self.current_text_block.text, self.doc)
+            f = self._parse_flow(self.current_text_block.text)
             self.current_text_block = None
             self.doc.add_flow(f)
             source.return_line()
             return "SAM", context
 
         if self.doc.in_context(['p', 'li']):
-            if block_patterns['list-item'].match(line) or block_patterns['num-list-item'].match(line) or block_patterns[
-                'labeled-list-item'].match(line):
-                f = self.flow_parser.parse(self.current_text_block.text, self.doc)
+            if source.current_line_matches(['list-item', 'num-list-item', 'labeled-list-item']):
+                f = self._parse_flow(self.current_text_block.text)
                 self.current_text_block = None
                 self.doc.add_flow(f)
                 source.return_line()
@@ -431,7 +822,7 @@ class SamParser:
         label = match.group("label")
         content_start = match.start("content")
         attributes, citations = parse_attributes(match.group("attributes"))
-        lli = LabeledListItem(indent, self.flow_parser.parse(label, self.doc), attributes, citations)
+        lli = LabeledListItem(indent, self._parse_flow(label), attributes, citations)
         self.doc.add_block(lli)
         p = Paragraph(content_start)
         self.doc.add_block(p)
@@ -455,32 +846,41 @@ class SamParser:
         source, match = context
         indent = match.end("indent")
         href=match.group("attributes")[1:-1]
+        import urllib.error
 
         try:
             fullhref = urllib.parse.urljoin(self.source_url, href)
         except SAMParserFileError as e:
             raise SamParserError (" at ".join(str(e), match.group(0)))
 
+        included_files = self.context.included_files
         if fullhref in included_files:
             raise SAMParserError("Duplicate file inclusion detected with file: " + fullhref)
         else:
             included_files.append(fullhref)
 
-        reader = codecs.getreader("utf-8")
         SAM_parser_info("Parsing include " + fullhref)
         try:
-            includeparser = SamParser()
-            with urllib.request.urlopen(fullhref) as response:
-                includeparser.parse(reader(response))
-            include = Include(includeparser.doc, href, fullhref, indent)
+            if self.context.include_cache is not None:
+                included_doc, dependencies = self.context.include_cache.parse(fullhref, self.context,
+                                                                              self._parse_include)
+            else:
+                included_doc, dependencies = self._parse_include(fullhref)
+            include = Include(included_doc, href, fullhref, indent)
             self.doc.add_block(include)
             SAM_parser_info("Finished parsing include " + href)
+        # Record a missing file, so that cached documents that include it are
+        # parsed again if it turns up.
         except FileNotFoundError as e:
             SAM_parser_warning(str(e))
+            dependencies = {fullhref: None}
         except urllib.error.URLError as e:
             SAM_parser_warning(str(e))
-
-        included_files.pop()
+            dependencies = {fullhref: None}
+        finally:
+            included_files.pop()
+        if self.context.include_dependencies:
+            self.context.include_dependencies[-1].update(dependencies)
 
 
 
@@ -489,7 +889,7 @@ class SamParser:
     def _variable_def(self, context):
         source, match = context
         indent = match.end("indent")
-        s = VariableDef(match.group('name'), self.flow_parser.parse(match.group('content'), self.doc), indent=indent)
+        s = VariableDef(match.group('name'), self._parse_flow(match.group('content')), indent=indent)
         self.doc.add_block(s)
         return "SAM", context
 
@@ -498,7 +898,7 @@ class SamParser:
         indent = match.end("indent")
         attributes, citations = parse_attributes(match.group("attributes"))
         b=Line(indent, attributes,
-               self.flow_parser.parse(match.group('content'), self.doc, strip=False), citations)
+               self._parse_flow(match.group('content'), strip=False), citations)
         self.doc.add_block(b)
         return "SAM", context
 
@@ -519,15 +919,15 @@ class SamParser:
             line = source.next_line
         except EOFError:
             return "END", context
-        indent = len(line) - len(line.lstrip())
-        if block_patterns['blank-line'].match(line):
+        indent = source.current_indent
+        if source.current_kind == 'blank-line':
             return "RECORD", context
         if indent < self.doc.current_block.indent:
             source.return_line()
             return "SAM", context
         else:
             #FIXME: splitting field values belongs to record object
-            field_values = [self.flow_parser.parse(x.strip(), self.doc) for x in re.split(r'(?<!\\),', line)]
+            field_values = [self._parse_flow(x.strip()) for x in re.split(r'(?<!\\),', line)]
             r = Record(field_values, indent)
             self.doc.add_block(r)
 
@@ -547,8 +947,8 @@ class SamParser:
             line = source.next_line
         except EOFError:
             return "END", context
-        indent = len(line) - len(line.lstrip())
-        if block_patterns['blank-line'].match(line):
+        indent = source.current_indent
+        if source.current_kind == 'blank-line':
             return "GRID", context
         elif indent <= self.doc.ancestor_or_self_type(Grid).indent:
             source.return_line()
@@ -565,7 +965,7 @@ class SamParser:
                 b = Cell(indent)
                 self.doc.add_block(b)
 
-                self.doc.add_flow(self.flow_parser.parse(content, self.doc))
+                self.doc.add_flow(self._parse_flow(content))
             # Test for consistency with previous rows?
 
             return "GRID", context
@@ -577,8 +977,10 @@ class SamParser:
         except EOFError:
             return "END", context
 
-        match = block_patterns['declaration'].match(line)
-        if match is not None:
+        kind = source.current_kind
+        match = source.current_match
+
+        if kind == 'declaration':
             name = match.group('name').strip()
             content = match.group('content').strip()
             if self.doc.root.children:
@@ -594,85 +996,111 @@ class SamParser:
 
             return "SAM", (source, match)
 
-        match = block_patterns['remark-start'].match(line)
-        if match is not None:
-            return "REMARK-START", (source, match)
-
-        match = block_patterns['comment'].match(line)
-        if match is not None:
+        if kind == 'comment':
             c = Comment(match.group('comment'), match.end('indent'))
             self.doc.add_block(c)
 
             return "SAM", (source, match)
 
-        match = block_patterns['record-start'].match(line)
-        if match is not None:
-            return "RECORD-START", (source, match)
-
-        match = block_patterns['blank-line'].match(line)
-        if match is not None:
+        if kind == 'blank-line':
             return "SAM", (source, match)
 
-        match = block_patterns['codeblock-start'].match(line)
-        if match is not None:
-            return "CODEBLOCK-START", (source, match)
-
-        match = block_patterns['blockquote-start'].match(line)
-        if match is not None:
-            return "BLOCKQUOTE-START", (source, match)
-
-        match = block_patterns['alt-blockquote-start'].match(line)
-        if match is not None:
-            return "BLOCKQUOTE-START", (source, match)
-
-        match = block_patterns['fragment-start'].match(line)
-        if match is not None:
-            return "FRAGMENT-START", (source, match)
-
-        match = block_patterns['grid-start'].match(line)
-        if match is not None:
-            return "GRID-START", (source, match)
-
-        match = block_patterns['list-item'].match(line)
-        if match is not None:
-            return "LIST-ITEM", (source, match)
+        try:
+            return self.line_kind_states[kind], (source, match)
+        except KeyError:
+            raise SAMParserError("I'm confused")
 
-        match = block_patterns['num-list-item'].match(line)
-        if match is not None:
-            return "NUM-LIST-ITEM", (source, match)
 
-        match = block_patterns['labeled-list-item'].match(line)
-        if match is not None:
-            return "LABELED-LIST-ITEM", (source, match)
+class Serialization:
+    """
+    The output of one of the serialization methods of a node: serialize_xml(),
+    serialize_html() or regurgitate().
+
+    The serialization methods are generators that yield chunks of output, which
+    are bytes for XML and HTML and strings for SAM. To include the output of
+    another node, they yield the Serialization of that node rather than yielding
+    from it, so that a chunk of output does not pass up through the generator of
+    every node above it in the tree. The nested generators are run with an
+    explicit stack instead.
+
+    A Serialization is an iterator over the chunks of output, so code that
+    iterates over the output of the serialization methods, or yields from it,
+    works as before. Use write_to() to write the output to a file in large blocks.
+    """
+    __slots__ = ('generator', '_chunks')
 
-        match = block_patterns['block-insert'].match(line)
-        if match is not None:
-            return "BLOCK-INSERT", (source, match)
+    def __init__(self, generator):
+        self.generator = generator
+        self._chunks = None
 
-        match = block_patterns['include'].match(line)
-        if match is not None:
-            return "INCLUDE", (source, match)
+    def __iter__(self):
+        return self
 
-        match = block_patterns['variable-def'].match(line)
-        if match is not None:
-            return "VARIABLE-DEF", (source, match)
+    def __next__(self):
+        if self._chunks is None:
+            self._chunks = self.chunks()
+        return next(self._chunks)
 
-        match = block_patterns['line-start'].match(line)
-        if match is not None:
-            return "LINE-START", (source, match)
+    def chunks(self):
+        """
+        Generates the chunks of output of this serialization and the serializations nested in it.
+        """
+        stack = [self.generator]
+        while stack:
+            for chunk in stack[-1]:
+                if type(chunk) is Serialization:
+                    stack.append(chunk.generator)
+                    break
+                yield chunk
+            else:
+                stack.pop()
 
-        match = block_patterns['block-start'].match(line)
-        if match is not None:
-            return "BLOCK", (source, match)
+    def write_to(self, file, block_size=65536):
+        """
+        Writes the output to a file or to a buffer such as io.BytesIO. Chunks of
+        output are joined into blocks of at least block_size bytes or characters
+        before they are written. If serialization fails, the output produced
+        before the failure is still written.
+        :param file: An object with a write method that accepts the type of output, bytes or strings.
+        :param block_size: The smallest size of each write, apart from the last one.
+        """
+        buffer = []
+        size = 0
+        stack = [self.generator]
+        try:
+            while stack:
+                for chunk in stack[-1]:
+                    if type(chunk) is Serialization:
+                        stack.append(chunk.generator)
+                        break
+                    buffer.append(chunk)
+                    size += len(chunk)
+                    if size >= block_size:
+                        file.write(buffer[0][:0].join(buffer))
+                        buffer = []
+                        size = 0
+                else:
+                    stack.pop()
+        finally:
+            if buffer:
+                file.write(buffer[0][:0].join(buffer))
 
-        match = block_patterns['paragraph-start'].match(line)
-        if match is not None:
-            return "PARAGRAPH-START", (source, match)
 
-        raise SAMParserError("I'm confused")
+def serializer(method):
+    """
+    Decorator for the serialization methods of nodes, which makes them return
+    a Serialization of the generator they create.
+    """
+    @functools.wraps(method)
+    def serialize(*args, **kwargs):
+        return Serialization(method(*args, **kwargs))
+    return serialize
 
 
 class Block(ABC):
+    __slots__ = ('block_type', 'namespace', 'content', 'indent', 'parent', 'position', 'children',
+                 'citations', 'ID', 'name', 'conditions', 'language_code')
+
     _attribute_serialization_xml = [('conditions', 'conditions'),
                                     ('ID', 'id'),
                                     ('name', 'name'),
@@ -693,17 +1121,20 @@ class Block(ABC):
     def __init__(self, block_type, indent, attributes={}, content=None, citations=[], namespace=None):
 
         # Test for a valid block block_type. Must be valid XML block_type.
-        try:
-            x = etree.Element(block_type)
-        except ValueError:
+        if xml_name_patterns['ascii' if block_type.isascii() else 'unicode'].fullmatch(block_type) is None:
             raise SAMParserStructureError('Invalid block name "{0}"'.format(block_type))
         self.block_type = block_type
         self.namespace = namespace
         self.content = content
         self.indent = indent
         self.parent = None
+        # The position of the block among the children of its parent
+        self.position = None
+        # The lists are made even if they stay empty, which costs about 80
+        # bytes a node (see the memory benchmark), so that callers can add
+        # to them directly.
         self.children = []
-        self.citations = citations
+        self.citations = citations if citations else []
         self.ID = None
         self.name = None
         self.conditions = []
@@ -745,11 +1176,12 @@ class Block(ABC):
         Adds a child block to the current block.
         The main reason for this being separated from the add method is so that
         block types that override add can sill inherit add_child, ensuring that
-        they do not forget to update the block's parent attribute.
+        they do not forget to update the block's parent and position attributes.
         :param b: The block to add.
         :return: None
         """
         b.parent = self
+        b.position = len(self.children)
         self.children.append(b)
 
     def find_all(self, find_function, **kwargs):
@@ -778,20 +1210,20 @@ class Block(ABC):
     def ancestors_and_self(self):
         ancestors_and_self=[]
         x=self
-        while type(x.parent) is not DocStructure:
+        while not isinstance(x.parent, DocStructure):
             ancestors_and_self.append(x)
             x=x.parent
         return ancestors_and_self
 
     def preceding_sibling(self):
-        my_pos= [i for i, x in enumerate(self.parent.children) if x is self][0]
+        my_pos = sibling_position(self)
         if my_pos > 0:
             return self.parent.children[my_pos - 1]
         else:
             return None
 
     def following_sibling(self):
-        my_pos= [i for i,x in enumerate(self.parent.children) if x is self][0]
+        my_pos = sibling_position(self)
         if my_pos == len(self.parent.children)-1:
             return None
         else:
@@ -833,18 +1265,19 @@ class Block(ABC):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield "%s:" % (self.block_type)
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         for y in [x for x in self.citations]:
-            yield from y.regurgitate()
+            yield y.regurgitate()
 
         if self.content:
             yield " %s" % (self.content)
         yield "\n"
         for z in [x for x in self.children]:
-            yield from z.regurgitate()
+            yield z.regurgitate()
 
     def _regurgitate_attributes(self, attribute_dict):
         for attr_name, symbol in attribute_dict:
@@ -878,6 +1311,7 @@ class Block(ABC):
             except AttributeError:
                 pass
 
+    @serializer
     def serialize_xml(self):
 
         yield '<{0}'.format(self.block_type).encode('utf-8')
@@ -895,28 +1329,29 @@ class Block(ABC):
             if self.citations:
                 for x in self.citations:
                     yield b'\n'
-                    yield from x.serialize_xml()
+                    yield x.serialize_xml()
 
             if self.content:
                 yield b"\n<title>"
-                yield from self.content.serialize_xml()
+                yield self.content.serialize_xml()
                 yield "</title>\n".format(self.content).encode('utf-8')
 
-            if type(self.children[0]) is not Flow:
+            if type(self.children[0]) not in (Flow, LazyFlow):
                 yield b"\n"
 
             for x in self.children:
                 if x is not None:
-                    yield from x.serialize_xml()
+                    yield x.serialize_xml()
             yield "</{0}>\n".format(self.block_type).encode('utf-8')
         else:
             if self.content is None:
                 yield b"/>\n"
             else:
                 yield b'>'
-                yield from self.content.serialize_xml()
+                yield self.content.serialize_xml()
                 yield "</{0}>\n".format(self.block_type).encode('utf-8')
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield '<{0} class="{1}"'.format(self.html_tag, self.block_type).encode('utf-8')
 
@@ -932,28 +1367,29 @@ class Block(ABC):
         if self.citations:
             for x in self.citations:
                 yield b'\n'
-                yield from x.serialize_html()
+                yield x.serialize_html()
 
         if self.content:
             if self.children:
                 title_depth = len(list(x for x in self.ancestors_and_self() if x.content))
                 heading_level = title_depth if title_depth < 6 else 6
                 yield '\n<h{0} class="title">'.format(heading_level).encode('utf-8')
-                yield from self.content.serialize_html(duplicate, variables)
+                yield self.content.serialize_html(duplicate, variables)
                 yield "</h{0}>\n".format(heading_level).encode('utf-8')
             else:
-                yield from self.content.serialize_html(duplicate, variables)
+                yield self.content.serialize_html(duplicate, variables)
 
         if self.children:
-            if type(self.children[0]) is not Flow:
+            if type(self.children[0]) not in (Flow, LazyFlow):
                 yield b"\n"
 
             for x in self.children:
                 if x is not None:
-                    yield from x.serialize_html(duplicate, variables)
+                    yield x.serialize_html(duplicate, variables)
         yield '</{0}>\n'.format(self.html_tag).encode('utf-8')
 
 class BlockInsert(Block):
+    __slots__ = ('reference_parts',)
     def __init__(self, indent, reference_parts, attributes={}, citations=[], namespace=None):
         super().__init__(block_type='insert', indent=indent, attributes=attributes,
                          citations=citations, namespace=namespace)
@@ -966,6 +1402,7 @@ class BlockInsert(Block):
     def idrefs(self):
         return [x[1] for x in self.reference_parts if x[0] == 'idref']
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         if self.reference_parts[0][0] in insert_reference_symbols:
@@ -977,9 +1414,10 @@ class BlockInsert(Block):
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield '\n'
         for c in self.children:
-            yield from c.regurgitate()
+            yield c.regurgitate()
         yield '\n'
 
+    @serializer
     def serialize_xml(self, attrs=None, payload=None):
         attributes = {}
         if self.reference_parts[0][0] in insert_reference_symbols:
@@ -1019,15 +1457,16 @@ class BlockInsert(Block):
         if self.citations or self.children:
             yield b'>\n'
             for cit in self.citations:
-                yield from cit.serialize_xml()
+                yield cit.serialize_xml()
 
             for c in self.children:
-                yield from c.serialize_xml()
+                yield c.serialize_xml()
             yield b'</insert>\n'
         else:
             yield b'/>\n'
 
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
 
         if len(self.reference_parts) == 1:
@@ -1041,7 +1480,7 @@ class BlockInsert(Block):
                     ob = self.docstructure.object_by_id(reference_value)
                     if ob:
                         variables = [x for x in self.children if type(x) is VariableDef]
-                        yield from ob.serialize_html(duplicate=True, variables=variables)
+                        yield ob.serialize_html(duplicate=True, variables=variables)
                     else:
                         SAM_parser_warning('ID reference "{0}" could not be resolved. '
                                            'It will be omitted from HTML output. At: {1}'.format(reference_value, str(self).strip()))
@@ -1049,7 +1488,7 @@ class BlockInsert(Block):
                     ob = self.docstructure.object_by_name(reference_value)
                     if ob:
                         variables = [x for x in self.children if type(x) is VariableDef]
-                        yield from ob.serialize_html(duplicate=True, variables=variables)
+                        yield ob.serialize_html(duplicate=True, variables=variables)
                     else:
                         SAM_parser_warning(
                             'Name reference "{0}" could not be resolved. '
@@ -1075,10 +1514,10 @@ class BlockInsert(Block):
                 if self.citations or self.children:
 
                     for cit in self.citations:
-                        yield from cit.serialize_html()
+                        yield cit.serialize_html()
 
                     for c in self.children:
-                        yield from c.serialize_html()
+                        yield c.serialize_html()
 
                 _, item_extension = os.path.splitext(reference_value)
                 if reference_method in known_insert_types and item_extension.lower() in known_file_types:
@@ -1099,6 +1538,7 @@ class BlockInsert(Block):
 
 
 class Codeblock(Block):
+    __slots__ = ('code_language',)
     _attribute_serialization_xml = [('conditions', 'conditions'),
                                     ('ID', 'id'),
                                     ('code_language', 'language'),
@@ -1127,17 +1567,19 @@ class Codeblock(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield '```'
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         for x in self.citations:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield '\n'
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield '\n'
 
+    @serializer
     def serialize_xml(self):
         yield b'<codeblock'
         yield from self._serialize_attributes(self._attribute_serialization_xml)
@@ -1146,16 +1588,17 @@ class Codeblock(Block):
             yield b">\n"
             if self.citations:
                 for x in self.citations:
-                    yield from x.serialize_xml()
+                    yield x.serialize_xml()
                     yield b'\n'
             if self.children:
                 for x in self.children:
                     if x is not None:
-                        yield from x.serialize_xml()
+                        yield x.serialize_xml()
             yield b"</codeblock>\n"
         else:
             yield b'/>'
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield b'<pre class="codeblock"'
         yield from self._serialize_attributes(self._attribute_serialization_html, duplicate)
@@ -1164,14 +1607,14 @@ class Codeblock(Block):
 
         if self.citations:
             for x in self.citations:
-                yield from x.serialize_html()
+                yield x.serialize_html()
                 yield b'\n'
         if self.children:
             if self.code_language:
                 yield '<code class="codeblock" data-language="{0}">'.format(self.code_language).encode('utf-8')
             for x in self.children:
                 if x is not None:
-                    yield from x.serialize_html(duplicate, variables)
+                    yield x.serialize_html(duplicate, variables)
             if self.code_language:
                 yield b'</code>'
             yield b"</pre>\n"
@@ -1180,6 +1623,7 @@ class Codeblock(Block):
 
 
 class Embedblock(Block):
+    __slots__ = ('encoding',)
     _attribute_serialization_xml = [('conditions', 'conditions'),
                                     ('encoding', 'encoding'),
                                     ('ID', 'id'),
@@ -1205,15 +1649,17 @@ class Embedblock(Block):
         super().__init__(block_type='embedblock', indent=indent, attributes=attributes,
                          citations=citations, namespace=namespace)
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield '```'
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield '\n'
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield '\n'
 
+    @serializer
     def serialize_xml(self):
         attrs = []
         yield b'<embedblock'
@@ -1227,11 +1673,12 @@ class Embedblock(Block):
 
             for x in self.children:
                 if x is not None:
-                    yield from x.serialize_xml()
+                    yield x.serialize_xml()
             yield b"</embedblock>\n"
         else:
             yield b'/>\n'
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield b'<div class="embed" hidden '
 
@@ -1244,13 +1691,14 @@ class Embedblock(Block):
 
             for x in self.children:
                 if x is not None:
-                    yield from x.serialize_html()
+                    yield x.serialize_html()
             yield b"</div>\n"
         else:
             yield b'/>\n'
 
 
 class Remark(Block):
+    __slots__ = ('attribution',)
     _attribute_serialization_xml = [('attribution', 'attribution'),
                                     ('conditions', 'conditions'),
                                     ('ID', 'id'),
@@ -1279,17 +1727,19 @@ class Remark(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield '!!!'
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield '\n'
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield '\n'
 
 
 class Grid(Block):
+    __slots__ = ()
     html_tag = 'table'
     def __init__(self, indent, attributes={}, citations=[], namespace=None):
         super().__init__(block_type='grid', indent=indent, attributes=attributes,
@@ -1298,16 +1748,18 @@ class Grid(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield "+++"
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield "\n"
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield '\n'
 
 class Row(Block):
+    __slots__ = ()
     html_tag = 'tr'
     def __init__(self, indent,  namespace=None):
         super().__init__(block_type='row', indent=indent, namespace=namespace)
@@ -1315,6 +1767,7 @@ class Row(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield ' | '.join([''.join(x.regurgitate()).replace('|', '\\|') for x in self.children]) + '\n'
@@ -1338,6 +1791,7 @@ class Row(Block):
 
 
 class Cell(Block):
+    __slots__ = ()
     html_tag = 'td'
 
     def __init__(self, indent, namespace=None):
@@ -1346,11 +1800,13 @@ class Cell(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
 
 class Line(Block):
+    __slots__ = ()
     html_tag = 'pre'
     def __init__(self, indent, attributes, content, citations=[], namespace=None):
         super().__init__(block_type='line', indent=indent, attributes=attributes, content=content,
@@ -1359,6 +1815,7 @@ class Line(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent) + '|'
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
@@ -1371,6 +1828,7 @@ class Line(Block):
             self.parent.add(b)
 
 class Fragment(Block):
+    __slots__ = ()
     def __init__(self, indent, attributes={}, citations=[], namespace=None):
         super().__init__(block_type='fragment', indent=indent, attributes=attributes,
                          citations=citations, namespace=namespace)
@@ -1378,16 +1836,18 @@ class Fragment(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield '~~~'
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield '\n'
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield '\n'
 
 class Blockquote(Block):
+    __slots__ = ()
     html_tag = "blockquote"
     def __init__(self, indent, attributes={}, citations=[], namespace=None):
         super().__init__(block_type='blockquote', indent=indent, attributes=attributes,
@@ -1396,19 +1856,21 @@ class Blockquote(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield '"""'
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         if self.citations:
             for x in self.citations:
-                yield from x.regurgitate()
+                yield x.regurgitate()
         yield '\n'
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield '\n'
 
 class RecordSet(Block):
+    __slots__ = ('field_names',)
     html_tag = "table"
     def __init__(self, block_type, field_names, indent, attributes={}, citations=[], namespace=None):
         super().__init__(block_type=block_type, indent=indent, attributes=attributes,
@@ -1418,12 +1880,13 @@ class RecordSet(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield '{0}{1}::'.format(" " * int(self.indent), self.block_type)
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield '{0}\n'.format(', '.join(self.field_names))
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
 
 
     def add(self, b):
@@ -1434,10 +1897,10 @@ class RecordSet(Block):
         elif len(b.field_values) != len(self.field_names):
             raise SAMParserStructureError('Record length does not match record set header.')
         else:
-            b.parent = self
-            self.children.append(b)
+            self._add_child(b)
 
 class Record(Block):
+    __slots__ = ('field_values',)
     _attribute_serialization_xml = [('namespace', 'xmlns')]
 
     _attribute_serialization_html = []
@@ -1449,10 +1912,12 @@ class Record(Block):
     def __str__(self):
         return
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield ', '.join([''.join(x.regurgitate()).replace(',', '\\,') for x in self.field_values]) + '\n'
 
+    @serializer
     def serialize_xml(self):
         record = list(zip(self.parent.field_names, self.field_values))
         yield b'<record'
@@ -1461,10 +1926,11 @@ class Record(Block):
         if record:
             for name, value in zip(self.parent.field_names, self.field_values):
                 yield "<{0}>".format(name).encode('utf-8')
-                yield from value.serialize_xml()
+                yield value.serialize_xml()
                 yield "</{0}>\n".format(name).encode('utf-8')
         yield b"</record>\n"
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         if not self.preceding_sibling():
             yield b'<thead class="recordset-header">\n<tr class="recordset-header-row">\n'
@@ -1480,7 +1946,7 @@ class Record(Block):
         if record:
             for name, value in zip(self.parent.field_names, self.field_values):
                 yield '<td class="record-field" data-field-name="{0}">'.format(name).encode('utf-8')
-                yield from value.serialize_html()
+                yield value.serialize_html()
                 yield b"</td>\n"
         yield b"</tr>\n"
 
@@ -1489,6 +1955,7 @@ class Record(Block):
 
 
 class List(Block):
+    __slots__ = ()
     @abstractmethod
     def __init__(self,*args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1504,11 +1971,13 @@ class List(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
 
 class UnorderedList(List):
+    __slots__ = ()
     html_tag = "ul"
 
     def __init__(self, indent, namespace=None):
@@ -1533,6 +2002,7 @@ class UnorderedList(List):
 
 
 class OrderedList(List):
+    __slots__ = ()
     html_tag = "ol"
 
     def __init__(self, indent, namespace=None):
@@ -1560,6 +2030,7 @@ class OrderedList(List):
 
 
 class ListItem(Block):
+    __slots__ = ()
     html_tag = "li"
     @abstractmethod
     def __init__(self, block_type, indent, attributes={}, citations=[], namespace=None):
@@ -1568,6 +2039,7 @@ class ListItem(Block):
 
 
 class OrderedListItem(ListItem):
+    __slots__ = ()
     def __init__(self, indent, attributes={}, citations=[],  namespace=None):
         super().__init__(block_type="li", indent=indent, attributes=attributes,
                          citations=citations, namespace=namespace)
@@ -1575,32 +2047,36 @@ class OrderedListItem(ListItem):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
-        yield '{0}.'.format(str(self.parent.children.index(self) + 1))
+        yield '{0}.'.format(str(sibling_position(self) + 1))
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield ' '
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield "\n"
 
 
 class UnorderedListItem(ListItem):
+    __slots__ = ()
     def __init__(self, indent, attributes={}, citations=[],  namespace=None):
         super().__init__(block_type="li", indent = indent, attributes = attributes, namespace = namespace)
 
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield '*'
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield ' '
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
 
 class LabeledListItem(ListItem):
+    __slots__ = ('label',)
     def __init__(self, indent, label, attributes={}, citations=[],  namespace=None):
         super().__init__(block_type="li", indent=indent, attributes=attributes,
                          citations=citations, namespace=namespace)
@@ -1609,29 +2085,31 @@ class LabeledListItem(ListItem):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield '|{0}|'.format(self.label)
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
         yield ' '
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
 
+    @serializer
     def serialize_xml(self):
         yield '<{0}'.format(self.block_type).encode('utf-8')
         yield from self._serialize_attributes(self._attribute_serialization_xml)
         yield b">\n<label>"
-        yield from self.label.serialize_xml()
+        yield self.label.serialize_xml()
         yield b"</label>\n"
 
         if self.citations:
             for x in self.citations:
                 yield b'\n'
-                yield from x.serialize_xml()
+                yield x.serialize_xml()
 
         if self.content:
             yield b"\n<title>"
-            yield from self.content.serialize_xml()
+            yield self.content.serialize_xml()
             yield b"</title>\n".format(self.content)
 
         if type(self.children[0]) is not Flow:
@@ -1639,25 +2117,27 @@ class LabeledListItem(ListItem):
 
         for x in self.children:
             if x is not None:
-                yield from x.serialize_xml()
+                yield x.serialize_xml()
         yield "</{0}>\n".format(self.block_type).encode('utf-8')
 
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield b'<div class="ll.li"'
         yield from self._serialize_attributes(self._attribute_serialization_html, duplicate)
         yield b'>\n'
         yield b'<dt class="ll.li.label">'
-        yield from self.label.serialize_html()
+        yield self.label.serialize_html()
         yield b'</dt>\n<dd class="ll.li.item">'
         for x in self.children:
             if x is not None:
-                yield from x.serialize_html(duplicate, variables)
+                yield x.serialize_html(duplicate, variables)
         yield b"</dd>\n"
         yield b"</div>\n"
 
 
 class LabeledList(List):
+    __slots__ = ()
     html_tag = "dl"
     def __init__(self, indent, attributes={}, citations=[],  namespace=None):
         super().__init__('ll', indent=indent, attributes=attributes,  namespace=namespace)
@@ -1680,6 +2160,7 @@ class LabeledList(List):
                 self.parent.add(b)
 
 class Paragraph(Block):
+    __slots__ = ()
     html_tag = "p"
     def __init__(self, indent,  namespace=None):
         super().__init__(block_type='p', indent=indent, namespace=namespace)
@@ -1687,105 +2168,114 @@ class Paragraph(Block):
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         if type(self.parent) in [Block, Blockquote, Remark, Fragment]:
             yield " " * int(self.indent)
             for x in self.children:
-                yield from x.regurgitate()
+                yield x.regurgitate()
             yield "\n\n"
         elif self.parent is None:
             for x in self.children:
-                yield from x.regurgitate()
+                yield x.regurgitate()
             yield "\n\n"
-        elif self.parent.children.index(self) == 0:
+        elif sibling_position(self) == 0:
             for x in self.children:
-                yield from x.regurgitate()
+                yield x.regurgitate()
             yield "\n\n"
         else:
             parent_indent = self.parent.indent
-            parent_leader = len(str(self.parent.parent.children.index(self.parent)+1))+2
+            parent_leader = len(str(sibling_position(self.parent)+1))+2
 
 
             yield " " * (parent_indent + parent_leader)
             for x in self.children:
-                yield from x.regurgitate()
+                yield x.regurgitate()
             yield "\n\n"
 
     def _add_child(self, b):
-        if type(b) is Flow:
-            b.parent = self
-            self.children.append(b)
+        if type(b) is Flow or type(b) is LazyFlow:
+            super()._add_child(b)
         elif self.parent.block_type == 'li' and b.block_type in ['ol', 'ul', 'comment']:
-            b.parent = self.parent
-            self.parent.children.append(b)
+            self.parent._add_child(b)
         else:
             raise SAMParserStructureError(
                 'A paragraph cannot have block children.')
 
 
 class Comment(Block):
+    __slots__ = ()
     def __init__(self, content, indent):
         super().__init__(block_type='comment', content=content, indent=indent,namespace=None)
 
     def _add_child(self, b):
         if self.parent.block_type == 'li' and b.block_type in ['ol', 'ul', 'comment']:
-            b.parent = self.parent
-            self.parent.children.append(b)
+            self.parent._add_child(b)
         else:
             raise SAMParserStructureError('A comment cannot have block children.')
 
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield " " * int(self.indent)
         yield u"#{0}\n".format(self.content)
 
+    @serializer
     def serialize_xml(self):
         yield '<!-- {0} -->\n'.format(self.content.replace('--', '-\-')).encode('utf-8')
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield '<!-- {0} -->\n'.format(self.content.replace('--', '-\-')).encode('utf-8')
 
 
 class VariableDef(Block):
+    __slots__ = ()
     def __init__(self, variable_name, value, indent=0):
         super().__init__(block_type=variable_name, content=value, indent=indent)
 
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         yield "{0}${1}={2}\n".format(" " * int(self.indent), self.block_type, self.content)
 
+    @serializer
     def serialize_xml(self):
         yield '<variable name="{0}">'.format(self.block_type).encode('utf-8')
-        yield from self.content.serialize_xml()
+        yield self.content.serialize_xml()
         yield b"</variable>\n"
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield '<div class="variable" data-name="{0}" hidden>'.format(self.block_type, self.content).encode('utf-8')
-        yield from self.content.serialize_html()
+        yield self.content.serialize_html()
         yield b"</div>\n"
 
 class Root(Block):
+    __slots__ = ()
     def __init__(self, doc):
         super().__init__(block_type='root', attributes={}, content=None, indent=-1)
         self.parent = doc
-        self.children = []
 
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         for x in self.children:
-            yield from x.regurgitate()
+            yield x.regurgitate()
 
+    @serializer
     def serialize_xml(self):
         yield b'<?xml version="1.0" encoding="UTF-8"?>\n'
         for x in self.children:
-            yield from x.serialize_xml()
+            yield x.serialize_xml()
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield b'<!DOCTYPE html>\n'
         try:
@@ -1811,7 +2301,7 @@ class Root(Block):
                 yield '<script src="js/all.min.js"></script>\n'.format(j).encode('utf-8')
         yield b'</head>\n<body>\n'
         for x in self.children:
-            yield from x.serialize_html(duplicate, variables)
+            yield x.serialize_html(duplicate, variables)
         yield b'</body>\n</html>'
 
     def _add_child(self, b):
@@ -1822,8 +2312,7 @@ class Root(Block):
         # catch it earlier and give feedback.
         if type(b) is not Comment and any( type(x) is not Comment for x in self.children):
             raise SAMParserStructureError('A SAM document can only have one root. Found "{0}".'.format(str(b)))
-        b.parent = self
-        self.children.append(b)
+        super()._add_child(b)
 
 
 class UnparsedTextBlock:
@@ -1891,9 +2380,12 @@ block_pattern_replacements = {
 
 
 class Flow():
+    __slots__ = ('children', 'parent', 'position', 'ID', 'name')
+
     def __init__(self):
         self.children=[]
         self.parent = None
+        self.position = None
         self.ID = None
         self.name = None
 
@@ -1955,11 +2447,12 @@ class Flow():
     def docstructure(self):
         return self.parent.docstructure
 
+    @serializer
     def regurgitate(self):
 
         for i, x in enumerate(self.children):
             if hasattr(x, 'regurgitate'):
-                yield from x.regurgitate()
+                yield x.regurgitate()
             elif i == 0:
                 # if block_patterns['block-start'].match(x) is not None:
                 #     yield escape_for_sam(x).replace(':', '\\:', 1)
@@ -1996,6 +2489,8 @@ class Flow():
                 self.children.append(thing)
 
         elif not thing == '':
+            if type(thing) is not str:
+                thing.position = len(self.children)
             self.children.append(thing)
 
     def find_last_annotation(self, text, mode):
@@ -2005,19 +2500,21 @@ class Flow():
         except KeyError:
             raise SAMParserError("Unknown annotation lookup mode: " + mode)
 
+    @serializer
     def serialize_xml(self):
         for x in self.children:
             if type(x) is str:
                 yield escape_for_xml(x).encode('utf-8')
             else:
-                yield from x.serialize_xml()
+                yield x.serialize_xml()
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         for x in self.children:
             if type(x) is str:
                 yield escape_for_xml(x).encode('utf-8')
             else:
-                yield from x.serialize_html(duplicate, variables)
+                yield x.serialize_html(duplicate, variables)
 
 
 # Annotation lookup modes. Third parties can add additional lookup modes
@@ -2025,7 +2522,7 @@ class Flow():
 # matching algorithms.
 
 def _annotation_lookup_case_sensitive(flow, text):
-    for i in reversed(flow):
+    for i in reversed(flow.children):
         if type(i) is Phrase:
             if i.annotated and i.text == text:
                 return i.global_annotations
@@ -2052,9 +2549,74 @@ annotation_lookup_modes = {
     'case insensitive': _annotation_lookup_case_insensitive
 }
 
+# Lookup keys for annotation lookup modes. A key function turns the text of a
+# phrase into the key under which the document indexes annotated phrases for
+# that mode, so that lookups can be made without searching the document.
+# Two phrase texts must have the same key exactly when the lookup mode treats
+# them as matching. A key of None means the text never matches. Lookup
+# modes without a key function still work, but each lookup searches the
+# flows added to the document since the last lookup of the same text.
+
+def _annotation_key_case_sensitive(text):
+    return text
+
+
+def _annotation_key_case_insensitive(text):
+    return text.lower()
+
+
+def _annotation_key_off(text):
+    return None
+
+
+annotation_lookup_keys = {
+    'on': _annotation_key_case_insensitive,
+    'off': _annotation_key_off,
+    'case sensitive': _annotation_key_case_sensitive,
+    'case insensitive': _annotation_key_case_insensitive
+}
+
+
+class LazyFlow(Flow):
+    """
+    A flow whose text has not been parsed yet, which SamParser.parse() makes
+    when parsing lazily. Until it is parsed, its children slot holds the
+    document, the position of the flow among the deferred flows of the
+    document, its text, whether to strip the text, and whether the flow was
+    added with add_flow(). Reading any attribute of the flow parses it, after
+    which it is a Flow.
+    """
+    __slots__ = ()
+
+    def __init__(self, doc, index, text, strip):
+        self.children = [doc, index, text, strip, False]
+        self.parent = None
+        self.position = None
+        self.ID = None
+        self.name = None
+
+    def __getattribute__(self, name):
+        # isinstance() reads __class__, which must not parse the flow.
+        if name != '__class__':
+            object.__getattribute__(self, 'children')[0].resolve_flows(self)
+        return object.__getattribute__(self, name)
+
+
+# Flows whose text has none of these characters cannot have annotations,
+# citations or inserts, so parsing them neither depends on nor changes the
+# rest of the document, and they can be parsed in any order.
+flow_reference_characters = ('{', '(', '[')
 
 
 class Pre(Flow):
+    """
+    The text of a codeblock or an embed block. A Pre keeps the lines of the
+    block as they were read from the source, with the indent that is removed
+    from them, rather than copies of the lines with the indent removed. The
+    lines without the indent are only made when they are asked for, and the
+    serialization methods escape and encode the text of the whole block at once.
+    """
+    __slots__ = ('source_lines', 'indent')
     html_tag = "pre"
     def __init__(self, text_block):
         super().__init__()
@@ -2066,25 +2628,42 @@ class Pre(Flow):
             min_indent = min(raw_lines, key=lambda t: t[1])[1]
         except ValueError:
             min_indent = 0
-        self.lines = [x[min_indent:] if len(x) > min_indent else x for x in text_block.lines]
+        self.source_lines = text_block.lines
         self.indent = min_indent
 
+    @property
+    def lines(self):
+        """
+        The lines of the block, with the indent removed.
+        """
+        indent = self.indent
+        return [x[indent:] if len(x) > indent else x for x in self.source_lines]
+
+    @property
+    def text(self):
+        """
+        The text of the block, with the indent removed from each line.
+        """
+        if self.indent == 0:
+            return ''.join(self.source_lines)
+        return ''.join(self.lines)
 
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    @serializer
     def regurgitate(self):
         for x in self.lines:
             yield " " * int(self.indent)
             yield x
 
+    @serializer
     def serialize_xml(self):
-        for x in self.lines:
-            yield escape_for_xml(x).encode('utf-8')
+        yield escape_for_xml(self.text).encode('utf-8')
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
-        for x in self.lines:
-            yield escape_for_xml(x).encode('utf-8')
+        yield escape_for_xml(self.text).encode('utf-8')
 
 class DocStructure:
     """
@@ -2108,8 +2687,21 @@ class DocStructure:
         self.current_block = self.root
         self.default_namespace = None
         self.annotation_lookup = "case insensitive"
-        self.ids = []
+        # The IDs declared in the document, mapped to the nodes that declare them
+        self.nodes_by_id = {}
+        # The first node in document order with each name
+        self.nodes_by_name = {}
+        # The idrefs used in the document, in the order they were added
         self.idrefs = []
+        # The flows that annotation lookup searches, in document order
+        self.annotation_flows = []
+        self._annotation_indexes = {}
+        # The LazyFlows of a lazily parsed document, in the order the parser
+        # found them, and the flow parser and position that resolve_flows()
+        # has reached in them. None if the document was not parsed lazily.
+        self.deferred_flows = None
+        self.flow_parser = None
+        self._next_deferred_flow = 0
         self.parent = None
         # Used by HTML output mode
         self.css = None
@@ -2121,8 +2713,14 @@ class DocStructure:
     def __str__(self):
         return ''.join(self.regurgitate())
 
+    def __getstate__(self):
+        self.resolve_flows()
+        return self.__dict__
+
+    @serializer
     def regurgitate(self):
-        yield from self.root.regurgitate()
+        self.resolve_flows()
+        yield self.root.regurgitate()
 
     @property
     def xml(self):
@@ -2133,13 +2731,48 @@ class DocStructure:
     @property
     def etree(self):
         if not self._etree:
-            self._etree = etree.parse(self.xml)
+            self.build_etree()
+        return self._etree
+
+    def build_etree(self, output_file=None, url=None):
+        """
+        Builds the lxml tree of the XML output of the document, which the etree
+        property then returns. The output is fed to lxml's parser as it is
+        serialized, so the XML is never held in memory as a whole. This saves
+        memory, not time: the output is still serialized and parsed again, and
+        takes about as long as parsing the joined output does (see the etree
+        benchmark).
+        :param output_file: A binary file to write the XML output to while the tree is built.
+        :param url: The URL of the tree, which XSLT uses to resolve relative references.
+        :return: The lxml ElementTree.
+        """
+        target = XMLTreeFeed(etree.XMLParser(), output_file)
+        self.serialize_xml().write_to(target)
+        self._etree = target.close()
+        if url is not None:
+            self._etree.docinfo.URL = url
         return self._etree
 
     @property
     def docstructure(self):
         return self
 
+    @property
+    def ids(self):
+        """
+        The IDs declared in the document, in the order they were added, as a list.
+        """
+        self.resolve_flows()
+        return list(self.nodes_by_id)
+
+    def unmatched_idrefs(self):
+        """
+        Finds the idrefs in the document that do not match any ID.
+        :return: A list of the unmatched idrefs, in the order they were first used.
+        """
+        self.resolve_flows()
+        return [x for x in dict.fromkeys(self.idrefs) if x not in self.nodes_by_id]
+
     def find_all(self, find_function, **kwargs):
         return self.root.find_all(find_function, **kwargs)
 
@@ -2252,16 +2885,81 @@ class DocStructure:
     def object_by_id(self, id):
         """
         Get an object by ID.
+
+        Objects are found through the index of IDs that add_block() and add_flow()
+        keep up to date. If an object found there has since lost its ID or been
+        taken out of the document, the index is rebuilt. IDs that are not in the
+        index are searched for in the document tree.
         :return: An object with the corresponding ID or none.
         """
-        return self.root.object_by_id(id)
+        return self._indexed_object('nodes_by_id', 'ID', id)
 
     def object_by_name(self, name):
         """
         Get an object by name.
+
+        Objects are found through the index of names in the same way as
+        object_by_id() finds them by ID. The index holds the first object in
+        document order with each name, so call reindex() after adding a named
+        object to the document other than through add_block() or add_flow().
         :return: An object with the corresponding name or none.
         """
-        return self.root.object_by_name(name)
+        return self._indexed_object('nodes_by_name', 'name', name)
+
+    def _indexed_object(self, index_name, attribute, value):
+        self.resolve_flows()
+        node = getattr(self, index_name).get(value)
+        if node is not None and not (getattr(node, attribute, None) == value and self.contains(node)):
+            self.reindex()
+            node = getattr(self, index_name).get(value)
+        if node is None:
+            if attribute == 'ID':
+                node = self.root.object_by_id(value)
+            else:
+                node = self.root.object_by_name(value)
+            if node is not None:
+                getattr(self, index_name)[value] = node
+        return node
+
+    def contains(self, node):
+        """
+        Determines if a node is part of the document by following its parents up to the root.
+        :param node: A block or span object.
+        :return: True if the node is in the document.
+        """
+        while node is not self.root:
+            parent = getattr(node, 'parent', None)
+            if parent is None or not isinstance(parent, (Block, Flow)):
+                return False
+            try:
+                sibling_position(node)
+            except ValueError:
+                return False
+            node = parent
+        return True
+
+    def reindex(self):
+        """
+        Rebuilds the indexes of objects by ID and by name from the document tree.
+        Call this after changing the IDs or names of objects in the document,
+        or adding objects to it, other than through add_block() and add_flow().
+        """
+        self.resolve_flows()
+        self.nodes_by_id = {}
+        self.nodes_by_name = {}
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            node_id = getattr(node, 'ID', None)
+            if node_id is not None:
+                self.nodes_by_id.setdefault(node_id, node)
+            node_name = getattr(node, 'name', None)
+            if node_name is not None:
+                self.nodes_by_name.setdefault(node_name, node)
+            if isinstance(node, Flow):
+                nodes.extend(reversed([x for x in node.children if isinstance(x, Span)]))
+            elif isinstance(node, Block):
+                nodes.extend(reversed(node.children))
 
 
 
@@ -2284,19 +2982,25 @@ class DocStructure:
 
         # ID check
         if block.ID is not None:
-            if block.ID in self.ids:
+            if block.ID in self.nodes_by_id:
                 raise SAMParserStructureError('Duplicate ID found "{0}".'.format(block.ID))
-            self.ids.append(block.ID)
+            self.nodes_by_id[block.ID] = block
+        if block.name is not None:
+            self.nodes_by_name.setdefault(block.name, block)
 
-        # Check IDs from included files
-        try:
-            overlapping_ids = set(block.ids) & set(self.ids)
+        if type(block) is Include:
+            # Check IDs from included files
+            overlapping_ids = [i for i in block.nodes_by_id if i in self.nodes_by_id]
             if overlapping_ids:
                 raise SAMParserStructureError('Duplicate ID found "{0}".'.format(', '.join(overlapping_ids)))
-            self.ids.extend(block.ids)
-            self.idrefs.extend(block.idrefs)
-        except (TypeError, AttributeError):
-            pass
+            self.nodes_by_id.update(block.nodes_by_id)
+            for name, node in block.nodes_by_name.items():
+                self.nodes_by_name.setdefault(name, node)
+            self.idrefs.extend(block.included_idrefs)
+            # Flows from included files can be used for annotation lookup
+            self.annotation_flows.extend(block.annotation_flows)
+        else:
+            self.idrefs.extend(get_idrefs(block))
 
         if block.namespace is None and self.default_namespace is not None:
             block.namespace = self.default_namespace
@@ -2317,15 +3021,96 @@ class DocStructure:
         :return: None.
         """
 
+        if type(flow) is LazyFlow:
+            # Indexed once it is parsed
+            object.__getattribute__(flow, 'children')[4] = True
+        else:
+            self._index_flow(flow)
+        self.current_block._add_child(flow)
+
+    def _index_flow(self, flow):
+        """
+        Adds the IDs, names and idrefs of a flow added to the document to its
+        indexes, and makes the flow available to annotation lookup.
+        """
         # Check for duplicate IDs in the flow
         # Add any ids found to list of ids
-        ids = [f.ID for f in flow.children if hasattr(f, 'ID') and f.ID is not None]
-        for i in ids:
-            if i in self.ids:
-                raise SAMParserStructureError('Duplicate ID found "{0}".'.format(ids[0]))
-            self.ids.append(i)
+        ids = [f for f in flow.children if hasattr(f, 'ID') and f.ID is not None]
+        for f in ids:
+            if f.ID in self.nodes_by_id:
+                raise SAMParserStructureError('Duplicate ID found "{0}".'.format(ids[0].ID))
+            self.nodes_by_id[f.ID] = f
+        for f in flow.children:
+            if isinstance(f, Span) and getattr(f, 'name', None) is not None:
+                self.nodes_by_name.setdefault(f.name, f)
+
+        self.idrefs.extend(flow.find_all(get_idrefs))
+        if type(flow) is Flow:
+            self.annotation_flows.append(flow)
+
+    def defer_flow(self, text, strip=True):
+        """
+        Makes a LazyFlow for the text of a flow of a lazily parsed document.
+        :param text: The text of the flow.
+        :param strip: Whether to strip whitespace from the ends of the text.
+        :return: The LazyFlow, or None if there is no text.
+        """
+        if text is None:
+            return None
+        flow = LazyFlow(self, len(self.deferred_flows), text, strip)
+        self.deferred_flows.append(flow)
+        return flow
 
-        self.current_block._add_child(flow)
+    def resolve_flows(self, flow=None):
+        """
+        Parses the LazyFlows of a lazily parsed document. Flows that can have
+        annotations, citations or inserts are parsed in the order the parser
+        found them, so that annotation lookup and the indexes of IDs, names and
+        idrefs give the same results as parsing the document in full. Once all
+        the flows are parsed, idrefs with no corresponding IDs are reported.
+        :param flow: A LazyFlow of the document. If given, it is parsed together
+        with the flows that have to be parsed before it, rather than all of them.
+        """
+        if self.flow_parser is None:
+            return
+        deferred = self.deferred_flows
+        stop = len(deferred)
+        if flow is not None:
+            index, text = object.__getattribute__(flow, 'children')[1:3]
+            if not any(x in text for x in flow_reference_characters):
+                self._parse_deferred_flow(flow)
+                return
+            stop = index + 1
+        while self._next_deferred_flow < stop:
+            deferred_flow = deferred[self._next_deferred_flow]
+            deferred[self._next_deferred_flow] = None
+            self._next_deferred_flow += 1
+            if type(deferred_flow) is LazyFlow:
+                self._parse_deferred_flow(deferred_flow)
+        if type(flow) is LazyFlow:
+            # Parsing it failed before
+            self._parse_deferred_flow(flow)
+        if self._next_deferred_flow == len(deferred):
+            self.flow_parser = None
+            self.deferred_flows = []
+            unmatched_idrefs = self.unmatched_idrefs()
+            if unmatched_idrefs:
+                raise SAMParserError("Idrefs found with no corresponding IDs: {0}".format(", ".join(unmatched_idrefs)))
+
+    def _parse_deferred_flow(self, flow):
+        doc, index, text, strip, indexed = object.__getattribute__(flow, 'children')
+        flow.__class__ = Flow
+        flow.children = []
+        try:
+            self.flow_parser.parse(text, self, strip, flow)
+            if indexed:
+                self._index_flow(flow)
+        except BaseException as err:
+            flow.__class__ = LazyFlow
+            flow.children = [doc, index, text, strip, indexed]
+            if isinstance(err, SAMParserStructureError):
+                raise SAMParserError("Structure error: {0} in:\n\n {1}\n".format(' '.join(err.args), text))
+            raise
 
 
 
@@ -2342,13 +3127,18 @@ class DocStructure:
         so that their flows get searched. That is why we only need to pass the annotation_lookup
         mode parameter to the flow version.
         
+        If no node is specified, the search uses an index of the annotated
+        phrases in the flows added to the document so far rather than searching
+        the document tree. See annotation_lookup_keys.
+
         :param text: The annotation text to search for. 
         :param node: The node in the document tree to start the search from. If not specified, 
         the seach defaults to self.root, meaning the entire document is searched.
         :return: The last matching annotation object, or None. 
         """
         if node is None:
-            node = self.root
+            return self._find_last_indexed_annotation(text)
+        self.resolve_flows()
         if type(node) is Flow:
             result = node.find_last_annotation(text, mode=self.annotation_lookup)
             if result is not None:
@@ -2363,87 +3153,1210 @@ class DocStructure:
                 pass
         return None
 
+    def _find_last_indexed_annotation(self, text):
+        mode = self.annotation_lookup
+        try:
+            lookup = annotation_lookup_modes[mode]
+        except KeyError:
+            raise SAMParserError("Unknown annotation lookup mode: " + mode)
+        key_function = annotation_lookup_keys.get(mode)
+
+        # The index for a mode is a dictionary and the number of flows it
+        # covers. With a key function, the dictionary maps keys to the last
+        # annotated phrase with that key. Without one, it maps texts to the
+        # result of the last lookup of that text.
+        if key_function is not None:
+            index = self._annotation_index(mode, key_function)
+            key = key_function(text)
+            phrase = None if key is None else index.get(key)
+            return None if phrase is None else phrase.global_annotations
+        else:
+            index, flow_count = self._annotation_indexes.get(mode, ({}, 0))
+            result, flows_searched = index.get(text, (None, 0))
+            for flow in reversed(self.annotation_flows[flows_searched:]):
+                found = lookup(flow, text)
+                if found is not None:
+                    result = found
+                    break
+            index[text] = (result, len(self.annotation_flows))
+            self._annotation_indexes[mode] = (index, 0)
+            return result
+
+    def _annotation_index(self, mode, key_function):
+        """
+        Brings the index of annotated phrases for a lookup mode with a key
+        function up to date with the flows added to the document.
+        :return: The index, which maps keys to the last annotated phrase with that key.
+        """
+        index, flow_count = self._annotation_indexes.get(mode, ({}, 0))
+        for flow in self.annotation_flows[flow_count:]:
+            for x in flow.children:
+                if type(x) is Phrase and x.annotated:
+                    key = key_function(x.text)
+                    if key is not None:
+                        index[key] = x
+        self._annotation_indexes[mode] = (index, len(self.annotation_flows))
+        return index
+
+    @serializer
     def serialize_html(self):
-        yield from self.root.serialize_html()
+        self.resolve_flows()
+        yield self.root.serialize_html()
 
+    @serializer
     def serialize_xml(self):
-        yield from self.root.serialize_xml()
+        self.resolve_flows()
+        yield self.root.serialize_xml()
 
-class Include(Block):
-    def __init__(self, doc, content, href, indent):
-        super().__init__(block_type="include", indent=indent, attributes={}, content = content, namespace=None)
-        self.children=doc.root.children
-        for i in doc.root.children:
-            i.parent = self
+class StreamingDocStructure(DocStructure):
+    """
+    The document structure that SamParser.events() builds. It records the
+    events of the blocks and flows added to it in its pending list, and takes
+    blocks out of the tree once they have ended, so that only the blocks that
+    are still open are kept.
+    """
+    def __init__(self, source_url):
+        super().__init__(source_url)
+        self.pending = [('start-document', self)]
+        # The blocks that have not ended, outermost first
+        self.open_blocks = []
+        # The number of children added so far to each open block, by id, so
+        # that blocks get their positions although their preceding siblings
+        # have been taken out of the tree.
+        self.child_counts = {}
 
-        self.ids = doc.ids
-        self.href= href
+    def add_block(self, block):
+        super().add_block(block)
+        path = []
+        b = block
+        while b is not self.root:
+            path.append(b)
+            b = b.parent
+        path.reverse()
+        # The blocks that were open but are not ancestors of the new block
+        # have ended, and those that are have started unless they were open.
+        common = 0
+        while common < min(len(self.open_blocks), len(path)) and self.open_blocks[common] is path[common]:
+            common += 1
+        while len(self.open_blocks) > common:
+            self._end_block(self.open_blocks.pop())
+        for b in path[common:]:
+            self._start_block(b)
+        self._release_annotation_flows()
 
-    def __str__(self):
-        return ''.join(self.regurgitate())
+    def add_flow(self, flow):
+        super().add_flow(flow)
+        flow.position = self._next_position(self.current_block)
+        self.pending.append(('start-flow', flow))
+        self.pending.extend(flow_events(flow))
+        self.pending.append(('end-flow', flow))
+        self._release_annotation_flows()
+
+    def close(self):
+        """
+        Ends the blocks that are still open, at the end of the document.
+        """
+        while self.open_blocks:
+            self._end_block(self.open_blocks.pop())
+        self.pending.append(('end-document', self))
+
+    def _next_position(self, parent):
+        position = self.child_counts.get(id(parent), 0)
+        self.child_counts[id(parent)] = position + 1
+        return position
+
+    def _start_block(self, block):
+        block.position = self._next_position(block.parent)
+        self.open_blocks.append(block)
+        if type(block) is Record:
+            self.pending.append(('record', block))
+        else:
+            self.pending.append(('start-block', block))
+        self.pending.extend(block_content_events(block))
+        if type(block) is Include:
+            for event, node in tree_events(block, start=False):
+                self.pending.append((event, node))
+                if event == 'end-block' or event == 'record':
+                    node.parent.children.remove(node)
+
+    def _end_block(self, block):
+        if type(block) is not Record:
+            self.pending.append(('end-block', block))
+        self.child_counts.pop(id(block), None)
+        block.parent.children.remove(block)
+
+    def _release_annotation_flows(self):
+        # Index the annotated phrases of the flows added so far, so that the
+        # flows do not have to be kept for annotation lookup.
+        key_function = annotation_lookup_keys.get(self.annotation_lookup)
+        if key_function is not None and self.annotation_flows:
+            index = self._annotation_index(self.annotation_lookup, key_function)
+            self.annotation_flows = []
+            self._annotation_indexes[self.annotation_lookup] = (index, 0)
+
+
+# The method of an EventHandler that handles each event
+event_handler_methods = {'start-document': 'start_document',
+                         'end-document': 'end_document',
+                         'start-block': 'start_block',
+                         'end-block': 'end_block',
+                         'record': 'record',
+                         'start-flow': 'start_flow',
+                         'end-flow': 'end_flow',
+                         'flow-text': 'flow_text',
+                         'phrase': 'phrase',
+                         'annotation': 'annotation',
+                         'citation': 'citation',
+                         'insert': 'insert',
+                         'codeblock-line': 'codeblock_line'}
+
+
+class EventHandler:
+    """
+    Handles the events of a SAM document, which SamParser.push_events() passes
+    to it as it parses the document, one method call per event. The methods of
+    this class do nothing, so a handler only needs to define the methods for
+    the events it is interested in. See SamParser.events() for the events.
+    """
+    def start_document(self, doc):
+        pass
 
-    def regurgitate(self):
-        yield " " * int(self.indent)
-        yield "<<<(" + self.content + ")\n\n"
+    def end_document(self, doc):
+        pass
 
-    def serialize_xml(self):
-        for x in self.children:
-            yield from x.serialize_xml()
+    def start_block(self, block):
+        pass
 
-    def serialize_html(self, duplicate=False, variables=[]):
-        for x in self.children:
-            yield from x.serialize_html()
+    def end_block(self, block):
+        pass
 
+    def record(self, record):
+        pass
 
+    def start_flow(self, flow):
+        pass
 
-class StringSource:
-    def __init__(self, source):
-        """
+    def end_flow(self, flow):
+        pass
 
-        :param string_to_parse: The string to parse.
-        """
-        self.current_line = None
-        self.pending_line = None
-        self.previous_line = None
-        self.buf = source
-        self.current_line_number=0
+    def flow_text(self, text):
+        pass
 
-    @property
-    def next_line(self):
-        self.previous_line = self.current_line
-        if self.pending_line is None:
-            self.current_line = self.buf.readline()
-        else:
-            self.current_line = self.pending_line
-            self.pending_line = None
-        if self.current_line == "":
-            raise EOFError("End of file")
-        self.current_line_number += 1
-        return self.current_line
+    def phrase(self, phrase):
+        pass
 
-    def return_line(self):
-        self.pending_line = self.current_line
-        self.current_line = self.previous_line
-        self.current_line_number -= 1
+    def annotation(self, annotation):
+        pass
 
+    def citation(self, citation):
+        pass
 
+    def insert(self, insert):
+        pass
 
+    def codeblock_line(self, line):
+        pass
 
-class FlowParser:
+
+class TreeBuilder(EventHandler):
+    """
+    Builds the document tree of a SAM document from its events, by putting
+    each block back into the tree as it starts. The result is the same as
+    that of SamParser.parse().
+    """
     def __init__(self):
-        # These attributes are set by the parse method
         self.doc = None
-        self.flow_source = None
-        self.current_string = None
-        self.flow = None
 
-        self.smart_quotes = 'off'
-        self.stateMachine = StateMachine()
-        self.stateMachine.add_state("PARA", self._para)
-        self.stateMachine.add_state("ESCAPE", self._escape)
-        self.stateMachine.add_state("END", None, end_state=1)
-        self.stateMachine.add_state("PHRASE-START", self._phrase_start)
-        self.stateMachine.add_state("PHRASE-END", self._phrase_end)
+    def start_document(self, doc):
+        self.doc = doc
+
+    def start_block(self, block):
+        parent = block.parent
+        block.position = len(parent.children)
+        parent.children.append(block)
+
+    record = start_block
+
+
+def flow_events(flow):
+    """
+    Generates the events of the content of a flow.
+    :param flow: A Flow or Pre object.
+    """
+    if type(flow) is Pre:
+        for line in flow.lines:
+            yield 'codeblock-line', line
+        return
+    for x in flow.children:
+        if type(x) is str:
+            yield 'flow-text', x
+        elif isinstance(x, Phrase):
+            yield 'phrase', x
+            for a in x.annotations:
+                yield 'annotation', a
+            for c in x.citations:
+                yield 'citation', c
+        elif isinstance(x, Annotation):
+            yield 'annotation', x
+        elif type(x) is Citation:
+            yield 'citation', x
+        elif type(x) is InlineInsert:
+            yield 'insert', x
+            for c in x.citations:
+                yield 'citation', c
+
+
+def block_content_events(block):
+    """
+    Generates the events of the parts of a block other than its children,
+    which are its citations and flows such as its title.
+    :param block: A Block object.
+    """
+    if type(block) is BlockInsert:
+        yield 'insert', block
+    for c in block.citations:
+        yield 'citation', c
+    if type(block) is Record:
+        flows = block.field_values
+    elif type(block) is LabeledListItem:
+        flows = [block.label]
+    else:
+        flows = [block.content]
+    for flow in flows:
+        if isinstance(flow, Flow):
+            yield from flow_events(flow)
+
+
+def tree_events(node, start=True):
+    """
+    Generates the events of a document tree that has been built already, in
+    the order in which SamParser.events() generates them while parsing.
+    :param node: A DocStructure, or a block to generate the events of the
+    subtree of.
+    :param start: Whether to generate the events of the block itself, or only
+    of its children.
+    """
+    if isinstance(node, DocStructure):
+        yield 'start-document', node
+        yield from tree_events(node.root, start=False)
+        yield 'end-document', node
+        return
+    if start:
+        if type(node) is Record:
+            yield 'record', node
+            yield from block_content_events(node)
+            return
+        yield 'start-block', node
+        yield from block_content_events(node)
+    # Iterate over a copy, so that the caller can take blocks out of the tree
+    # as they end.
+    for child in tuple(node.children):
+        if isinstance(child, Flow):
+            yield 'start-flow', child
+            yield from flow_events(child)
+            yield 'end-flow', child
+        else:
+            yield from tree_events(child)
+    if start:
+        yield 'end-block', node
+
+
+@serializer
+def serialize_events(events, method='xml', css=None, javascript=None):
+    """
+    Serializes a SAM document as XML or HTML from its events, as generated by
+    SamParser.events(), while it is being parsed. The output is the same as
+    that of the serialize_xml() or serialize_html() method of the document.
+
+    Each block in the root block of the document is written as soon as it
+    ends, and is then released, so only one of these blocks is held in memory
+    at a time. The rest of the document is written around them. Variable
+    definitions are kept, since the blocks that follow them can refer to them.
+    If the root block is not a named block, or has no blocks in it, the
+    document is written at the end as a whole.
+
+    HTML output resolves inserts by ID or name by copying the content they
+    refer to, which may be anywhere in the document, so they cannot be
+    serialized this way.
+    :param events: An iterator over the (event, node) tuples of the document.
+    :param method: 'xml' or 'html'.
+    :param css: The stylesheets to link to in HTML output.
+    :param javascript: The scripts to link to in HTML output.
+    :return: A Serialization of the output.
+    """
+    doc = root_block = None
+    # The output that closes the root block and the document, once the
+    # output that opens them has been written
+    closing = None
+    for event, node in events:
+        if event == 'start-block' or event == 'record':
+            # Put the block back into the tree, as TreeBuilder does.
+            node.parent.children.append(node)
+            if node.parent is doc.root:
+                if root_block is None and type(node) is not Comment:
+                    root_block = node
+            elif node.parent is root_block and closing is None and type(root_block) is Block:
+                opening, *closing = _split_serialization(doc, node, method)
+                yield from opening
+        elif event == 'end-block':
+            if closing is None:
+                continue
+            if node is root_block:
+                yield from closing[0]
+            elif node.parent is root_block or node.parent is doc.root:
+                yield getattr(node, 'serialize_' + method)()
+                if type(node) is not VariableDef:
+                    node.parent.children.remove(node)
+                    _release_subtree(node)
+        elif event == 'end-flow':
+            if closing is not None and node.parent is root_block:
+                yield getattr(node, 'serialize_' + method)()
+                root_block.children.remove(node)
+        elif event == 'insert':
+            if (method == 'html' and len(node.reference_parts) == 1
+                    and node.reference_parts[0][0] in ('idref', 'nameref')):
+                raise SAMParserError("Streamed HTML output cannot resolve inserts by ID or name, which need the "
+                                     "whole document. Found: {0}".format(str(node).strip()))
+        elif event == 'start-document':
+            doc = node
+            doc.css = css
+            doc.javascript = javascript
+        elif event == 'end-document':
+            if closing is None:
+                yield getattr(doc, 'serialize_' + method)()
+            else:
+                yield from closing[1]
+
+
+class StreamedBlocksMarker:
+    """
+    Stands in for the blocks of the root block when the output around them is
+    serialized, to mark where they go.
+    """
+    language_code = None
+
+    @serializer
+    def serialize_xml(self):
+        yield self
+
+    @serializer
+    def serialize_html(self, duplicate=False, variables=[]):
+        yield self
+
+
+def _split_serialization(doc, first_block, method):
+    """
+    Serializes the document with markers in place of the blocks of the root
+    block and of the blocks that follow the root block.
+    :param first_block: The first block of the root block, which is left out.
+    :return: Lists of the chunks of output that open the document, close the
+    root block, and close the document.
+    """
+    root = doc.root
+    root_block = first_block.parent
+    marker = StreamedBlocksMarker()
+    children = root.children, root_block.children
+    # The blocks that are still open are in the tree twice, once put there
+    # by the parser and once by serialize_events().
+    root.children = list(dict.fromkeys(root.children)) + [marker]
+    root_block.children = [x for x in dict.fromkeys(root_block.children) if x is not first_block] + [marker]
+    try:
+        parts = [[]]
+        for chunk in getattr(root, 'serialize_' + method)().chunks():
+            if chunk is marker:
+                parts.append([])
+            else:
+                parts[-1].append(chunk)
+    finally:
+        root.children, root_block.children = children
+    return parts
+
+
+def _release_subtree(block):
+    # Take the subtree apart, so that nodes kept in the indexes of the
+    # document do not keep the rest of it in memory.
+    stack = [block]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, Block):
+            stack.extend(x.children)
+            x.children = []
+        elif isinstance(x, Flow):
+            x.children = []
+
+
+class XMLTreeFeed:
+    """
+    A file-like object that feeds the XML written to it to an lxml parser
+    and, optionally, writes it to a file as well.
+    """
+    def __init__(self, parser, file=None):
+        self.parser = parser
+        self.file = file
+
+    def write(self, data):
+        self.parser.feed(data)
+        if self.file is not None:
+            self.file.write(data)
+
+    def close(self):
+        """
+        Finishes parsing.
+        :return: The lxml ElementTree of the XML written.
+        """
+        return self.parser.close().getroottree()
+
+
+class CompiledFileCache:
+    """
+    A cache of objects compiled from files, such as XSLT stylesheets and XML
+    schemas, so that a file used for many documents is compiled once.
+
+    Compiled objects are checked out for the duration of their use. A compiled
+    object is only used by one thread at a time, so that its error log reports
+    on the one document it was last used for. If all the compiled objects for a
+    file are in use, another one is compiled. The modification time and size
+    of the file are checked on every checkout, and the file is compiled again
+    if it has changed.
+    """
+    def __init__(self, compile):
+        """
+        :param compile: A function that compiles the file at the path passed to it.
+        """
+        self.compile = compile
+        self.compile_count = 0
+        self._lock = threading.Lock()
+        # The file stamp and the unused compiled objects for each path
+        self._entries = {}
+
+    @contextlib.contextmanager
+    def checkout(self, filename):
+        """
+        Gets a compiled object for a file, compiling the file if need be.
+        :param filename: The name of the file.
+        :return: A context manager that gives the compiled object and returns it to the cache afterward.
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != stamp:
+                entry = self._entries[path] = (stamp, [])
+            compiled = entry[1].pop() if entry[1] else None
+        if compiled is None:
+            compiled = self.compile(path)
+            with self._lock:
+                self.compile_count += 1
+        try:
+            yield compiled
+        finally:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None and entry[0] == stamp:
+                    entry[1].append(compiled)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+xslt_cache = CompiledFileCache(lambda path: etree.XSLT(etree.parse(path)))
+xsd_cache = CompiledFileCache(lambda path: etree.XMLSchema(file=path))
+
+
+class IncludeCache:
+    """
+    A cache of parsed include files, so that a file included many times, in
+    one document or in many, is parsed once. The cache can be shared by
+    parses running in several threads.
+
+    Entries are keyed by the resolved URL of the included file. An entry is
+    checked on every use against each file it was parsed from, which includes
+    the files the included file includes in turn: local files by modification
+    time and size, other URLs by a hash of their content. Including a document
+    makes its nodes part of the including document's tree, so the cache keeps
+    each document pickled and every use gets its own copy. The messages printed
+    while an included file is parsed are printed again on every use.
+
+    A URL whose server sent an ETag or Last-Modified header with it is checked
+    with a conditional request, so it is only downloaded again if it has changed.
+    """
+    # The ETag and Last-Modified headers and the stamp of the content last
+    # downloaded from each URL, shared by all caches
+    _validators = {}
+    _validators_lock = threading.Lock()
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # The pickled document, the stamps of the files it depends on, the
+        # smart quote sets it was parsed with and the messages printed while
+        # it was parsed, for each URL
+        self._entries = {}
+
+    @staticmethod
+    def stamp(url):
+        """
+        Gets a stamp that changes when the file at a URL changes.
+        :param url: The URL of the file.
+        :return: The modification time and size of a local file, a hash of the
+        content at other URLs, or None if there is no file at the URL.
+        """
+        import urllib.request
+        import urllib.error
+        import hashlib
+        try:
+            if urlparse(url).scheme == 'file':
+                stat = os.stat(urllib.request.url2pathname(urlparse(url).path))
+                return stat.st_mtime_ns, stat.st_size
+            request = urllib.request.Request(url)
+            with IncludeCache._validators_lock:
+                validators = IncludeCache._validators.get(url)
+            if validators is not None:
+                etag, last_modified, stamp = validators
+                if etag:
+                    request.add_header('If-None-Match', etag)
+                if last_modified:
+                    request.add_header('If-Modified-Since', last_modified)
+            try:
+                with urllib.request.urlopen(request) as response:
+                    stamp = hashlib.sha256(response.read()).hexdigest()
+                    IncludeCache.remember_validators(url, response, stamp)
+                    return stamp
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and validators is not None:
+                    return stamp
+                raise
+        except OSError:
+            return None
+
+    @staticmethod
+    def remember_validators(url, response, stamp):
+        """
+        Keeps the headers that a later stamp of a URL can make a conditional
+        request with.
+        :param url: The URL that was requested.
+        :param response: The response, from urllib.request.urlopen.
+        :param stamp: The stamp of the content of the response.
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with IncludeCache._validators_lock:
+            if etag or last_modified:
+                IncludeCache._validators[url] = (etag, last_modified, stamp)
+            else:
+                IncludeCache._validators.pop(url, None)
+
+    def dependencies(self, url):
+        """
+        Gets the URLs of the files the cache entry for a URL depends on.
+        :return: The URLs, or an empty list if there is no entry.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        return list(entry[1]) if entry is not None else []
+
+    def parse(self, url, context, parse):
+        """
+        Gets the parsed document of an included file, parsing the file if it is
+        not in the cache or has changed.
+        :param url: The resolved URL of the included file.
+        :param context: The ParseContext of the including parse. The URL must
+        already be on its stack of included files.
+        :param parse: A function that parses the file at a URL, returning its
+        DocStructure and the stamps of the files it depends on, by URL.
+        :return: A DocStructure for the caller's use only, and the stamps of
+        the files it depends on.
+        """
+        import pickle
+        with self._lock:
+            entry = self._entries.get(url)
+        if (entry is not None and entry[2] == context.smart_quote_sets
+                and all(context.stamp(x) == stamp for x, stamp in entry[1].items())):
+            for x in entry[1]:
+                if x != url and x in context.included_files:
+                    raise SAMParserError("Duplicate file inclusion detected with file: " + x)
+            with self._lock:
+                self.hits += 1
+            doc = unpickle(entry[0])
+            for message in entry[3]:
+                print_message(message)
+        else:
+            with self._lock:
+                self.misses += 1
+            with recorded_messages() as messages:
+                doc, dependencies = parse(url)
+            entry = (pickle.dumps(doc, pickle.HIGHEST_PROTOCOL), dependencies, context.smart_quote_sets, messages)
+            with self._lock:
+                self._entries[url] = entry
+        return doc, entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+include_cache = IncludeCache()
+
+
+def fetch_include(url):
+    """
+    Reads an included file.
+    :param url: The resolved URL of the file.
+    :return: The content of the file as bytes, the URL it was read from after
+    any redirects, and its IncludeCache stamp.
+    """
+    import urllib.request
+    import hashlib
+    local = urlparse(url).scheme == 'file'
+    # Stamp a local file before reading it, so that a change made while it
+    # is read shows up the next time a cache entry for it is checked.
+    stamp = IncludeCache.stamp(url) if local else None
+    with urllib.request.urlopen(url) as response:
+        data = response.read()
+        source_url = response.geturl()
+        if not local:
+            stamp = hashlib.sha256(data).hexdigest()
+            IncludeCache.remember_validators(url, response, stamp)
+    return data, source_url, stamp
+
+
+class ParseCache:
+    """
+    A cache of parsed documents in a directory, so that a file that has not
+    changed since it was last parsed is loaded rather than parsed again, even
+    by another process or a later run. The cache is used by
+    SamParser.parse_file.
+
+    Entries are keyed by a hash of the source file, its URL, the version of the
+    parser and the smart quote sets in effect. The declarations of a document
+    are part of its source. An entry also records the files the document
+    includes, and is only used if none of them has changed since.
+
+    Entries are pickled, so a cache directory should only be shared with
+    users you trust. Entries not used for max_age seconds are removed, and
+    then the least recently used ones while the entries take up more than
+    max_size bytes. Entries are checked for eviction on the first store made
+    through a ParseCache object and then once every evict_interval stores.
+    """
+    evict_interval = 100
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024, max_age=30 * 24 * 60 * 60):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._stores = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __reduce__(self):
+        # Worker processes get a cache object of their own for the same directory.
+        return ParseCache, (self.directory, self.max_size, self.max_age)
+
+    def key(self, data, source_url, context):
+        """
+        Works out the key of the entry for a source file.
+        :param data: The content of the file as bytes.
+        :param source_url: The URL of the file.
+        :param context: The ParseContext of the parse.
+        :return: The key, as a string of hexadecimal digits.
+        """
+        smart_quote_sets = [(name, [(r.pattern, r.flags, sub) for r, sub in subs.items()])
+                            for name, subs in sorted(context.smart_quote_sets.items())]
+        import hashlib
+        h = hashlib.sha256()
+        h.update(repr((parser_version(), source_url, smart_quote_sets)).encode('utf-8'))
+        h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.samcache')
+
+    def load(self, key):
+        """
+        Loads a parsed document.
+        :param key: The key of its entry.
+        :return: The DocStructure, the stamps of the files it includes and the
+        messages printed while parsing it, or None if there is no entry that
+        is up to date.
+        """
+        import pickle
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                dependencies, messages, pickled_doc = pickle.load(f)
+            if all(IncludeCache.stamp(url) == stamp for url, stamp in dependencies.items()):
+                doc = unpickle(pickled_doc)
+                os.utime(path)
+                with self._lock:
+                    self.hits += 1
+                return doc, dependencies, messages
+        except Exception:
+            # An entry that is missing, damaged or written by an incompatible
+            # version of Python is a miss.
+            pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, key, doc, dependencies, messages):
+        """
+        Stores a parsed document.
+        :param key: The key of its entry.
+        :param doc: The DocStructure.
+        :param dependencies: The IncludeCache stamps of the files the document
+        includes, by URL.
+        :param messages: The messages printed while parsing the document.
+        """
+        import pickle
+        # The document is pickled separately so that an out of date entry is
+        # found without unpickling it.
+        entry = (dependencies, messages, pickle.dumps(doc, pickle.HIGHEST_PROTOCOL))
+        # Write the entry under a temporary name first, so that other processes
+        # never see part of an entry.
+        import tempfile
+        f = tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            with f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, self._path(key))
+        except BaseException:
+            self._remove(f.name)
+            raise
+        with self._lock:
+            self._stores += 1
+            evict = self._stores % self.evict_interval == 1
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes entries that are too old, then the least recently used
+        entries until the rest fit in the maximum size.
+        """
+        entries = []
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for x in it:
+                if not x.name.endswith('.samcache'):
+                    continue
+                try:
+                    stat = x.stat()
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.max_age:
+                    self._remove(x.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, x.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with os.scandir(self.directory) as it:
+            for x in it:
+                if x.name.endswith('.samcache'):
+                    self._remove(x.path)
+
+
+def unpickle(data):
+    """
+    Unpickles a document tree. The garbage collector is held off while the
+    tree is built, since otherwise it runs over and over as the many new
+    nodes are created, only to find that none of them are garbage.
+    """
+    import pickle
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(data)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+@functools.lru_cache(maxsize=None)
+def parser_version():
+    """
+    Gets a hash of the source of the parser, which changes whenever the
+    parser does.
+    """
+    import hashlib
+    h = hashlib.sha256()
+    for module in (__name__, StateMachine.__module__):
+        with open(sys.modules[module].__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+prefetch_workers = 8
+_prefetch_pool = None
+_prefetch_pool_pid = None
+_prefetch_pool_lock = threading.Lock()
+
+def prefetch_pool():
+    """
+    Gets the pool of threads that prefetch included files, which is shared by
+    all parses in a process. The pool is created on first use, and again in
+    a child process forked after it was created, since its threads are not
+    carried over by the fork.
+    """
+    global _prefetch_pool, _prefetch_pool_pid
+    import concurrent.futures
+    with _prefetch_pool_lock:
+        if _prefetch_pool is None or _prefetch_pool_pid != os.getpid():
+            _prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_workers,
+                                                                   thread_name_prefix="sam-include")
+            _prefetch_pool_pid = os.getpid()
+        return _prefetch_pool
+
+
+class Include(Block):
+    __slots__ = ('href', 'ids', 'nodes_by_id', 'nodes_by_name', 'included_idrefs', 'annotation_flows')
+    def __init__(self, doc, content, href, indent):
+        super().__init__(block_type="include", indent=indent, attributes={}, content = content, namespace=None)
+        self.children=doc.root.children
+        for position, i in enumerate(doc.root.children):
+            i.parent = self
+            i.position = position
+
+        self.ids = doc.ids
+        self.nodes_by_id = doc.nodes_by_id
+        self.nodes_by_name = doc.nodes_by_name
+        self.included_idrefs = doc.idrefs
+        self.annotation_flows = doc.annotation_flows
+        self.href= href
+
+    def __str__(self):
+        return ''.join(self.regurgitate())
+
+    @serializer
+    def regurgitate(self):
+        yield " " * int(self.indent)
+        yield "<<<(" + self.content + ")\n\n"
+
+    @serializer
+    def serialize_xml(self):
+        for x in self.children:
+            yield x.serialize_xml()
+
+    @serializer
+    def serialize_html(self, duplicate=False, variables=[]):
+        for x in self.children:
+            yield x.serialize_html()
+
+
+
+class LineLexer:
+    """
+    Classifies every line of a SAM source document in a single pass before
+    the block state machine runs. For each line, the lexer records its indent,
+    its kind (the name of the first entry in line_kinds that matches it, or
+    'blank-line') and the match object of the corresponding block pattern.
+    Indents and kinds are kept in compact arrays indexed by line number
+    (counting from 0).
+
+    Rather than trying every block pattern in turn, the lexer only tries the
+    patterns whose lead character fits the first non-space character of the
+    line. The candidate patterns for each lead character are worked out the
+    first time the character is seen.
+    """
+    kinds = tuple(['blank-line'] + [name for name, lead in line_kinds])
+    _kind_codes = {name: code for code, name in enumerate(kinds)}
+    _leads = [(code + 1, name, re.compile(lead, re.U)) for code, (name, lead) in enumerate(line_kinds)]
+    _candidates = {}
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.indents = array('l')
+        self.kind_codes = bytearray()
+        self.matches = []
+        for line in lines:
+            self._classify(line)
+
+    def _classify(self, line):
+        indent, code, match = self.classify(line)
+        self.indents.append(indent)
+        self.kind_codes.append(code)
+        self.matches.append(match)
+
+    @classmethod
+    def classify(cls, line):
+        """
+        Classifies a line.
+        :param line: The line.
+        :return: The indent of the line, the code of its kind and the match
+        object of the block pattern for the kind, which is None for a blank line.
+        """
+        content = line.lstrip()
+        indent = len(line) - len(content)
+        if not content:
+            return indent, 0, None
+        try:
+            candidates = cls._candidates[content[0]]
+        except KeyError:
+            candidates = tuple((code, block_patterns[name]) for code, name, lead in cls._leads
+                               if lead.match(content[0]))
+            cls._candidates[content[0]] = candidates
+        for code, pattern in candidates:
+            match = pattern.match(line)
+            if match is not None:
+                return indent, code, match
+        raise SAMParserError("I'm confused")
+
+    def kind(self, line_index):
+        return self.kinds[self.kind_codes[line_index]]
+
+    def line_indexes(self, kind):
+        """
+        Lists the lines classified as a given kind.
+        :param kind: The name of a line kind.
+        :return: The indexes of the lines, in order.
+        """
+        code = self._kind_codes[kind]
+        result = []
+        position = self.kind_codes.find(code)
+        while position >= 0:
+            result.append(position)
+            position = self.kind_codes.find(code, position + 1)
+        return result
+
+    def codeblock_line_ranges(self):
+        """
+        Works out which lines are the content of code and embed blocks, which
+        is text rather than SAM whatever kind the lines were classified as: the
+        blank lines and the lines indented more than the block's header that
+        follow it.
+        :return: The (start, end) ranges of the indexes of the lines, in order.
+        """
+        ranges = []
+        end = 0
+        for start in self.line_indexes('codeblock-start'):
+            if start < end:
+                continue
+            indent = self.indents[start]
+            end = start + 1
+            while end < len(self.kind_codes) and (self.kind_codes[end] == 0 or self.indents[end] > indent):
+                end += 1
+            ranges.append((start + 1, end))
+        return ranges
+
+    def could_match(self, line_index, kind):
+        """
+        Determines if a line could match the block pattern of a given kind,
+        independent of the kind it was classified as.
+        :param line_index: The index of the line in the source.
+        :param kind: The name of a line kind.
+        :return: True if the line matches the block pattern for that kind.
+        """
+        return self.line_could_match(self.lines[line_index], self.kind_codes[line_index], kind)
+
+    @classmethod
+    def line_could_match(cls, line, code, kind):
+        """
+        Determines if a line could match the block pattern of a given kind.
+        :param line: The line.
+        :param code: The code of the kind the line was classified as.
+        :param kind: The name of a line kind.
+        :return: True if the line matches the block pattern for that kind.
+        """
+        if code == cls._kind_codes[kind]:
+            return True
+        if code == 0:
+            return False
+        content = line.lstrip()
+        if any(c == cls._kind_codes[kind] for c, p in cls._candidates[content[0]]):
+            return block_patterns[kind].match(line) is not None
+        return False
+
+
+def read_lines(source):
+    """
+    Reads the lines of a SAM document, as readlines() reads them from a file
+    opened in text mode with universal newlines. The lines of a binary source
+    are decoded as UTF-8, skipping a byte order mark if there is one.
+    :param source: A file-like object in text mode, or in binary mode if it holds UTF-8.
+    :return: A list of the lines, with their line ends.
+    """
+    if not isinstance(source, (io.RawIOBase, io.BufferedIOBase)):
+        return source.readlines()
+    wrapper = io.TextIOWrapper(source, encoding='utf-8-sig')
+    try:
+        return wrapper.readlines()
+    finally:
+        # Detach the wrapper so that it does not close the source when it is
+        # garbage collected.
+        wrapper.detach()
+
+def text_lines(source):
+    """
+    Generates the lines of a SAM document, as iterating over a file opened in
+    text mode with universal newlines does. The lines of a binary source are
+    decoded as UTF-8, skipping a byte order mark if there is one.
+    :param source: A file-like object in text mode, or in binary mode if it holds UTF-8.
+    """
+    if not isinstance(source, (io.RawIOBase, io.BufferedIOBase)):
+        yield from source
+        return
+    wrapper = io.TextIOWrapper(source, encoding='utf-8-sig')
+    try:
+        yield from wrapper
+    finally:
+        # A parse that stops early may only let go of the lines once the
+        # source has been closed, when there is nothing left to detach from.
+        if not source.closed:
+            wrapper.detach()
+
+
+class StringSource:
+    def __init__(self, source):
+        """
+
+        :param source: A file-like object containing the SAM document to parse,
+        in text mode, or in binary mode if it is encoded in UTF-8.
+        """
+        self.current_line = None
+        self.previous_line = None
+        self.lexer = LineLexer(read_lines(source))
+        self.current_line_number = 0
+
+    @property
+    def next_line(self):
+        self.previous_line = self.current_line
+        if self.current_line_number >= len(self.lexer.lines):
+            self.current_line = ""
+            raise EOFError("End of file")
+        self.current_line = self.lexer.lines[self.current_line_number]
+        self.current_line_number += 1
+        return self.current_line
+
+    def return_line(self):
+        self.current_line = self.previous_line
+        self.current_line_number -= 1
+
+    @property
+    def current_kind(self):
+        return self.lexer.kind(self.current_line_number - 1)
+
+    @property
+    def current_match(self):
+        return self.lexer.matches[self.current_line_number - 1]
+
+    @property
+    def current_indent(self):
+        return self.lexer.indents[self.current_line_number - 1]
+
+    def current_line_matches(self, kinds):
+        """
+        Determines if the current line matches the block pattern of any of the given
+        line kinds, regardless of which kind the lexer classified it as.
+        :param kinds: A list of line kind names.
+        :return: True if the current line matches any of them.
+        """
+        return any(self.lexer.could_match(self.current_line_number - 1, k) for k in kinds)
+
+
+class StreamSource(StringSource):
+    """
+    A source that reads and classifies the lines of a document one at a time
+    as the parser asks for them, rather than all of them up front, and only
+    keeps the current and the previous line. SamParser.events() uses it, so
+    that the memory it uses does not grow with the size of the document.
+    """
+    def __init__(self, source):
+        """
+
+        :param source: A file-like object containing the SAM document to parse,
+        in text mode, or in binary mode if it is encoded in UTF-8.
+        """
+        self.current_line = None
+        self.previous_line = None
+        self.current_line_number = 0
+        self.lines = text_lines(source)
+        # The (indent, kind code, match) of the current and the previous line
+        self.current = None
+        self.previous = None
+        # The classification of the line given back by return_line()
+        self.returned = None
+
+    @property
+    def next_line(self):
+        self.previous_line = self.current_line
+        self.previous = self.current
+        if self.returned is not None:
+            self.current_line, self.current = self.returned
+            self.returned = None
+        else:
+            try:
+                self.current_line = next(self.lines)
+            except StopIteration:
+                self.current_line = ""
+                raise EOFError("End of file")
+            self.current = LineLexer.classify(self.current_line)
+        self.current_line_number += 1
+        return self.current_line
+
+    def return_line(self):
+        self.returned = (self.current_line, self.current)
+        self.current = self.previous
+        super().return_line()
+
+    @property
+    def current_kind(self):
+        return LineLexer.kinds[self.current[1]]
+
+    @property
+    def current_match(self):
+        return self.current[2]
+
+    @property
+    def current_indent(self):
+        return self.current[0]
+
+    def current_line_matches(self, kinds):
+        return any(LineLexer.line_could_match(self.current_line, self.current[1], k) for k in kinds)
+
+
+class FlowParser:
+    # The state that handles each character that can start a markup construct.
+    markup_states = {'\\': "ESCAPE",
+                     '{': "PHRASE-START",
+                     '[': "CITATION-START",
+                     '*': "BOLD-START",
+                     '_': "ITALIC-START",
+                     '`': "CODE-START",
+                     '>': "INLINE-INSERT",
+                     '&': "CHARACTER-ENTITY"}
+
+    def __init__(self, context=None):
+        self.context = ParseContext() if context is None else context
+        # These attributes are set by the parse method
+        self.doc = None
+        self.flow_source = None
+        self.current_string = None
+        self.flow = None
+
+        self.smart_quotes = 'off'
+        self.stateMachine = StateMachine()
+        self.stateMachine.add_state("PARA", self._para)
+        self.stateMachine.add_state("ESCAPE", self._escape)
+        self.stateMachine.add_state("END", None, end_state=1)
+        self.stateMachine.add_state("PHRASE-START", self._phrase_start)
+        self.stateMachine.add_state("PHRASE-END", self._phrase_end)
         self.stateMachine.add_state("ANNOTATION-START", self._annotation_start)
         self.stateMachine.add_state("CITATION-START", self._citation_start)
         self.stateMachine.add_state("BOLD-START", self._bold_start)
@@ -2452,72 +4365,106 @@ class FlowParser:
         self.stateMachine.add_state("INLINE-INSERT", self._inline_insert)
         self.stateMachine.add_state("CHARACTER-ENTITY", self._character_entity)
         self.stateMachine.set_start("PARA")
+        self.smart_quote_matches = {}
 
 
-    def parse(self, flow_source, doc, strip=True):
+    def parse(self, flow_source, doc, strip=True, flow=None):
+        """
+        Parses the text of a flow.
+        :param flow_source: The text to parse.
+        :param doc: The DocStructure the flow belongs to, which is searched for annotations.
+        :param strip: Whether to strip whitespace from the ends of the text.
+        :param flow: The Flow to parse the text into. A new one is made if not given.
+        :return: The Flow, or None if there is no text.
+        """
         if flow_source is None:
             return None
         self.doc = doc
         self.flow_source = FlowSource(flow_source, strip)
         self.current_string = ''
-        self.flow = Flow()
+        self.flow = Flow() if flow is None else flow
+        self.smart_quote_matches = {}
         self.stateMachine.run(self.flow_source)
         return self.flow
 
     def _para(self, para):
-        try:
-            char = para.next_char
-        except IndexError:
+        # Copy the plain text up to the next character that can start a markup
+        # construct in one go, then hand that character to the state for the
+        # construct it starts.
+        text = para.para
+        pos = para.currentCharNumber + 1
+        while True:
+            match = flow_patterns['markup'].search(text, pos)
+            markup_pos = len(text) if match is None else match.start()
+            pos = self._append_text(text, pos, markup_pos)
+            # A smart quote substitution can consume markup characters,
+            # in which case we have to look for the next one again.
+            if pos <= markup_pos:
+                break
+        if markup_pos == len(text):
             self.flow.append(self.current_string)
             self.current_string = ''
             return "END", para
-        if char == '\\':
-            return "ESCAPE", para
-        elif char == '{':
-            return "PHRASE-START", para
-        elif char == '[':
-            return "CITATION-START", para
-        elif char == "*":
-            return "BOLD-START", para
-        elif char == "_":
-            return "ITALIC-START", para
-        elif char == "`":
-            return "CODE-START", para
-        elif char == ">":
-            return "INLINE-INSERT", para
-        elif char == "&":
-            return "CHARACTER-ENTITY", para
-        else:
-            if self.smart_quotes != 'off':
-                try:
-                    for r, sub in smart_quote_sets[self.smart_quotes].items():
-                        match = r.match(para.para, para.currentCharNumber)
-                        if match is not None:
-                            self.current_string += sub
-                            if len(match.group(0)) > 1:
-                                para.advance(len(match.group(0)) - 1)
-                            return "PARA", para
-                except KeyError:
-                    raise SAMParserError("Unknown smart quotes set specified: {0}".format(self.smart_quotes))
+        para.currentCharNumber = markup_pos
+        return self.markup_states[text[markup_pos]], para
 
-            self.current_string += char
-            return "PARA", para
+    def _append_text(self, text, start, end):
+        """
+        Appends a run of plain text to the current string, applying the
+        current set of smart quote substitutions.
+        :param text: The text of the flow being parsed.
+        :param start: The start of the run of text in the flow.
+        :param end: The end of the run of text in the flow.
+        :return: The position in the flow after the appended text. This is
+        beyond the end of the run if a substitution consumed characters past it.
+        """
+        if start >= end:
+            return start
+        if self.smart_quotes == 'off':
+            self.current_string += text[start:end]
+            return end
+        try:
+            subs = self.context.smart_quote_sets[self.smart_quotes]
+        except KeyError:
+            raise SAMParserError("Unknown smart quotes set specified: {0}".format(self.smart_quotes))
+
+        pos = start
+        while pos < end:
+            # Find the substitution that applies closest to the current position,
+            # preferring the first in the set if more than one applies there.
+            # The last match found for each pattern is kept, since it remains
+            # the nearest until the position moves past its start.
+            nearest = None
+            for r, sub in subs.items():
+                match = self.smart_quote_matches.get(r, False)
+                if match is False or (match is not None and match.start() < pos):
+                    match = r.search(text, pos)
+                    self.smart_quote_matches[r] = match
+                if match is not None and (nearest is None or match.start() < nearest[0].start()):
+                    nearest = (match, sub)
+            if nearest is None or nearest[0].start() >= end:
+                self.current_string += text[pos:end]
+                return end
+            match, sub = nearest
+            self.current_string += text[pos:match.start()] + sub
+            pos = match.start() + max(len(match.group(0)), 1)
+        return pos
 
     def _phrase_start(self, para):
-        match = flow_patterns['phrase'].match(para.rest_of_para)
+        match = para.match(flow_patterns['phrase'])
         if match:
             self.flow.append(self.current_string)
             self.current_string = ''
             text = unescape(match.group("text"))
             if self.smart_quotes != 'off':
-                text = multi_replace(text, smart_quote_sets[self.smart_quotes])
+                text = multi_replace(text, self.context.smart_quote_sets[self.smart_quotes])
             p = Phrase(text)
             self.flow.append(p)
             para.advance(len(match.group(0)))
 
-            if flow_patterns['annotation'].match(para.rest_of_para):
+            if para.match(flow_patterns['annotation']):
                 return "ANNOTATION-START", para
-            elif flow_patterns['citation'].match(para.rest_of_para):
+            elif para.match(flow_patterns['citation']):
                 return "CITATION-START", para
             else:
                 para.retreat(1)
@@ -2553,7 +4500,7 @@ class FlowParser:
         return "PARA", para
 
     def _annotation_start(self, para):
-        match = flow_patterns['annotation'].match(para.rest_of_para)
+        match = para.match(flow_patterns['annotation'])
         phrase = self.flow.children[-1]
         if not isinstance(phrase, (Phrase, Code)):
             raise SAMParserError("A {0} cannot have an annotation. At:\n{1}".format(type(phrase).__name__, match.group(0)))
@@ -2572,7 +4519,7 @@ class FlowParser:
 
 
             # Check for link shortcut
-            if urlparse(annotation_type, None).scheme is not None:
+            if urlparse(annotation_type).scheme:
                 specifically = annotation_type
                 annotation_type = 'link'
             else:
@@ -2601,9 +4548,9 @@ class FlowParser:
                 else:
                     phrase.add_annotation(Annotation(annotation_type, unescape(specifically), namespace, is_local, cancel))
             para.advance(len(match.group(0)))
-            if flow_patterns['annotation'].match(para.rest_of_para):
+            if para.match(flow_patterns['annotation']):
                 return "ANNOTATION-START", para
-            elif flow_patterns['citation'].match(para.rest_of_para):
+            elif para.match(flow_patterns['citation']):
                 return "CITATION-START", para
             else:
                 para.retreat(1)
@@ -2616,15 +4563,15 @@ class FlowParser:
             return "PARA", para
 
     def _citation_start(self, para):
-        match = flow_patterns['citation'].match(para.rest_of_para)
+        match = para.match(flow_patterns['citation'])
         if match:
             self.flow.append(self.current_string)
             self.current_string = ''
             self.flow.append(Citation(*parse_citation(match.group('citation'))))
             para.advance(len(match.group(0)))
-            if flow_patterns['annotation'].match(para.rest_of_para):
+            if para.match(flow_patterns['annotation']):
                 return "ANNOTATION-START", para
-            elif flow_patterns['citation'].match(para.rest_of_para):
+            elif para.match(flow_patterns['citation']):
                 return "CITATION-START", para
             else:
                 para.retreat(1)
@@ -2634,49 +4581,49 @@ class FlowParser:
             return "PARA", para
 
     def _bold_start(self, para):
-        match = flow_patterns['bold'].match(para.rest_of_para)
+        match = para.match(flow_patterns['bold'])
         if match:
             self.flow.append(self.current_string)
             self.current_string = ''
             p = Phrase(unescape(match.group("text")))
             self.flow.append(p)
-            p.annotations.append(Annotation('bold', local=True))
+            p.annotations = [Annotation('bold', local=True)]
             para.advance(len(match.group(0)))
         else:
             self.current_string += '*'
             return "PARA", para
 
-        if flow_patterns['annotation'].match(para.rest_of_para):
+        if para.match(flow_patterns['annotation']):
             return "ANNOTATION-START", para
-        elif flow_patterns['citation'].match(para.rest_of_para):
+        elif para.match(flow_patterns['citation']):
             return "CITATION-START", para
         else:
             para.retreat(1)
             return "PARA", para
 
     def _italic_start(self, para):
-        match = flow_patterns['italic'].match(para.rest_of_para)
+        match = para.match(flow_patterns['italic'])
         if match:
             self.flow.append(self.current_string)
             self.current_string = ''
             p = Phrase(unescape(match.group("text")))
             self.flow.append(p)
-            p.annotations.append(Annotation('italic', local=True))
+            p.annotations = [Annotation('italic', local=True)]
             para.advance(len(match.group(0)))
         else:
             self.current_string += '_'
             return "PARA", para
 
-        if flow_patterns['annotation'].match(para.rest_of_para):
+        if para.match(flow_patterns['annotation']):
             return "ANNOTATION-START", para
-        elif flow_patterns['citation'].match(para.rest_of_para):
+        elif para.match(flow_patterns['citation']):
             return "CITATION-START", para
         else:
             para.retreat(1)
             return "PARA", para
 
     def _code_start(self, para):
-        match = flow_patterns['code'].match(para.rest_of_para)
+        match = para.match(flow_patterns['code'])
         if match:
             self.flow.append(self.current_string)
             self.current_string = ''
@@ -2686,16 +4633,16 @@ class FlowParser:
             self.current_string += '`'
             return "PARA", para
 
-        if flow_patterns['annotation'].match(para.rest_of_para):
+        if para.match(flow_patterns['annotation']):
             return "ANNOTATION-START", para
-        elif flow_patterns['citation'].match(para.rest_of_para):
+        elif para.match(flow_patterns['citation']):
             return "CITATION-START", para
         else:
             para.retreat(1)
             return "PARA", para
 
     def _inline_insert(self, para):
-        match = flow_patterns['inline-insert'].match(para.rest_of_para)
+        match = para.match(flow_patterns['inline-insert'])
         if match:
             self.flow.append(self.current_string)
             self.current_string = ''
@@ -2711,22 +4658,24 @@ class FlowParser:
 
     def _escape(self, para):
         char = para.next_char
-        if re_escaped_chars.match(char):
+        if flow_patterns['escaped-character'].match(char):
             self.current_string += char
         else:
             self.current_string += '\\' + char
         return "PARA", para
 
     def _character_entity(self, para):
-        match = re_character_entity.match(para.rest_of_para)
+        match = para.match(flow_patterns['character-entity'])
         if match:
-            self.current_string += re_character_entity.sub(replace_charref, match.group(0))
+            self.current_string += flow_patterns['character-entity'].sub(replace_charref, match.group(0))
             para.advance(len(match.group(0)) - 1)
         else:
             self.current_string += '&'
         return "PARA", para
 
 class Span(ABC):
+    __slots__ = ()
+
     _attribute_serialization_xml = [('conditions', 'conditions'),
                                    ('ID', 'id'),
                                    ('name', 'name'),
@@ -2813,6 +4762,9 @@ class Span(ABC):
                 pass
 
 class Phrase(Span):
+    __slots__ = ('text', 'annotations', 'citations', 'parent', 'position', 'language_code', 'ID', 'name',
+                 'conditions')
+
 
     def __init__(self, text):
         self.text = text
@@ -2825,12 +4777,13 @@ class Phrase(Span):
         self.conditions = []
 
 
+    @serializer
     def regurgitate(self):
         yield u'{{{0:s}}}'.format(escape_for_sam(self.text))
         for x in self.annotations:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         for x in self.citations:
-            yield from x.regurgitate()
+            yield x.regurgitate()
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
 
     @property
@@ -2861,6 +4814,7 @@ class Phrase(Span):
         self.annotations.append(annotation)
 
 
+    @serializer
     def serialize_xml(self):
         yield b'<phrase'
         yield from self._serialize_attributes(self._attribute_serialization_xml)
@@ -2869,13 +4823,14 @@ class Phrase(Span):
         #Nest annotations for serialization
         if self.annotations:
             ann, *rest = self.annotations
-            yield from ann.serialize_xml(rest, escape_for_xml(self.text))
+            yield ann.serialize_xml(rest, escape_for_xml(self.text))
         else:
             yield escape_for_xml(self.text).encode('utf-8')
         for i in self.citations:
-            yield from i.serialize_xml()
+            yield i.serialize_xml()
         yield b'</phrase>'
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield b'<span class="phrase"'
         yield from self._serialize_attributes(self._attribute_serialization_html, duplicate)
@@ -2891,12 +4846,12 @@ class Phrase(Span):
                     link_made = True
                     yield '<a href="#{0}">'.format(cit.reference_parts[0][1]).encode('utf-8')
             else:
-                yield from cit.serialize_html()
+                yield cit.serialize_html()
 
         #Nest annotations for serialization
         if self.annotations:
             ann, *rest = self.annotations
-            yield from ann.serialize_html(rest, escape_for_xml(self.text))
+            yield ann.serialize_html(rest, escape_for_xml(self.text))
         else:
             yield escape_for_xml(self.text).encode('utf-8')
         if link_made:
@@ -2911,6 +4866,8 @@ class Phrase(Span):
     #         self.child.append(thing)
 
 class Code(Phrase):
+    __slots__ = ('code_language', 'encoding')
+
     attribute_serialization_xml = [('encoding', 'encoding'),
                                    ('conditions', 'conditions'),
                                    ('ID', 'id'),
@@ -2951,12 +4908,14 @@ class Code(Phrase):
         except AttributeError:
             pass
 
+    @serializer
     def regurgitate(self):
         yield '`{0}`'.format(escape_for_sam_code(self.text))
         yield from self._regurgitate_attributes(self.attribute_regurgitation)
         for x in self.annotations:
-            yield from x.regurgitate()
+            yield x.regurgitate()
 
+    @serializer
     def serialize_xml(self):
         yield b'<code'
         yield from self._serialize_attributes(self.attribute_serialization_xml)
@@ -2964,6 +4923,7 @@ class Code(Phrase):
         yield escape_for_xml(self.text).encode('utf-8')
         yield b'</code>'
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield b'<code class="code"'
         yield from self._serialize_attributes(self.attribute_serialization_html)
@@ -2975,10 +4935,12 @@ class Code(Phrase):
         raise SAMParserStructureError("Inline code cannot have typed annotations.")
 
 class Embed(Code):
+    __slots__ = ()
 
     def __init__(self, text):
         super().__init__(text)
 
+    @serializer
     def serialize_xml(self):
         yield b'<embed'
         yield from self._serialize_attributes(self.attribute_serialization_xml)
@@ -2986,6 +4948,7 @@ class Embed(Code):
         yield escape_for_xml(self.text).encode('utf-8')
         yield b'</embed>'
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
         yield b'<span class="embed" hidden'
         yield from self._serialize_attributes(self.attribute_serialization_html)
@@ -3011,6 +4974,14 @@ class FlowSource:
     def rest_of_para(self):
         return self.para[self.currentCharNumber:]
 
+    def match(self, pattern):
+        """
+        Matches a pattern at the current position without copying the rest of the paragraph.
+        :param pattern: A compiled regular expression.
+        :return: The match object, or None if the pattern does not match.
+        """
+        return pattern.match(self.para, self.currentCharNumber)
+
     def advance(self, count):
         self.currentCharNumber += count
 
@@ -3019,6 +4990,8 @@ class FlowSource:
 
 
 class Annotation:
+    __slots__ = ('type', 'specifically', 'namespace', 'local', 'cancel', 'child', 'parent')
+
     def __init__(self, type, specifically='', namespace='', local=False, cancel=False):
         self.type = type.strip()
         self.specifically = specifically
@@ -3035,18 +5008,20 @@ class Annotation:
     def __ne__(self, other):
         return [self.type, self.specifically, self.namespace] != [other.type, other.specifically, other.namespace]
 
+    @serializer
     def regurgitate(self):
         yield '({0}'.format(self.type)
         yield (' "{0}"'.format(self.specifically.replace('"','\\"')) if self.specifically else '')
         yield (' ({0})'.format(self.namespace) if self.namespace else '')
         yield ')'
 
+    @serializer
     def serialize_xml(self, annotations=None, payload=None):
         if self.cancel:
             # don't serialize the cancel annotation
             if annotations:
                 anns, *rest = annotations
-                yield from anns.serialize_xml(rest, payload)
+                yield anns.serialize_xml(rest, payload)
             elif payload:
                 yield payload.encode('utf-8')
             else:
@@ -3066,7 +5041,7 @@ class Annotation:
             if annotations:
                 anns, *rest = annotations
                 yield b'>'
-                yield from anns.serialize_xml(rest, payload)
+                yield anns.serialize_xml(rest, payload)
                 yield b'</annotation>'
             elif payload:
                 yield b'>'
@@ -3075,13 +5050,14 @@ class Annotation:
             else:
                 yield b'/>'
 
+    @serializer
     def serialize_html(self, annotations=None, payload=None):
 
         def recurse():
             #Nest annotations for serialization
             if annotations:
                 anns, *rest = annotations
-                yield from anns.serialize_html(rest, payload)
+                yield anns.serialize_html(rest, payload)
             elif payload:
                 yield payload.encode('utf-8')
 
@@ -3120,6 +5096,8 @@ class Annotation:
 
 
 class Citation(Span):
+    __slots__ = ('reference_parts', 'reference_extra', 'local', 'child', 'parent', 'position')
+
     def __init__(self, reference_parts, reference_extra):
         self.reference_parts = reference_parts
         self.reference_extra = None if reference_extra is None else reference_extra.strip()
@@ -3134,6 +5112,7 @@ class Citation(Span):
     def idrefs(self):
         return [x[1] for x in self.reference_parts if x[0] == 'idref']
 
+    @serializer
     def regurgitate(self):
         yield '['
         yield '/'.join(['{0}{1}'.format(citation_reference_symbols[m], v) for m, v in self.reference_parts])
@@ -3141,6 +5120,7 @@ class Citation(Span):
             yield ' {0}'.format(self.reference_extra)
         yield ']'
 
+    @serializer
     def serialize_xml(self):
         has_children= False
         yield b'<citation'
@@ -3176,6 +5156,7 @@ class Citation(Span):
         else:
             yield b'/>'
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
 
         if len(self.reference_parts) == 1:
@@ -3199,9 +5180,12 @@ class Citation(Span):
 
 
 class InlineInsert(Span):
+    __slots__ = ('reference_parts', 'citations', 'parent', 'position', 'namespace', 'ID', 'name', 'conditions',
+                 'language_code')
+
     def __init__(self, reference_parts, attributes={}, citations=[]):
         self.reference_parts = reference_parts
-        self.citations = citations
+        self.citations = citations if citations else []
         self.parent=None
         self.namespace = None
         self.ID = None
@@ -3222,6 +5206,7 @@ class InlineInsert(Span):
     def idrefs(self):
         return [x[1] for x in self.reference_parts if x[0] == 'idref']
 
+    @serializer
     def regurgitate(self):
         if self.reference_parts[0][0] in insert_reference_symbols:
             yield '>('
@@ -3231,6 +5216,7 @@ class InlineInsert(Span):
             yield '>({0} {1})'.format(self.reference_parts[0][0], self.reference_parts[0][1])
         yield from self._regurgitate_attributes(self._attribute_regurgitation)
 
+    @serializer
     def serialize_xml(self):
         attributes = {}
         if len(self.reference_parts) == 1:
@@ -3273,11 +5259,12 @@ class InlineInsert(Span):
         if self.citations:
             yield b'>'
             for c in self.citations:
-                yield from c.serialize_xml()
+                yield c.serialize_xml()
             yield b'</inline-insert>'
         else:
             yield b'/>'
 
+    @serializer
     def serialize_html(self, duplicate=False, variables=[]):
 
         if len(self.reference_parts) == 1:
@@ -3287,14 +5274,14 @@ class InlineInsert(Span):
                 if reference_method == 'variableref':
                     variable_content = get_variable_def(reference_value, self, variables)
                     if variable_content:
-                        yield from variable_content.serialize_html()
+                        yield variable_content.serialize_html()
                     else:
                         SAM_parser_warning('Variable reference "{0}" could not be resolved. '
                                            'It will be omitted from HTML output.'.format(self.item))
                 elif reference_method == 'idref':
                     ob = self.docstructure.object_by_id(reference_value)
                     if ob:
-                        yield from ob.serialize_html(duplicate=True)
+                        yield ob.serialize_html(duplicate=True)
                     else:
                         SAM_parser_warning(
                             'ID reference "{0}" could not be resolved. It will be omitted from HTML output. At: {1}'.format(
@@ -3302,7 +5289,7 @@ class InlineInsert(Span):
                 elif reference_method == 'nameref':
                     ob = self.docstructure.object_by_name(reference_value)
                     if ob:
-                        yield from ob.serialize_html(duplicate=True)
+                        yield ob.serialize_html(duplicate=True)
                     else:
                         SAM_parser_warning(
                             'Name reference "{0}" could not be resolved. It will be omitted from HTML output. At: {1}'.format(
@@ -3330,7 +5317,7 @@ class InlineInsert(Span):
                 if self.citations:
 
                     for cit in self.citations:
-                        yield from cit.serialize_html()
+                        yield cit.serialize_html()
 
                 _, item_extension = os.path.splitext(reference_value)
                 if reference_method in known_insert_types and item_extension.lower() in known_file_types:
@@ -3493,17 +5480,17 @@ def escape_for_sam_code(s):
     except AttributeError:
         return s
 
+# Chained replace() calls escape text much faster than str.translate() with
+# replacements longer than one character, especially long text.
 def escape_for_xml(s):
-    t = dict(zip([ord('<'), ord('>'), ord('&')], ['&lt;', '&gt;', '&amp;']))
     try:
-        return s.translate(t)
+        return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
     except AttributeError:
         return s
 
 def escape_for_xml_attribute(s):
-    t = dict(zip([ord('<'), ord('>'), ord('&'), ord('"')], ['&lt;', '&gt;', '&amp;', '&quot;']))
     try:
-        return s.translate(t)
+        return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
     except AttributeError:
         return s
 
@@ -3515,19 +5502,47 @@ def multi_replace(string, subs):
 
 
 def SAM_parser_warning(warning):
-    print("SAM parser warning: {0}".format(warning), file=sys.stderr)
+    print_message("SAM parser warning: {0}".format(warning))
 
 def SAM_parser_info(info, blank_line = False):
     if blank_line:
-        print('\n', file=sys.stderr)
-    print("SAM parser information: {0}".format(info), file=sys.stderr)
+        print_message('\n')
+    print_message("SAM parser information: {0}".format(info))
+
+_message_recorders = threading.local()
+
+def print_message(message):
+    """
+    Prints a parser message to stderr, and adds it to the messages being
+    recorded in the current thread. The message is only printed if none of
+    the recorders turned printing off.
+    """
+    stack = getattr(_message_recorders, 'stack', ())
+    if all(echo for messages, echo in stack):
+        print(message, file=sys.stderr)
+    for messages, echo in stack:
+        messages.append(message)
+
+@contextlib.contextmanager
+def recorded_messages(echo=True):
+    """
+    Records the messages printed in the current thread, so that a cached
+    parse can print them again or a server can return them.
+    :param echo: Whether the messages are printed to stderr as well.
+    :return: A context manager that gives the list the messages are added to.
+    """
+    stack = _message_recorders.__dict__.setdefault('stack', [])
+    messages = []
+    stack.append((messages, echo))
+    try:
+        yield messages
+    finally:
+        stack.pop()
 
 def SAM_parser_debug(message):
     print("SAM parser debug: {0}".format(message), file=sys.stderr)
 
 
-re_escaped_chars = re.compile('[:\\\(\)\{\}\[\]_\*,\.\*`"&\<\>' + "']", re.U)
-re_character_entity = re.compile(r'&(\#[0-9]+|#[xX][0-9a-fA-F]+|[\w]+);', re.U)
 
 def unescape(string):
     result = ''
@@ -3535,13 +5550,13 @@ def unescape(string):
         e = enumerate(string)
         for pos, char in e:
             try:
-                if char == '\\' and re_escaped_chars.match(string[pos + 1]):
+                if char == '\\' and flow_patterns['escaped-character'].match(string[pos + 1]):
                     result += string[pos + 1]
                     next(e, None)
                 elif char == '&':
-                    match = re_character_entity.match(string[pos:])
+                    match = flow_patterns['character-entity'].match(string, pos)
                     if match:
-                        result += re_character_entity.sub(replace_charref, match.group(0))
+                        result += flow_patterns['character-entity'].sub(replace_charref, match.group(0))
                         for i in range(1, len(match.group(0))):
                             next(e, None)
                     else:
@@ -3559,11 +5574,34 @@ def replace_charref(match):
         charref = match.group(0)
     except AttributeError:
         charref = match
+    import html
     character = html.unescape(charref)
     if character == charref:  # Escape not recognized
         raise SAMParserStructureError("Unrecognized character entity found: {0}".format(charref))
     return character
 
+def sibling_position(node):
+    """
+    Get the position of a node among the children of its parent.
+
+    Nodes record their position when they are added to their parent, so this
+    does not need to search the parent's children. If the children have been
+    changed by other means since, the node is searched for and its position
+    recorded again.
+    :param node: A block, flow, or span that has a parent.
+    :return: The index of the node in the children of its parent.
+    """
+    siblings = node.parent.children
+    position = getattr(node, 'position', None)
+    if position is None or position >= len(siblings) or siblings[position] is not node:
+        for position, x in enumerate(siblings):
+            if x is node:
+                break
+        else:
+            raise ValueError("Node is not among the children of its parent.")
+        node.position = position
+    return position
+
 def get_variable_def(name, context, before_variables=[], after_variables=[]):
     """
     Get a variable definition with a given name.
@@ -3573,8 +5611,8 @@ def get_variable_def(name, context, before_variables=[], after_variables=[]):
         for x in before_variables:
             if x.block_type == name:
                 return x.content
-    if context.parent and type(context.parent) is not DocStructure:
-        starting_point = context.parent.children.index(context)
+    if context.parent and not isinstance(context.parent, DocStructure):
+        starting_point = sibling_position(context)
         for x in reversed(context.parent.children[:starting_point]):
             if type(x) is VariableDef and x.block_type == name:
                 return x.content
@@ -3586,192 +5624,772 @@ def get_variable_def(name, context, before_variables=[], after_variables=[]):
     return None
 
 
-if __name__ == "__main__":
+# The following functions implement the command line tool. They are defined at
+# the module level so that the worker processes of the -jobs option can run them.
 
-    import glob
-    import os.path
+def get_input_list(args):
+    inputfiles=glob.glob(args.infile)
+    if not inputfiles:
+        raise SAMParserError("No input file(s) found.")
+    return inputfiles
 
-    transformed = None
-    parser_error_count = 0
-    xsd_error_count = 0
-    xslt_error_count = 0
-    samParser = SamParser()
+def get_output_file(args, input_file, default_output_extension):
+    """
+    Calculates the name of the output file using the input file name
+    and the output file extension.
 
-    def get_input_list():
-        inputfiles=glob.glob(args.infile)
-        if not inputfiles:
-            raise SAMParserError("No input file(s) found.")
-        return inputfiles
+    The output directory name is read from the arguments.
 
-    def write_output(input_file, default_output_extension, source_func, mode="binary"):
-        """
-        Calculates the name of the output file using the input file name
-        and the output file extension, then writes the output file by
-        calling the output generating function passed to it.
+    :param args: The command line arguments.
+    :param input_file: The name of the input file.
+    :param default_output_extension: The extension to be used on the output file unless overridden on the command line.
+    :return: The name of the output file, or None if output goes to stdout.
+    """
+    if not args.outputextension:
+        output_extension = default_output_extension
+    else:
+        if args.outputextension[0] == '.':
+            output_extension = args.outputextension
+        else:
+            output_extension = '.' + args.outputextension
 
-        The output directory name is read from the arguments.
+    if args.outdir:
+        output_file = os.path.join(args.outdir,
+                                  os.path.splitext(
+                                      os.path.basename(input_file))[0] + output_extension)
+    else:
+        output_file = args.outfile
+    return output_file
 
-        :param input_file: The name of the input file.
-        :param default_output_extension: The extension to be used on the output file unless overridden on the command line.
-        :param source_func: The output function to call.
-        :return: The name of the output file (in case the caller needs to read it).
-        """
-        if not args.outputextension:
-            output_extension = default_output_extension
+def get_transformed_file(args, input_file):
+    """
+    Calculates the name of the file the output transformed using -xslt is written to.
+    :param args: The command line arguments.
+    :param input_file: The name of the input file.
+    :return: The name of the transformed output file, or None if none is named.
+    """
+    if args.transformedoutputdir:
+        return os.path.join(args.transformedoutputdir, os.path.splitext(
+            os.path.basename(input_file))[0] + args.transformedextension)
+    return args.transformedoutputfile
+
+def write_output(args, input_file, default_output_extension, source_func, mode="binary"):
+    """
+    Writes the output file by calling the output generating function passed to it.
+
+    :param args: The command line arguments.
+    :param input_file: The name of the input file.
+    :param default_output_extension: The extension to be used on the output file unless overridden on the command line.
+    :param source_func: The output function to call. It must return a Serialization.
+    :return: The name of the output file (in case the caller needs to read it).
+    """
+    output_file = get_output_file(args, input_file, default_output_extension)
+
+    if mode=="binary":
+        if output_file:
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with open(output_file, "wb") as outf:
+                source_func().write_to(outf)
         else:
-            if args.outputextension[0] == '.':
-                output_extension = args.outputextension
-            else:
-                output_extension = '.' + args.outputextension
+            source_func().write_to(sys.stdout.buffer)
+    else:
+        if output_file:
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with open(output_file, "wt", encoding="utf-8") as outf:
+                source_func().write_to(outf)
+        else:
+            source_func().write_to(sys.stdout)
 
-        if args.outdir:
-            output_file = os.path.join(args.outdir,
-                                      os.path.splitext(
-                                          os.path.basename(input_file))[0] + output_extension)
+    return output_file
+
+def stream_output(args, samParser, inputfile, default_output_extension, method, **kwargs):
+    """
+    Writes the XML or HTML output of an input file while the file is parsed,
+    for the -stream option, and reports the peak memory use of the process.
+    :param args: The command line arguments.
+    :param samParser: The SamParser to parse the file with.
+    :param inputfile: The name of the input file.
+    :param default_output_extension: The extension to be used on the output file unless overridden on the command line.
+    :param method: 'xml' or 'html'.
+    :param kwargs: Further arguments to serialize_events().
+    :return: The name of the output file.
+    """
+    output_file = get_output_file(args, inputfile, default_output_extension)
+    with open(inputfile, "rb") as inf:
+        SAM_parser_info("Parsing " + os.path.abspath(inf.name), blank_line=True)
+        serialization = serialize_events(samParser.events(inf), method, **kwargs)
+        if output_file:
+            # Write the output under a temporary name first, so that a document
+            # that fails part way through leaves no partial output behind.
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            import tempfile
+            f = tempfile.NamedTemporaryFile(dir=os.path.dirname(output_file), suffix='.tmp', delete=False)
+            try:
+                with f:
+                    serialization.write_to(f)
+                os.replace(f.name, output_file)
+            except BaseException:
+                os.remove(f.name)
+                raise
         else:
-            output_file = args.outfile
+            serialization.write_to(sys.stdout.buffer)
+    peak = peak_memory()
+    if peak is not None:
+        SAM_parser_info("Peak memory use: {0:.1f} MB".format(peak / 2 ** 20))
+    return output_file
+
+def peak_memory():
+    """
+    Gets the peak resident set size of the process.
+    :return: The size in bytes, or None where the resource module is not available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports the size in bytes, other systems in kilobytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def print_xslt_messages(error_log):
+    for entry in error_log:
+        print('message from line %s, col %s: %s' % (
+            entry.line, entry.column, entry.message), file=sys.stderr)
+        print('domain: %s (%d)' % (entry.domain_name, entry.domain), file=sys.stderr)
+        print('type: %s (%d)' % (entry.type_name, entry.type), file=sys.stderr)
+        print('level: %s (%d)' % (entry.level_name, entry.level), file=sys.stderr)
+
+def xml_output(args, inputfile):
+    """
+    Processes one input file for the xml subcommand.
+    :param args: The command line arguments.
+    :param inputfile: The name of the input file.
+    :return: The numbers of SAM parser, XSD schema, and XSLT errors, and the
+    IncludeCache stamps of the files the input file includes.
+    """
+    parser_error_count = 0
+    xsd_error_count = 0
+    xslt_error_count = 0
+    samParser = new_parser(args)
+    if args.expandrelativepaths:
+        samParser.expand_relative_paths = True
 
-        if mode=="binary":
-            if output_file:
-                os.makedirs(os.path.dirname(output_file), exist_ok=True)
-                with open(output_file, "wb") as outf:
-                    for i in source_func():
-                        outf.write(i)
+    try:
+        if args.stream:
+            if args.xsd or args.xslt:
+                raise SAMParserError("The -stream option cannot be used with -xsd or -xslt, "
+                                     "which need the whole document.")
+            stream_output(args, samParser, inputfile, '.xml', 'xml')
+        else:
+            samParser.parse_file(inputfile)
+        if args.xsd or args.xslt:
+            # Build the tree for validation and transformation while writing
+            # the XML output to the output file, or to stdout if none is named.
+            outputfile = get_output_file(args, inputfile, '.xml')
+            if samParser.doc.expand_relative_paths:
+                url = None
             else:
-                for i in source_func():
-                    sys.stdout.buffer.write(i.decode("utf-8"))
-        else:
-            if output_file:
-                os.makedirs(os.path.dirname(output_file), exist_ok=True)
-                with open(output_file, "wt", encoding="utf-8") as outf:
-                    for i in source_func():
-                        outf.write(i)
+                # Relative paths in the tree are resolved from the output file if
+                # there is one, or else from the source file.
+                url = outputfile if outputfile else inputfile
+            if outputfile:
+                os.makedirs(os.path.dirname(outputfile), exist_ok=True)
+                with open(outputfile, "wb") as outf:
+                    samParser.doc.build_etree(outf, url)
             else:
-                for i in source_func():
-                    sys.stdout.buffer.write(i)
+                samParser.doc.build_etree(sys.stdout.buffer, url)
+            # The output the messages about validation and transformation refer to
+            output_name = outputfile if outputfile else '<stdout>'
+        elif not args.stream:
+            outputfile = write_output(args, inputfile, '.xml', samParser.doc.serialize_xml)
+
+        if args.xsd:
+            SAM_parser_info("Validating XML output using " + args.xsd)
+            with xsd_cache.checkout(args.xsd) as xmlschema:
+                try:
+                    xmlschema.assertValid(samParser.doc.etree)
+                except etree.DocumentInvalid as e:
+                    print('XSD SCHEMA ERROR {0} in {1}'.format(str(e), output_name), file=sys.stderr)
+                    xsd_error_count += 1
+                else:
+                    SAM_parser_info("Validation successful.")
 
-        return output_file
+        if args.xslt:
+            if not (args.transformedoutputfile or args.transformedoutputdir):
+                raise SAMParserError(
+                    "A transformed output file or directory must be specified if an XSLT file is specified.")
 
+            transformedfile = get_transformed_file(args, inputfile)
+            try:
+                with xslt_cache.checkout(args.xslt) as transformer:
+                    try:
+                        # The tree has the URL of the output file, so any local paths
+                        # that have not been expanded resolve as they would from disk.
+                        transformed = transformer(samParser.doc.etree)
+                    except etree.XSLTError as e:
+                        print('XSLT TRANSFORMER ERROR {0} in {1}'.format(str(e), output_name), file=sys.stderr)
+                        if transformer.error_log:
+                            SAM_parser_warning("Messages from the XSLT transformation of {0}:".format(output_name))
+                            print_xslt_messages(transformer.error_log)
+                        raise SAMXSLTError(e)
+                    # For XSLT warnings that don't cause an exception
+                    if transformer.error_log:
+                        SAM_parser_warning("Messages from the XSLT transformation:")
+                        print_xslt_messages(transformer.error_log)
+                    if transformedfile:
+                        with open(transformedfile, "wb") as tf:
+                            tf.write(str(transformed).encode(encoding='utf-8'))
 
-    def xml_output():
-        global xsd_error_count, parser_error_count, xslt_error_count
+            except FileNotFoundError as e:
+                raise SAMParserError(e.strerror + ' ' + e.filename)
 
-        for inputfile in get_input_list():
 
-            try:
-                samParser.parse_file(inputfile)
-                outputfile = write_output(inputfile, '.xml', samParser.doc.serialize_xml)
+    except SAMParserError as e:
+        sys.stderr.write('SAM parser ERROR: ' + str(e) + "\n")
+        parser_error_count += 1
 
-                if args.xsd:
-                    SAM_parser_info("Validating XML output using " + args.xsd)
-                    xmlschema = etree.XMLSchema(file=args.xsd)
-                    try:
-                        xmlschema.assertValid(samParser.doc.etree)
-                    except etree.DocumentInvalid as e:
-                        print('XSD SCHEMA ERROR {0} in {1}'.format(str(e), outputfile), file=sys.stderr)
-                        xsd_error_count += 1
-                    else:
-                        SAM_parser_info("Validation successful.")
+    except SAMXSLTError as e:
+        sys.stderr.write('XSLT ERROR: ' + str(e) + "\n")
+        xslt_error_count += 1
 
-                if args.xslt:
-                    if not (args.transformedoutputfile or args.transformedoutputdir):
-                        raise SAMParserError(
-                            "A transformed output file or directory must be specified if an XSLT file is specified.")
+    return parser_error_count, xsd_error_count, xslt_error_count, samParser.includes
 
-                    if args.transformedoutputdir:
-                        transformedfile = os.path.join(args.transformedoutputdir, os.path.splitext(
-                            os.path.basename(inputfile))[0] + args.transformedextension)
-                    else:
-                        transformedfile = args.transformedoutputfile
-                    try:
-                        transformer = etree.XSLT(etree.parse(args.xslt))
-                        try:
-                            if samParser.doc.expand_relative_paths:
-                                # We can use the internal tree because all paths have been expanded.
-                                transformed = transformer(samParser.doc.etree)
-                            else: # May be local paths so have to parse from disk.
-                                transformed = transformer(etree.parse(outputfile))
-                        except etree.XSLTError as e:
-                            print('XSLT TRANSFORMER ERROR {0} in {1}'.format(str(e), outputfile), file=sys.stderr)
-                            if transformer.error_log:
-                                SAM_parser_warning("Messages from the XSLT transformation of {0}:".format(outputfile))
-                                for entry in transformer.error_log:
-                                    print('message from line %s, col %s: %s' % (
-                                        entry.line, entry.column, entry.message), file=sys.stderr)
-                                    print('domain: %s (%d)' % (entry.domain_name, entry.domain), file=sys.stderr)
-                                    print('type: %s (%d)' % (entry.type_name, entry.type), file=sys.stderr)
-                                    print('level: %s (%d)' % (entry.level_name, entry.level), file=sys.stderr)
-                            raise SAMXSLTError(e)
-                        # For XSLT warnings that don't cause an exception
-                        if transformer.error_log:
-                            SAM_parser_warning("Messages from the XSLT transformation:")
-                            for entry in transformer.error_log:
-                                print('message from line %s, col %s: %s' % (
-                                    entry.line, entry.column, entry.message), file=sys.stderr)
-                                print('domain: %s (%d)' % (entry.domain_name, entry.domain), file=sys.stderr)
-                                print('type: %s (%d)' % (entry.type_name, entry.type), file=sys.stderr)
-                                print('level: %s (%d)' % (entry.level_name, entry.level), file=sys.stderr)
-                        if transformedfile:
-                            with open(transformedfile, "wb") as tf:
-                                tf.write(str(transformed).encode(encoding='utf-8'))
-
-                    except FileNotFoundError as e:
-                        raise SAMParserError(e.strerror + ' ' + e.filename)
-
-
-            except SAMParserError as e:
-                sys.stderr.write('SAM parser ERROR: ' + str(e) + "\n")
-                parser_error_count += 1
-                continue
+def html_output(args, inputfile):
+    """
+    Processes one input file for the html subcommand.
+    :param args: The command line arguments.
+    :param inputfile: The name of the input file.
+    :return: The numbers of SAM parser, XSD schema, and XSLT errors, and the
+    IncludeCache stamps of the files the input file includes.
+    """
+    samParser = new_parser(args)
+    try:
+        if args.stream:
+            stream_output(args, samParser, inputfile, '.html', 'html', css=args.css, javascript=args.javascript)
+        else:
+            samParser.parse_file(inputfile)
+            samParser.doc.css = args.css
+            samParser.doc.javascript = args.javascript
+            write_output(args, inputfile, '.html', samParser.doc.serialize_html)
+    except SAMParserError as e:
+        sys.stderr.write('SAM parser ERROR: ' + str(e) + "\n")
+        return 1, 0, 0, samParser.includes
+    return 0, 0, 0, samParser.includes
+
+def regurgitate_output(args, inputfile):
+    """
+    Processes one input file for the regurgitate subcommand.
+    :param args: The command line arguments.
+    :param inputfile: The name of the input file.
+    :return: The numbers of SAM parser, XSD schema, and XSLT errors, and the
+    IncludeCache stamps of the files the input file includes.
+    """
+    samParser = new_parser(args)
+    try:
+        samParser.parse_file(inputfile)
+        write_output(args, inputfile, '.sam', samParser.doc.regurgitate, mode='text')
+    except SAMParserError as e:
+        sys.stderr.write('SAM parser ERROR: ' + str(e) + "\n")
+        return 1, 0, 0, samParser.includes
+    return 0, 0, 0, samParser.includes
+
+def load_smart_quotes(filename):
+    """
+    Reads the smart quote substitution sets in a smart quotes file.
+    :param filename: The name of the smart quotes file.
+    :return: A dictionary of the substitution sets, by name, that can be
+    passed to a ParseContext.
+    """
+    smart_quote_sets = {}
+    with open(filename, encoding="utf8") as sqf:
+        try:
+            substitution_sets = etree.parse(sqf)
+        except etree.XMLSyntaxError as e:
+            raise SAMParserError("Smart quotes file {0} contains XML error {1}: " + str(e))
+
+        for x in substitution_sets.iterfind(".//subset"):
+            subs = {}
+            for y in x.iterfind("sub"):
+                r = re.compile(y.find("pattern").text)
+                subs.update({r: y.find("replace").text})
+            smart_quote_sets.update({x.find("name").text: subs})
+    return smart_quote_sets
+
+def new_parser(args):
+    """
+    Creates a SAM parser for one input file, using the smart quote sets
+    loaded from the file named on the command line, the shared include cache,
+    and the parse cache if one is named.
+    :param args: The command line arguments.
+    """
+    return SamParser(ParseContext(args.smart_quote_sets, include_cache, parse_cache=args.parse_cache))
 
-            except SAMXSLTError as e:
-                sys.stderr.write('XSLT ERROR: ' + str(e) + "\n")
-                xslt_error_count += 1
-                continue
+def run_job(args, inputfile):
+    """
+    Processes one input file in a worker process of the -jobs option. The
+    output written to stdout and stderr is captured and returned, so that the
+    main process can write the output for each file in one piece.
+    :param args: The command line arguments.
+    :param inputfile: The name of the input file.
+    :return: The result of the subcommand function, the bytes written to
+    stdout, the text written to stderr, and whether processing stopped on an
+    unexpected exception.
+    """
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8", write_through=True)
+    stderr = io.StringIO()
+    failed = False
+    result = (0, 0, 0, {})
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            result = process_file(args, inputfile)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            failed = True
+    return result, stdout.buffer.getvalue(), stderr.getvalue(), failed
+
+def run_jobs(args, inputfiles):
+    """
+    Processes input files in a pool of worker processes, largest files first.
+    :param args: The command line arguments.
+    :param inputfiles: The names of the input files.
+    :return: The result of the subcommand function for each input file.
+    """
+    import concurrent.futures
+    results = {}
+    inputfiles = sorted(inputfiles, key=os.path.getsize, reverse=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(run_job, args, inputfile): inputfile for inputfile in inputfiles}
+        for future in concurrent.futures.as_completed(futures):
+            result, output, messages, failed = future.result()
+            sys.stdout.flush()
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            sys.stderr.write(messages)
+            sys.stderr.flush()
+            if failed:
+                # A serial run stops on an unexpected exception, with exit code 1.
+                executor.shutdown(cancel_futures=True)
+                sys.exit(1)
+            results[futures[future]] = result
+    return results
+
+manifest_name = '.sam-manifest.json'
+
+def get_manifest_file(args):
+    """
+    Gets the name of the manifest used by the -incremental option, which is
+    kept in the output directory or next to the output file.
+    :param args: The command line arguments.
+    """
+    if args.outdir:
+        return os.path.join(args.outdir, manifest_name)
+    if args.outfile:
+        return os.path.join(os.path.dirname(os.path.abspath(args.outfile)), manifest_name)
+    raise SAMParserError("The -incremental option needs an output file or directory.")
 
+def file_stamp(filename):
+    """
+    Gets the modification time and size of a file as a list, the form it
+    takes in the manifest, or None if the file does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
 
-    def html_output():
-        global parser_error_count
-        for inputfile in get_input_list():
-            try:
-                samParser = SamParser()
-                samParser.parse_file(inputfile)
-                samParser.doc.css = args.css
-                samParser.doc.javascript = args.javascript
-                write_output(inputfile, '.html', samParser.doc.serialize_html)
-            except SAMParserError as e:
-                sys.stderr.write('SAM parser ERROR: ' + str(e) + "\n")
-                parser_error_count += 1
-                continue
+def get_run_signature(args):
+    """
+    Works out a signature of everything besides the input file and its
+    includes that the output of a run depends on: the subcommand and its
+    options, the files named by the options, and the version of the parser.
+    :param args: The command line arguments.
+    :return: The signature, as a string of hexadecimal digits.
+    """
+    ignored = ('infile', 'func', 'jobs', 'incremental', 'cache', 'parse_cache', 'smart_quote_sets', 'stream')
+    options = {name: value for name, value in vars(args).items() if name not in ignored}
+    options['subcommand'] = args.func.__name__
+    options['parser'] = parser_version()
+    for name in ('xslt', 'xsd', 'smartquotes'):
+        if getattr(args, name, None):
+            options[name + ' stamp'] = file_stamp(getattr(args, name))
+    import hashlib
+    import json
+    return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def get_output_files(args, inputfile):
+    """
+    Lists the files the processing of an input file writes.
+    """
+    extensions = {xml_output: '.xml', html_output: '.html', regurgitate_output: '.sam'}
+    result = [get_output_file(args, inputfile, extensions[args.func])]
+    if getattr(args, 'xslt', None):
+        result.append(get_transformed_file(args, inputfile))
+    return [os.path.abspath(x) for x in result if x]
 
+def load_manifest(manifest_file):
+    """
+    Reads the manifest of an earlier run.
+    :return: The entry for each input file processed without errors, by absolute path.
+    """
+    import json
+    try:
+        with open(manifest_file, encoding='utf-8') as f:
+            return json.load(f)['files']
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
 
-    def regurgitate_output():
-        global parser_error_count
-        for inputfile in get_input_list():
+def manifest_stamp(stamp):
+    """
+    Gets an IncludeCache stamp in the form it takes in the manifest, where the
+    modification time and size of a local file are a list, as JSON reads them.
+    """
+    return list(stamp) if isinstance(stamp, tuple) else stamp
+
+def is_up_to_date(entry, signature):
+    """
+    Determines if the outputs of an input file are up to date, going by its
+    manifest entry: that the run signature and the stamps of the input file
+    and all its includes are unchanged and that all its outputs exist.
+    """
+    return (entry['signature'] == signature
+            and file_stamp(entry['source']) == entry['stamp']
+            and all(manifest_stamp(IncludeCache.stamp(url)) == stamp for url, stamp in entry['includes'].items())
+            and all(os.path.exists(x) for x in entry['outputs']))
+
+def save_manifest(manifest_file, files):
+    """
+    Writes the manifest, replacing the old one in one step.
+    :param files: The entry for each input file processed without errors, by absolute path.
+    """
+    import json
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    temporary_file = manifest_file + '.tmp'
+    with open(temporary_file, 'w', encoding='utf-8') as f:
+        json.dump({'files': files}, f, indent=1, sort_keys=True)
+    os.replace(temporary_file, manifest_file)
+
+def watch_input_files(args):
+    """
+    Processes the input files, then processes each of them again whenever it
+    or a file it includes changes, until interrupted. The parser stays loaded
+    between builds, so compiled XSLT stylesheets and XML schemas and the
+    parsed include files that have not changed are reused. All the files are
+    processed again if the XSLT, XSD or smart quotes file changes. Changes are
+    found by polling, since the standard library has no portable way to be
+    notified of them. Included files that are not local are polled once every
+    -remote-interval seconds.
+    :param args: The command line arguments.
+    """
+    # The stamp of each input file and the stamps of the files it includes
+    watched = {}
+    option_files = [getattr(args, name) for name in ('xslt', 'xsd', 'smartquotes') if getattr(args, name, None)]
+    option_stamps = {x: file_stamp(x) for x in option_files}
+    # The stamp of each remote include and when it was taken. Checking a
+    # remote include takes a request to its server, and a download unless the
+    # server supports conditional requests, so it is done once every
+    # remote_interval seconds rather than on every poll.
+    remote_stamps = {}
+    first = True
+    while True:
+        include_stamps = {}
+        def include_stamp(url):
+            if url not in include_stamps:
+                if urlparse(url).scheme == 'file':
+                    include_stamps[url] = IncludeCache.stamp(url)
+                else:
+                    if url not in remote_stamps or time.monotonic() - remote_stamps[url][1] >= args.remote_interval:
+                        remote_stamps[url] = (IncludeCache.stamp(url), time.monotonic())
+                    include_stamps[url] = remote_stamps[url][0]
+            return include_stamps[url]
+
+        changed_options = [x for x in option_files if file_stamp(x) != option_stamps[x]]
+        if changed_options:
+            option_stamps = {x: file_stamp(x) for x in option_files}
+            if args.smartquotes:
+                if option_stamps[args.smartquotes]:
+                    args.smart_quote_sets = load_smart_quotes(args.smartquotes)
+                else:
+                    SAM_parser_warning("Smart quotes file {0} was deleted. Using the sets loaded "
+                                       "before.".format(args.smartquotes))
+
+        # Work out which input files need to be processed, and when the
+        # change that affects each one was saved.
+        inputfiles = glob.glob(args.infile)
+        changes = {}
+        for inputfile in inputfiles:
+            stamp = file_stamp(inputfile)
+            entry = watched.get(inputfile)
+            if entry is None or stamp != entry[0]:
+                changes[inputfile] = stamp[0] if stamp else time.time_ns()
+            elif changed_options:
+                # A deleted file has no modification time.
+                changes[inputfile] = max((option_stamps[x][0] for x in changed_options if option_stamps[x]),
+                                         default=time.time_ns())
+            else:
+                changed_includes = [url for url, old_stamp in entry[1].items() if include_stamp(url) != old_stamp]
+                if changed_includes:
+                    # Only local files have a modification time.
+                    changes[inputfile] = max(include_stamp(url)[0] if isinstance(include_stamp(url), tuple)
+                                             else time.time_ns() for url in changed_includes)
+        for inputfile in list(watched):
+            if inputfile not in inputfiles:
+                del watched[inputfile]
+
+        error_count = 0
+        for inputfile, changed_at in sorted(changes.items()):
+            stamp = file_stamp(inputfile)
+            start = time.perf_counter()
             try:
-                samParser = SamParser()
-                samParser.parse_file(inputfile)
-                write_output(inputfile, '.sam', samParser.doc.regurgitate, mode='text')
-            except SAMParserError as e:
-                sys.stderr.write('SAM parser ERROR: ' + str(e) + "\n")
-                parser_error_count += 1
-                continue
+                result = process_file(args, inputfile)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                error_count += 1
+                # Keep the includes found last time, so that a fix to one of them is picked up.
+                includes = watched[inputfile][1] if inputfile in watched else {}
+            else:
+                error_count += sum(result[:3])
+                includes = result[3]
+                # The stamps the parse took are the latest for the remote includes.
+                for url, include in includes.items():
+                    if urlparse(url).scheme != 'file':
+                        remote_stamps[url] = (include, time.monotonic())
+            watched[inputfile] = (stamp, includes)
+            if not first:
+                SAM_parser_info("Processed {0} in {1:.3f}s, {2:.3f}s after the change was saved.".format(
+                    inputfile, time.perf_counter() - start, time.time() - changed_at / 1e9))
+        if changes or first:
+            print("Processing completed with {0} errors. Watching {1} files for changes.".format(
+                error_count, len(watched)), file=sys.stderr)
+            sys.stderr.flush()
+        first = False
+        time.sleep(args.interval)
+
+class ParseServerMixin:
+    """
+    The request processing of the parse server, shared by the Unix socket and
+    TCP versions. Requests run in threads of their own, but only as many are
+    processed at once as there are parsers in the pool. The others wait for a
+    parser to be returned.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def setup_parsers(self, workers, smart_quote_sets=None, parse_cache=None):
+        import queue
+        self.parsers = queue.Queue()
+        for i in range(workers):
+            self.parsers.put(SamParser(ParseContext(smart_quote_sets, include_cache, parse_cache=parse_cache)))
+
+    def process(self, request):
+        output_format = request.get('format', 'xml')
+        if output_format not in ('xml', 'html', 'regurgitate', 'diagnostics'):
+            raise ValueError('Unknown format ' + str(output_format))
+        output = None
+        errors = 0
+        includes = {}
+        parser = self.parsers.get()
+        try:
+            with recorded_messages(echo=False) as messages:
+                try:
+                    if 'path' in request:
+                        parser.parse_file(request['path'])
+                    else:
+                        parser.parse(io.StringIO(request['source']), request.get('url'))
+                    doc = parser.doc
+                    if output_format == 'xml':
+                        output = b''.join(doc.serialize_xml()).decode('utf-8')
+                    elif output_format == 'html':
+                        doc.css = request.get('css')
+                        doc.javascript = request.get('javascript')
+                        output = b''.join(doc.serialize_html()).decode('utf-8')
+                    elif output_format == 'regurgitate':
+                        output = ''.join(doc.regurgitate())
+                except SAMParserError as e:
+                    print_message('SAM parser ERROR: ' + str(e))
+                    errors += 1
+                includes = parser.includes
+        finally:
+            # A smart quotes declaration only applies to the document it is in.
+            parser.flow_parser.smart_quotes = 'off'
+            parser.doc = None
+            self.parsers.put(parser)
+        return {'output': output, 'errors': errors, 'messages': ''.join(x + '\n' for x in messages),
+                'includes': includes}
 
-    # Main parser
-    argparser = argparse.ArgumentParser()
-    subparsers = argparser.add_subparsers(title="subcommands")
 
-    # I/O parser
-    io_parser = argparse.ArgumentParser(add_help=False)
-    io_parser.add_argument("infile", help="the SAM file to be parsed")
-    io_parser.add_argument("-smartquotes", "-sq",
-                           help="the path to a file containing smartquote patterns and substitutions")
-    io_parser.add_argument("-expandrelativepaths", '-xrp', action="store_true", help="expand relative paths on serialization")
-    outputgroup = io_parser.add_mutually_exclusive_group()
-    outputgroup.add_argument("-outfile", "-o", help="the name of the output file")
-    outputgroup.add_argument("-outdir", "-od", help="the name of output directory")
-    io_parser.add_argument("-outputextension", "-oext", nargs='?')
+@functools.lru_cache(maxsize=None)
+def parse_server_classes():
+    """
+    Makes the classes of the parse server, which are made the first time they
+    are needed so that only the runs that use the server import socketserver.
+    The classes are also attributes of the module.
+    :return: The request handler class and the Unix socket and TCP server classes.
+    """
+    import socketserver
 
+    class ParseRequestHandler(socketserver.StreamRequestHandler):
+        """
+        Handles a connection to the parse server. Each request is a JSON object on
+        a line of its own, and each response is written back the same way. A
+        request has these members:
+
+        * format: "xml", "html", "regurgitate" or "diagnostics", which parses the
+          document and returns only the messages.
+        * path: The name of a SAM file to parse, or
+        * source: The SAM source to parse, with
+        * url: The URL that relative includes in the source are resolved against (optional).
+        * css, javascript: Lists of stylesheets and scripts for HTML output (optional).
+
+        A response has the members output (the output as a string, or null if
+        there are errors or only diagnostics were asked for), errors (the number
+        of errors), messages (the parser's messages) and includes (the
+        IncludeCache stamps of the files the document includes, by URL).
+        """
+        def handle(self):
+            import json
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    response = self.server.process(request)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    response = {'output': None, 'errors': 1, 'messages': 'Bad request: {0}\n'.format(e),
+                                'includes': {}}
+                except Exception:
+                    # Report an unexpected exception to the client as well, rather
+                    # than leaving it without a response.
+                    import traceback
+                    traceback.print_exc()
+                    response = {'output': None, 'errors': 1, 'messages': traceback.format_exc(), 'includes': {}}
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+    class UnixParseServer(ParseServerMixin, socketserver.ThreadingUnixStreamServer):
+        pass
+
+    class TCPParseServer(ParseServerMixin, socketserver.ThreadingTCPServer):
+        pass
+
+    return ParseRequestHandler, UnixParseServer, TCPParseServer
+
+parse_server_class_names = ('ParseRequestHandler', 'UnixParseServer', 'TCPParseServer')
+
+def __getattr__(name):
+    """
+    Gets the parse server classes, which are not made when the module is imported.
+    """
+    if name in parse_server_class_names:
+        return parse_server_classes()[parse_server_class_names.index(name)]
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def parse_server_address(address):
+    """
+    Works out the address of a parse server from the way it is given on the
+    command line: a port number or host:port for TCP, or else the path of a
+    Unix domain socket.
+    :return: The address, a (host, port) tuple or a path, and the socket family.
+    """
+    import socket
+    host, sep, port = address.rpartition(':')
+    if port.isdigit():
+        return (host or 'localhost', int(port)), socket.AF_INET
+    return address, socket.AF_UNIX
+
+def serve_requests(args):
+    """
+    Runs the parse server until interrupted.
+    :param args: The command line arguments of the serve subcommand.
+    """
+    import socket
+    ParseRequestHandler, UnixParseServer, TCPParseServer = parse_server_classes()
+    address, family = parse_server_address(args.address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixParseServer(address, ParseRequestHandler)
+    else:
+        server = TCPParseServer(address, ParseRequestHandler)
+    server.setup_parsers(args.workers, args.smart_quote_sets, args.parse_cache)
+    with server:
+        print("Serving on {0} with {1} parsers.".format(args.address, args.workers), file=sys.stderr)
+        sys.stderr.flush()
+        try:
+            server.serve_forever()
+        finally:
+            if family == socket.AF_UNIX:
+                os.remove(address)
+
+def request_parse(address, request):
+    """
+    Sends a request to a parse server.
+    :param address: The address of the server, as given on the command line.
+    :param request: The request, as described for ParseRequestHandler.
+    :return: The response.
+    """
+    import socket
+    import json
+    address, family = parse_server_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(request).encode('utf-8') + b'\n')
+            f.flush()
+            return json.loads(f.readline())
+
+def server_output(args, inputfile):
+    """
+    Processes one input file by sending it to the parse server named by the
+    -server option, and writes the output the server returns.
+    :param args: The command line arguments.
+    :param inputfile: The name of the input file.
+    :return: The numbers of SAM parser, XSD schema, and XSLT errors, and the
+    IncludeCache stamps of the files the input file includes.
+    """
+    output_format, extension, mode = {xml_output: ('xml', '.xml', 'binary'),
+                                      html_output: ('html', '.html', 'binary'),
+                                      regurgitate_output: ('regurgitate', '.sam', 'text')}[args.func]
+    request = {'format': output_format, 'path': os.path.abspath(inputfile)}
+    if output_format == 'html':
+        request.update(css=args.css, javascript=args.javascript)
+    try:
+        response = request_parse(args.server, request)
+    except OSError as e:
+        sys.stderr.write('SAM parser ERROR: Cannot connect to the parse server at {0}: {1}\n'.format(
+            args.server, e.strerror or e))
+        return 1, 0, 0, {}
+    sys.stderr.write(response['messages'])
+    if response['output'] is not None:
+        output = response['output'].encode('utf-8') if mode == 'binary' else response['output']
+        write_output(args, inputfile, extension, lambda: Serialization(iter([output])), mode)
+    # JSON turns the modification time and size of a local file into a list.
+    includes = {url: tuple(stamp) if isinstance(stamp, list) else stamp
+                for url, stamp in response['includes'].items()}
+    return response['errors'], 0, 0, includes
+
+def process_file(args, inputfile):
+    """
+    Processes one input file with the function of the subcommand, or sends it
+    to the parse server if the -server option is used.
+    :param args: The command line arguments.
+    :param inputfile: The name of the input file.
+    :return: What the subcommand function returns.
+    """
+    if args.server:
+        return server_output(args, inputfile)
+    return args.func(args, inputfile)
+
+def add_output_subcommands(subparsers, io_parser):
+    """
+    Adds the xml, html and regurgitate subcommands to the command line parser,
+    or to the watch subcommand.
+    :param subparsers: The subparsers object to add them to.
+    :param io_parser: The parser of the options all the subcommands share.
+    """
+    stream_help = ("write the output of each block in the root block as soon as it has been parsed, "
+                   "so that large documents are not held in memory as a whole")
 
     # XML sub
     xml_parser = subparsers.add_parser("xml", parents=[io_parser])
@@ -3783,6 +6401,7 @@ if __name__ == "__main__":
     transform_output_group.add_argument("-transformedoutputdir", "-tod",
                                    help="Name of the output directory for output transformed using -xslt")
     xml_parser.add_argument("-transformedextension", "-toext", nargs='?', const='.xml', default='.xml')
+    xml_parser.add_argument("-stream", action="store_true", help=stream_help)
     xml_parser.set_defaults(func=xml_output)
 
     # Regurgitate
@@ -3793,10 +6412,74 @@ if __name__ == "__main__":
     html_parser = subparsers.add_parser("html", parents=[io_parser])
     html_parser.add_argument("-css",  nargs='+', help="Add a call to a CSS stylesheet in HTML output mode.")
     html_parser.add_argument("-javascript", nargs='+', help="Add a call to a script in HTML output mode.")
+    html_parser.add_argument("-stream", action="store_true", help=stream_help)
     html_parser.set_defaults(func=html_output)
 
+
+if __name__ == "__main__":
+    import argparse
+
+    # Main parser
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(title="subcommands")
+
+    # I/O parser
+    io_parser = argparse.ArgumentParser(add_help=False)
+    io_parser.add_argument("infile", help="the SAM file to be parsed")
+    io_parser.add_argument("-smartquotes", "-sq",
+                           help="the path to a file containing smartquote patterns and substitutions")
+    io_parser.add_argument("-expandrelativepaths", '-xrp', action="store_true", help="expand relative paths on serialization")
+    outputgroup = io_parser.add_mutually_exclusive_group()
+    outputgroup.add_argument("-outfile", "-o", help="the name of the output file")
+    outputgroup.add_argument("-outdir", "-od", help="the name of output directory")
+    io_parser.add_argument("-outputextension", "-oext", nargs='?')
+    io_parser.add_argument("-jobs", "-j", type=int, default=1,
+                           help="the number of processes to spread the input files across")
+    io_parser.add_argument("-incremental", action="store_true",
+                           help="only process the input files that have changed, or whose includes, "
+                                "XSLT or XSD have changed, since the last incremental run")
+    io_parser.add_argument("-cache", metavar="DIR",
+                           help="a directory to cache parsed documents in, so that unchanged files "
+                                "are not parsed again")
+    io_parser.add_argument("-server", metavar="ADDRESS",
+                           help="send the input files to the parse server at this address, "
+                                "started with the serve subcommand, instead of parsing them here")
+
+    add_output_subcommands(subparsers, io_parser)
+
+    # Watch
+    watch_parser = subparsers.add_parser("watch", help="process the input files again whenever they "
+                                                       "or the files they include change")
+    watch_parser.add_argument("-interval", type=float, default=0.5,
+                              help="the number of seconds between checks for changes")
+    watch_parser.add_argument("-remote-interval", type=float, default=60, dest="remote_interval",
+                              help="the number of seconds between checks for changes to included "
+                                   "files that are not local, which take a request to their server")
+    watch_parser.set_defaults(watch=True)
+    add_output_subcommands(watch_parser.add_subparsers(title="subcommands"), io_parser)
+
+    # Serve
+    serve_parser = subparsers.add_parser("serve", help="run a server that parses documents sent to it, "
+                                                       "saving the cost of starting a process for each one")
+    serve_parser.add_argument("address", help="the path of a Unix domain socket, or a port number or "
+                                              "host:port to listen on with TCP")
+    serve_parser.add_argument("-workers", type=int, default=4,
+                              help="the number of requests to process at once")
+    serve_parser.add_argument("-smartquotes", "-sq",
+                              help="the path to a file containing smartquote patterns and substitutions")
+    serve_parser.add_argument("-cache", metavar="DIR", help="a directory to cache parsed documents in")
+    serve_parser.set_defaults(serve=True)
+
     args = argparser.parse_args()
-    
+
+    if getattr(args, "serve", False):
+        args.smart_quote_sets = load_smart_quotes(args.smartquotes) if args.smartquotes else None
+        args.parse_cache = ParseCache(args.cache) if args.cache else None
+        try:
+            serve_requests(args)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
     # If no subcommand was chosen
     if not hasattr(args, "func"):
         argparser.print_help()
@@ -3805,24 +6488,68 @@ if __name__ == "__main__":
     if args.infile == args.outfile:
         raise SAMParserError('Input and output files cannot have the same name.')
 
-    if args.expandrelativepaths:
-        samParser.expand_relative_paths = True
+    if args.server:
+        if getattr(args, 'xslt', None) or getattr(args, 'xsd', None):
+            argparser.error("the -xslt and -xsd options cannot be used with -server")
+        if getattr(args, 'stream', False):
+            argparser.error("the -stream option cannot be used with -server")
+        # The server parses with its own smart quotes and parse cache.
+        if args.smartquotes or args.expandrelativepaths or args.cache:
+            argparser.error("the -smartquotes, -expandrelativepaths and -cache options cannot be used "
+                            "with -server; give -smartquotes and -cache to the serve subcommand")
 
-    if args.smartquotes:
-        with open(args.smartquotes, encoding="utf8") as sqf:
-            try:
-                substitution_sets = etree.parse(sqf)
-            except etree.XMLSyntaxError as e:
-                raise SAMParserError("Smart quotes file {0} contains XML error {1}: " + str(e))
-
-            for x in substitution_sets.iterfind(".//subset"):
-                subs = {}
-                for y in x.iterfind("sub"):
-                    r = re.compile(y.find("pattern").text)
-                    subs.update({r: y.find("replace").text})
-                smart_quote_sets.update({x.find("name").text: subs})
-
-    args.func()
+    if args.incremental and not (args.outfile or args.outdir):
+        argparser.error("the -incremental option needs an output file or directory")
+
+    args.smart_quote_sets = load_smart_quotes(args.smartquotes) if args.smartquotes else None
+    args.parse_cache = ParseCache(args.cache) if args.cache else None
+
+    if getattr(args, "watch", False):
+        try:
+            watch_input_files(args)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    inputfiles = get_input_list(args)
+    skipped_count = 0
+    if args.incremental:
+        manifest_file = get_manifest_file(args)
+        manifest = load_manifest(manifest_file)
+        signature = get_run_signature(args)
+        stamps = {}
+        changed = []
+        for inputfile in inputfiles:
+            stamps[inputfile] = file_stamp(inputfile)
+            entry = manifest.get(os.path.abspath(inputfile))
+            if entry is not None and is_up_to_date(entry, signature):
+                skipped_count += 1
+            else:
+                changed.append(inputfile)
+        inputfiles = changed
+
+    if args.jobs > 1 and len(inputfiles) > 1:
+        results = run_jobs(args, inputfiles)
+    else:
+        results = {}
+        for inputfile in inputfiles:
+            results[inputfile] = process_file(args, inputfile)
+    parser_error_count = sum(x[0] for x in results.values())
+    xsd_error_count = sum(x[1] for x in results.values())
+    xslt_error_count = sum(x[2] for x in results.values())
+
+    if args.incremental:
+        for inputfile, (parser_errors, xsd_errors, xslt_errors, includes) in results.items():
+            path = os.path.abspath(inputfile)
+            if parser_errors or xsd_errors or xslt_errors:
+                # Files with errors are processed again, so that the errors are reported again.
+                manifest.pop(path, None)
+            else:
+                # The stamp of the input file is the one from before it was
+                # processed, so that a change made meanwhile is picked up next time.
+                manifest[path] = {'source': path, 'stamp': stamps[inputfile], 'includes': includes,
+                                  'signature': signature, 'outputs': get_output_files(args, inputfile)}
+        save_manifest(manifest_file, manifest)
+        print("{0} unchanged files skipped.".format(skipped_count), file=sys.stderr)
 
     error_count_total = parser_error_count + xsd_error_count + xslt_error_count
     if error_count_total == 0:
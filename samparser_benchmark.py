@@ -0,0 +1,788 @@
+"""
+Benchmarks for the SAM parser.
+
+Each benchmark is a subcommand. Run ``python samparser_benchmark.py -h``
+for the list of benchmarks and ``python samparser_benchmark.py <benchmark> -h``
+for the options of each one.
+"""
+import gc
+import os
+import sys
+import io
+import mmap
+import time
+import argparse
+import py_compile
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+import samparser
+from samparser import SamParser, FlowParser, DocStructure, SAMParserError, Block, Flow, Phrase
+
+
+def best_time(func, repeat=3):
+    """
+    Runs a function a number of times and returns the best time it took.
+    :param func: The function to time.
+    :param repeat: The number of times to run the function.
+    :return: The shortest run time in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silences the parser's warnings and information messages, which go to stderr.
+    """
+    with contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+class RecordingFlowParser(FlowParser):
+    """
+    A flow parser that keeps a record of the text of every flow it parses,
+    so that the flows of a document can be parsed again in isolation.
+    """
+    def __init__(self):
+        super().__init__()
+        self.flows = []
+
+    def parse(self, flow_source, doc, strip=True):
+        if flow_source is not None:
+            self.flows.append((flow_source, strip, self.smart_quotes))
+        return super().parse(flow_source, doc, strip)
+
+
+def collect_flows(filename):
+    """
+    Parses a SAM document and returns the text of all the flows in it.
+    :param filename: The name of the SAM file.
+    :return: A list of (text, strip, smart_quotes) tuples.
+    """
+    parser = SamParser()
+    parser.flow_parser = RecordingFlowParser()
+    with quiet():
+        parser.parse_file(filename)
+    return parser.flow_parser.flows
+
+
+class CharFlowParser(FlowParser):
+    """
+    A flow parser that reads plain text one character at a time, the way
+    the flow parser did before it learned to copy runs of plain text in bulk.
+    It is kept here as the reference the flow parser is measured against.
+    """
+    def _para(self, para):
+        try:
+            char = para.next_char
+        except IndexError:
+            self.flow.append(self.current_string)
+            self.current_string = ''
+            return "END", para
+        if char in self.markup_states:
+            return self.markup_states[char], para
+        if self.smart_quotes != 'off':
+            try:
+                for r, sub in self.context.smart_quote_sets[self.smart_quotes].items():
+                    match = r.match(para.para, para.currentCharNumber)
+                    if match is not None:
+                        self.current_string += sub
+                        if len(match.group(0)) > 1:
+                            para.advance(len(match.group(0)) - 1)
+                        return "PARA", para
+            except KeyError:
+                raise SAMParserError("Unknown smart quotes set specified: {0}".format(self.smart_quotes))
+        self.current_string += char
+        return "PARA", para
+
+
+def parse_flows(flow_parser, flows):
+    """
+    Parses a list of flows with a given flow parser.
+    :return: The list of Flow objects produced.
+    """
+    result = []
+    doc = DocStructure(None)
+    with quiet():
+        for text, strip, smart_quotes in flows:
+            flow_parser.smart_quotes = smart_quotes
+            flow = flow_parser.parse(text, doc, strip)
+            # Give the flow a parent so that it can be serialized on its own
+            flow.parent = doc
+            result.append(flow)
+    return result
+
+
+def flow_benchmark(args):
+    for filename in args.files:
+        flows = collect_flows(filename)
+        characters = sum(len(text) for text, strip, smart_quotes in flows)
+        print("{0}: {1} flows, {2} characters".format(filename, len(flows), characters))
+        for smart_quotes in (None, 'off', 'on'):
+            if smart_quotes is None:
+                label = 'as declared'
+                test_flows = flows
+            else:
+                label = 'smart quotes ' + smart_quotes
+                test_flows = [(text, strip, smart_quotes) for text, strip, sq in flows]
+
+            reference = [b''.join(f.serialize_xml()) for f in parse_flows(CharFlowParser(), test_flows)]
+            result = [b''.join(f.serialize_xml()) for f in parse_flows(FlowParser(), test_flows)]
+            if result != reference:
+                print("  {0}: output differs from the character-at-a-time parser".format(label))
+                return 1
+
+            char_time = best_time(lambda: parse_flows(CharFlowParser(), test_flows), args.repeat)
+            bulk_time = best_time(lambda: parse_flows(FlowParser(), test_flows), args.repeat)
+            print("  {0:<20} character-at-a-time {1:8.4f}s   bulk {2:8.4f}s   speedup {3:5.1f}x".format(
+                label, char_time, bulk_time, char_time / bulk_time))
+    return 0
+
+
+def record_set_source(records):
+    """
+    Makes a SAM document holding a single record set.
+    :param records: The number of records in the record set.
+    :return: The SAM source as a string.
+    """
+    lines = ['doc: Record set\n\n', '    data:: id, value, note\n']
+    for i in range(records):
+        lines.append('        {0}, {1}, Record number {0}\n'.format(i, i * 3))
+    return ''.join(lines)
+
+
+def records_benchmark(args):
+    previous = None
+    for records in args.records:
+        doc = SamParser().parse(io.StringIO(record_set_source(records)))
+        html_time = best_time(lambda: b''.join(doc.serialize_html()), args.repeat)
+        line = "{0:>8} records: HTML output {1:8.4f}s   {2:6.2f}us per record".format(
+            records, html_time, html_time / records * 1e6)
+        if previous is not None:
+            line += "   {0:5.1f}x the time for {1:5.1f}x the records".format(
+                html_time / previous[1], records / previous[0])
+        print(line)
+        previous = (records, html_time)
+    return 0
+
+
+def document_nodes(doc):
+    """
+    Lists the nodes of a document tree: blocks, flows, spans, and the annotations
+    and citations of phrases.
+    :param doc: The DocStructure of a parsed document.
+    :return: A list of the node objects.
+    """
+    result = []
+    nodes = [doc.root]
+    while nodes:
+        node = nodes.pop()
+        result.append(node)
+        if isinstance(node, Phrase):
+            nodes.extend(node.annotations)
+            nodes.extend(node.citations)
+        if isinstance(node, (Block, Flow)):
+            nodes.extend(x for x in node.children if not isinstance(x, str))
+        if isinstance(node, Block):
+            nodes.extend(x for x in node.citations)
+    return result
+
+
+def node_size(node, lazy_lists=False):
+    """
+    Gets the memory used by a node object itself, including its attribute
+    dictionary and any list attributes, but not the strings or nodes it refers to.
+    Getting the size of the attribute dictionary makes Python create it if it
+    has not yet, so the whole tree figure is the one to rely on.
+    :param node: A node of the document tree.
+    :param lazy_lists: Whether to leave out the empty list attributes, giving
+    the size the node would have if its lists were only made when the first
+    item was added to them.
+    :return: The size in bytes.
+    """
+    size = sys.getsizeof(node)
+    attributes = getattr(node, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+    for name in ('children', 'citations', 'conditions', 'annotations'):
+        value = getattr(node, name, None)
+        if type(value) is list and (value or not lazy_lists):
+            size += sys.getsizeof(value)
+    return size
+
+
+def memory_benchmark(args):
+    for filename in args.files:
+        # Parse once before measuring so that compiled regular expressions
+        # and other caches are not counted.
+        with quiet():
+            SamParser().parse_file(filename)
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        docs = []
+        with quiet():
+            for i in range(args.copies):
+                parser = SamParser()
+                parser.parse_file(filename)
+                docs.append(parser.doc)
+        # The parsers are garbage once parsing is done, but they have reference
+        # cycles, so collect them before measuring.
+        del parser
+        gc.collect()
+        tree_size = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+
+        # Nodes make their list attributes when they are created, even if the
+        # lists stay empty. The lazy figures leave the empty lists out, which
+        # is what the nodes would take if the lists were made on first use.
+        nodes = document_nodes(docs[0])
+        object_size = sum(node_size(x) for x in nodes)
+        lazy_object_size = sum(node_size(x, lazy_lists=True) for x in nodes)
+        tree_size /= args.copies
+        lazy_tree_size = tree_size - (object_size - lazy_object_size)
+        print("{0}: {1} nodes".format(filename, len(nodes)))
+        print("  node objects {0:8.1f} bytes per node   with lazy lists {1:8.1f}".format(
+            object_size / len(nodes), lazy_object_size / len(nodes)))
+        print("  whole tree   {0:8.1f} bytes per node   with lazy lists {1:8.1f}".format(
+            tree_size / len(nodes), lazy_tree_size / len(nodes)))
+    return 0
+
+
+def write_chunks(serialization, outf):
+    """
+    Writes the output of a serialization one chunk at a time, the way the
+    command line tool did before serializations could write themselves.
+    """
+    for chunk in serialization:
+        outf.write(chunk)
+
+
+def output_benchmark(args):
+    for filename in args.files:
+        parser = SamParser()
+        with quiet():
+            parser.parse_file(filename)
+        doc = parser.doc
+        print(filename)
+        for label, method, buffer_type in (('xml', doc.serialize_xml, io.BytesIO),
+                                           ('html', doc.serialize_html, io.BytesIO),
+                                           ('regurgitate', doc.regurgitate, io.StringIO)):
+            chunk_output = buffer_type()
+            block_output = buffer_type()
+            with quiet():
+                write_chunks(method(), chunk_output)
+                method().write_to(block_output)
+            if chunk_output.getvalue() != block_output.getvalue():
+                print("  {0}: output written in blocks differs from output written in chunks".format(label))
+                return 1
+            with quiet():
+                chunk_time = best_time(lambda: write_chunks(method(), buffer_type()), args.repeat)
+                block_time = best_time(lambda: method().write_to(buffer_type()), args.repeat)
+            print("  {0:<12} chunk by chunk {1:8.4f}s   in blocks {2:8.4f}s   speedup {3:5.1f}x".format(
+                label, chunk_time, block_time, chunk_time / block_time))
+    return 0
+
+
+def run_cli(*arguments):
+    result = subprocess.run([sys.executable, samparser.__file__] + list(arguments), capture_output=True)
+    if result.returncode != 0:
+        raise SAMParserError(result.stderr.decode())
+
+
+def serve_benchmark(args):
+    with tempfile.TemporaryDirectory() as directory:
+        address = os.path.join(directory, 'sam.sock')
+        server = subprocess.Popen([sys.executable, samparser.__file__, 'serve', address],
+                                  stderr=subprocess.PIPE)
+        try:
+            # The server reports that it is serving once it is listening.
+            server.stderr.readline()
+            for filename in args.files:
+                path = os.path.abspath(filename)
+                output = os.path.join(directory, 'output.xml')
+                print(filename)
+                timings = (('cold command line', lambda: run_cli('xml', path, '-o', output)),
+                           ('command line client', lambda: run_cli('xml', path, '-o', output, '-server', address)),
+                           ('server request', lambda: samparser.request_parse(address, {'format': 'xml',
+                                                                                        'path': path})))
+                for label, func in timings:
+                    print("  {0:<20} {1:8.4f}s per request".format(label, best_time(func, args.repeat)))
+        finally:
+            server.terminate()
+            server.wait()
+    return 0
+
+
+def manual_source(sections):
+    """
+    Makes a SAM document like a generated reference manual.
+    :param sections: The number of sections in the document.
+    :return: The SAM source as a string.
+    """
+    lines = ['manual: Reference manual\n\n']
+    for i in range(sections):
+        lines.append('    section:(*s{0}) Function {0}\n\n'.format(i))
+        lines.append('        The {{function {0}}}(code) takes *two* arguments [*s0] and returns a value.\n\n'.format(i))
+        lines.append('        * The first argument.\n\n        * The second argument.\n\n')
+        lines.append('        ```(python)\n            result = function_{0}(a, b)\n\n'.format(i))
+    return ''.join(lines)
+
+
+def peak_rss(*arguments):
+    """
+    Runs the command line tool and measures its peak memory use.
+    :return: The peak resident set size of the process in bytes.
+    """
+    process = subprocess.Popen([sys.executable, samparser.__file__] + list(arguments),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise SAMParserError("{0} failed".format(' '.join(arguments)))
+    # macOS reports the size in bytes, other systems in kilobytes.
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def stream_benchmark(args):
+    with tempfile.TemporaryDirectory() as directory:
+        for sections in args.sections:
+            path = os.path.join(directory, 'manual.sam')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(manual_source(sections))
+            output = os.path.join(directory, 'output')
+            print("{0:>8} sections, {1:6.1f} MB".format(sections, os.path.getsize(path) / 2 ** 20))
+            for subcommand in ('xml', 'html'):
+                whole = peak_rss(subcommand, path, '-o', output)
+                with open(output, 'rb') as f:
+                    expected = f.read()
+                streamed = peak_rss(subcommand, path, '-o', output, '-stream')
+                with open(output, 'rb') as f:
+                    if f.read() != expected:
+                        print("  {0}: streamed output differs".format(subcommand))
+                        return 1
+                print("  {0:<5} peak RSS whole {1:8.1f} MB   streamed {2:8.1f} MB".format(
+                    subcommand, whole / 2 ** 20, streamed / 2 ** 20))
+    return 0
+
+
+# The characters besides "\n" that str.splitlines() ends lines at.
+other_line_boundaries = '\v\f\x1c\x1d\x1e\x85\u2028\u2029'
+
+
+def embed_source(blocks, lines):
+    """
+    Makes a SAM document holding SVG images in embed blocks.
+    :param blocks: The number of embed blocks.
+    :param lines: The number of lines in each image.
+    :return: The SAM source as a string.
+    """
+    result = ['doc: Images\n\n']
+    for i in range(blocks):
+        result.append('    figure:(*figure{0}) Figure {0}\n\n        ```(=svg)\n'.format(i))
+        result.append('            <svg xmlns="http://www.w3.org/2000/svg" width="400" height="300">\n')
+        for j in range(lines):
+            result.append('              <path d="M {0} {1} L {1} {0}" stroke="black" />\n'.format(i, j))
+        result.append('            </svg>\n\n')
+    return ''.join(result)
+
+
+def serialize_pre_by_line(pre):
+    """
+    Serializes a Pre one line at a time, the way Pre.serialize_xml() did
+    before it escaped the text of the whole block at once.
+    """
+    for x in pre.lines:
+        yield x.translate({ord('<'): '&lt;', ord('>'): '&gt;', ord('&'): '&amp;'}).encode('utf-8')
+
+
+def codeblocks_benchmark(args):
+    source = embed_source(args.blocks, args.lines)
+    with quiet():
+        SamParser().parse(io.StringIO(source))
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    with quiet():
+        doc = SamParser().parse(io.StringIO(source))
+    gc.collect()
+    tree_size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    pres = [x for x in document_nodes(doc) if isinstance(x, samparser.Pre)]
+    text_size = sum(len(x.text) for x in pres)
+    print("{0} embed blocks of {1} lines, {2:.1f} MB of text".format(args.blocks, args.lines, text_size / 2 ** 20))
+    print("  document tree {0:8.1f} MB, source {1:8.1f} MB".format(tree_size / 2 ** 20, len(source) / 2 ** 20))
+    if b''.join(b''.join(serialize_pre_by_line(x)) for x in pres) != b''.join(
+            b''.join(x.serialize_xml()) for x in pres):
+        print("  the output of the whole blocks differs from the output line by line")
+        return 1
+    by_line = best_time(lambda: [b''.join(serialize_pre_by_line(x)) for x in pres], args.repeat)
+    whole = best_time(lambda: [b''.join(x.serialize_xml()) for x in pres], args.repeat)
+    print("  escaping line by line {0:8.4f}s   whole blocks {1:8.4f}s   speedup {2:5.1f}x".format(
+        by_line, whole, by_line / whole))
+    with quiet():
+        xml_time = best_time(lambda: doc.serialize_xml().write_to(io.BytesIO()), args.repeat)
+    print("  XML output of the document {0:8.4f}s".format(xml_time))
+    return 0
+
+
+def read_bulk_lines(source):
+    """
+    Reads the lines of a binary source the way samparser.read_lines() does,
+    but by memory-mapping or reading the whole source, decoding it in one pass
+    and splitting the text into lines, rather than through a text wrapper.
+    """
+    try:
+        size = os.fstat(source.fileno()).st_size
+    except OSError:
+        size = 0
+    if size > 0:
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = str(data, 'utf-8-sig')
+    else:
+        text = str(source.read(), 'utf-8-sig')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if any(c in text for c in other_line_boundaries):
+        return io.StringIO(text).readlines()
+    return text.splitlines(keepends=True)
+
+
+# Reads a document piped to stdin, the way given by the first argument, and
+# prints the time it took.
+stdin_script = """
+import sys, time, samparser, samparser_benchmark
+read = {'wrapper': samparser.read_lines, 'bulk': samparser_benchmark.read_bulk_lines}[sys.argv[1]]
+start = time.perf_counter()
+read(sys.stdin.buffer)
+print(time.perf_counter() - start)
+"""
+
+
+def piped_read_time(data, method, repeat):
+    """
+    Measures how long it takes to read a document piped to stdin.
+    :param data: The bytes of the document.
+    :param method: 'wrapper' to read it with samparser.read_lines(), or 'bulk' with read_bulk_lines().
+    :return: The best time in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        result = subprocess.run([sys.executable, '-c', stdin_script, method], input=data, capture_output=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        times.append(float(result.stdout))
+    return min(times)
+
+
+def peak_allocation(func):
+    """
+    Measures the peak memory allocated while a function runs, with tracemalloc.
+    :return: The peak in bytes.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def input_benchmark(args):
+    with tempfile.TemporaryDirectory() as directory:
+        for sections in args.sections:
+            path = os.path.join(directory, 'manual.sam')
+            with open(path, 'w', encoding='utf-8-sig') as f:
+                f.write(manual_source(sections))
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            def read_file(read):
+                with open(path, 'rb') as f:
+                    return read(f)
+
+            if read_file(read_bulk_lines) != read_file(samparser.read_lines):
+                print("  the lines read differ")
+                return 1
+            print("{0:>8} sections, {1:6.1f} MB".format(sections, len(data) / 2 ** 20))
+            for label, method, read in (('text wrapper', 'wrapper', samparser.read_lines),
+                                        ('bulk decode', 'bulk', read_bulk_lines)):
+                file_time = best_time(lambda: read_file(read), args.repeat)
+                pipe_time = piped_read_time(data, method, args.repeat)
+                peak = peak_allocation(lambda: read_file(read))
+                print("  {0:<13} file {1:8.4f}s   stdin {2:8.4f}s   peak allocation {3:7.1f} MB".format(
+                    label, file_time, pipe_time, peak / 2 ** 20))
+            with quiet():
+                parse_time = best_time(lambda: SamParser().parse_file(path), 1)
+            print("  {0:<13} {1:8.4f}s".format('whole parse', parse_time))
+    return 0
+
+
+# Modules that samparser only imports when they are needed
+deferred_modules = ['lxml.etree', 'urllib.request', 'argparse', 'html', 'concurrent.futures', 'hashlib']
+
+
+def import_times():
+    """
+    Imports samparser in a new interpreter with -X importtime.
+    :return: A list of (name, depth, self time, cumulative time) tuples, one for
+    each module imported, with the times in seconds. The depth of samparser is 0.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import samparser'],
+                            cwd=os.path.dirname(os.path.abspath(samparser.__file__)),
+                            capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines()[1:]:
+        self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(self_time) / 1e6, int(cumulative_time) / 1e6))
+    # The modules samparser imports are listed before it, so its depth is
+    # found from its own entry, the last one.
+    top = modules[-1][1]
+    return [(name, depth - top, self_time, cumulative_time)
+            for name, depth, self_time, cumulative_time in modules if depth >= top]
+
+
+def startup_benchmark(args):
+    # Make sure that the timed imports load compiled bytecode, even if the
+    # interpreter does not write bytecode files itself.
+    py_compile.compile(samparser.__file__)
+    runs = [import_times() for i in range(args.repeat)]
+    best = min(runs, key=lambda modules: modules[-1][3])
+    name, depth, self_time, cumulative_time = best[-1]
+    print("import samparser  {0:8.4f}s, {1:8.4f}s in the module itself".format(cumulative_time, self_time))
+    print("slowest imports:")
+    imports = sorted((module for module in best if module[1] == 1), key=lambda module: module[3], reverse=True)
+    for name, depth, self_time, cumulative_time in imports[:args.top]:
+        print("  {0:<20} {1:8.4f}s".format(name, cumulative_time))
+    imported = {module[0] for module in best}
+    print("deferred modules imported: {0}".format(
+        ', '.join(name for name in deferred_modules if name in imported) or 'none'))
+    for filename in args.files:
+        path = os.path.abspath(filename)
+        print(filename)
+        with tempfile.TemporaryDirectory() as directory:
+            for subcommand in ('regurgitate', 'xml', 'html'):
+                output = os.path.join(directory, 'output')
+                print("  {0:<12} {1:8.4f}s".format(subcommand, best_time(
+                    lambda: run_cli(subcommand, path, '-o', output), args.repeat)))
+    return 0
+
+
+def table_of_contents(doc):
+    """
+    Lists the IDs and titles of the sections of a document, looking only at
+    its block structure and titles.
+    :return: A list of (ID, title) tuples.
+    """
+    result = []
+    blocks = [doc.root]
+    while blocks:
+        block = blocks.pop()
+        if block.block_type == 'section':
+            result.append((block.ID, str(block.content)))
+        blocks.extend(reversed([x for x in block.children if isinstance(x, Block)]))
+    return result
+
+
+def lazy_benchmark(args):
+    for sections in args.sections:
+        source = manual_source(sections)
+
+        def parse(lazy):
+            with quiet():
+                return SamParser().parse(io.StringIO(source), lazy=lazy)
+
+        def output(doc):
+            with quiet():
+                doc.serialize_xml().write_to(io.BytesIO())
+
+        eager_doc, lazy_doc = parse(False), parse(True)
+        if table_of_contents(eager_doc) != table_of_contents(lazy_doc):
+            print("  the lazily parsed document has a different table of contents")
+            return 1
+        with quiet():
+            if b''.join(eager_doc.serialize_xml()) != b''.join(lazy_doc.serialize_xml()):
+                print("  the lazily parsed document has different output")
+                return 1
+        print("{0} sections".format(sections))
+        eager_toc = best_time(lambda: table_of_contents(parse(False)), args.repeat)
+        lazy_toc = best_time(lambda: table_of_contents(parse(True)), args.repeat)
+        print("  parse and list the sections {0:8.4f}s   lazily {1:8.4f}s   speedup {2:5.1f}x".format(
+            eager_toc, lazy_toc, eager_toc / lazy_toc))
+        eager_xml = best_time(lambda: output(parse(False)), args.repeat)
+        lazy_xml = best_time(lambda: output(parse(True)), args.repeat)
+        print("  parse and write XML        {0:8.4f}s   lazily {1:8.4f}s".format(eager_xml, lazy_xml))
+    return 0
+
+
+def tree_builder_calls(tree):
+    """
+    Lists the calls that build an lxml tree with an lxml TreeBuilder, which a
+    builder that makes the tree of a document directly from its nodes would
+    have to make.
+    :param tree: The lxml ElementTree to list the calls for. Comments and
+    processing instructions outside the root element are left out.
+    :return: A list of (method name, arguments) tuples.
+    """
+    etree = samparser.etree
+    calls = []
+    for event, element in etree.iterwalk(tree.getroot(), events=('start', 'end', 'comment', 'pi')):
+        if event in ('comment', 'pi'):
+            calls.append(('comment', (element.text,)) if event == 'comment'
+                         else ('pi', (element.target, element.text)))
+            if element.tail:
+                calls.append(('data', (element.tail,)))
+        elif event == 'start':
+            calls.append(('start', (element.tag, dict(element.attrib), element.nsmap)))
+            if element.text:
+                calls.append(('data', (element.text,)))
+        else:
+            calls.append(('end', (element.tag,)))
+            if element.tail and element.getparent() is not None:
+                calls.append(('data', (element.tail,)))
+    return calls
+
+
+def build_with_tree_builder(calls):
+    builder = samparser.etree.TreeBuilder()
+    for name, arguments in calls:
+        getattr(builder, name)(*arguments)
+    return builder.close()
+
+
+def etree_benchmark(args):
+    documents = [(filename, lambda parser, filename=filename: parser.parse_file(filename))
+                 for filename in args.files]
+    documents += [('{0} generated sections'.format(x),
+                   lambda parser, source=manual_source(x): parser.parse(io.StringIO(source)))
+                  for x in args.sections]
+    for label, parse in documents:
+        parser = SamParser()
+        with quiet():
+            parse(parser)
+            doc = parser.doc
+            tree = doc.build_etree()
+        calls = tree_builder_calls(tree)
+        if (samparser.etree.tostring(build_with_tree_builder(calls))
+                != samparser.etree.tostring(tree.getroot())):
+            print("  the tree built with a TreeBuilder differs")
+            return 1
+        with quiet():
+            serialize = best_time(lambda: doc.serialize_xml().write_to(io.BytesIO()), args.repeat)
+            feed = best_time(doc.build_etree, args.repeat)
+            join_and_parse = best_time(lambda: samparser.etree.fromstring(b''.join(doc.serialize_xml())),
+                                       args.repeat)
+            feed_peak = peak_allocation(doc.build_etree)
+            join_and_parse_peak = peak_allocation(
+                lambda: samparser.etree.fromstring(b''.join(doc.serialize_xml())))
+        tree_builder = best_time(lambda: build_with_tree_builder(calls), args.repeat)
+        print(label)
+        print("  serialize only            {0:8.4f}s".format(serialize))
+        print("  serialize and feed        {0:8.4f}s   parsing adds {1:8.4f}s   peak {2:8.1f} MB".format(
+            feed, feed - serialize, feed_peak / 1e6))
+        print("  join, then parse          {0:8.4f}s   parsing adds {1:8.4f}s   peak {2:8.1f} MB".format(
+            join_and_parse, join_and_parse - serialize, join_and_parse_peak / 1e6))
+        print("  TreeBuilder calls alone   {0:8.4f}s   ({1} calls)".format(tree_builder, len(calls)))
+    return 0
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmarks for the SAM parser.")
+    subparsers = argparser.add_subparsers(title="benchmarks")
+
+    flow_parser = subparsers.add_parser("flow", help="Compare the flow parser against parsing "
+                                                     "plain text one character at a time.")
+    flow_parser.add_argument("files", nargs='*', default=["test1.sam", "docsource/language.sam"],
+                             help="the SAM files whose flows are parsed")
+    flow_parser.add_argument("-repeat", type=int, default=5, help="the number of timed runs")
+    flow_parser.set_defaults(func=flow_benchmark)
+
+    records_parser = subparsers.add_parser("records", help="Time the HTML output of record sets of "
+                                                           "increasing size.")
+    records_parser.add_argument("records", nargs='*', type=int, default=[5000, 10000, 20000, 40000],
+                                help="the numbers of records to time")
+    records_parser.add_argument("-repeat", type=int, default=3, help="the number of timed runs")
+    records_parser.set_defaults(func=records_benchmark)
+
+    memory_parser = subparsers.add_parser("memory", help="Measure the memory used by the nodes of "
+                                                         "parsed documents.")
+    memory_parser.add_argument("files", nargs='*', default=["test1.sam"],
+                               help="the SAM files to parse")
+    memory_parser.add_argument("-copies", type=int, default=20,
+                               help="the number of copies of each document to keep in memory")
+    memory_parser.set_defaults(func=memory_benchmark)
+
+    output_parser = subparsers.add_parser("output", help="Compare writing XML, HTML and SAM output "
+                                                         "in blocks against writing it chunk by chunk.")
+    output_parser.add_argument("files", nargs='*', default=["test1.sam", "docsource/language.sam"],
+                               help="the SAM files to serialize")
+    output_parser.add_argument("-repeat", type=int, default=5, help="the number of timed runs")
+    output_parser.set_defaults(func=output_benchmark)
+
+    serve_parser = subparsers.add_parser("serve", help="Compare the time a request to the parse server "
+                                                       "takes against running the command line.")
+    serve_parser.add_argument("files", nargs='*', default=["test1.sam", "docsource/language.sam"],
+                              help="the SAM files to convert to XML")
+    serve_parser.add_argument("-repeat", type=int, default=5, help="the number of timed runs")
+    serve_parser.set_defaults(func=serve_benchmark)
+
+    stream_parser = subparsers.add_parser("stream", help="Compare the peak memory use of the command line "
+                                                         "tool with and without -stream on generated documents")
+    stream_parser.add_argument("sections", nargs='*', type=int, default=[1000, 10000, 50000],
+                               help="the numbers of sections in the generated documents")
+    stream_parser.set_defaults(func=stream_benchmark)
+
+    codeblocks_parser = subparsers.add_parser("codeblocks", help="Measure the memory used by large embed blocks "
+                                                                 "and the time it takes to serialize them")
+    codeblocks_parser.add_argument("-blocks", type=int, default=200, help="the number of embed blocks")
+    codeblocks_parser.add_argument("-lines", type=int, default=500, help="the number of lines in each block")
+    codeblocks_parser.add_argument("-repeat", type=int, default=5, help="the number of timed runs")
+    codeblocks_parser.set_defaults(func=codeblocks_benchmark)
+
+    input_parser = subparsers.add_parser("input", help="Compare reading generated documents through a text "
+                                                       "wrapper with decoding them in one pass, from files "
+                                                       "and from stdin")
+    input_parser.add_argument("sections", nargs='*', type=int, default=[10000, 50000],
+                              help="the numbers of sections in the generated documents")
+    input_parser.add_argument("-repeat", type=int, default=5, help="the number of timed runs")
+    input_parser.set_defaults(func=input_benchmark)
+
+    startup_parser = subparsers.add_parser("startup", help="Measure the time it takes to import samparser, "
+                                                           "using -X importtime, and to run the command line.")
+    startup_parser.add_argument("files", nargs='*', default=["test1.sam"],
+                                help="the SAM files to run the command line on")
+    startup_parser.add_argument("-repeat", type=int, default=5, help="the number of timed runs")
+    startup_parser.add_argument("-top", type=int, default=10, help="the number of slowest imports to list")
+    startup_parser.set_defaults(func=startup_benchmark)
+
+    lazy_parser = subparsers.add_parser("lazy", help="Compare listing the sections of generated documents "
+                                                     "and writing their XML output after parsing them in "
+                                                     "full and lazily")
+    lazy_parser.add_argument("sections", nargs='*', type=int, default=[1000, 10000],
+                             help="the numbers of sections in the generated documents")
+    lazy_parser.add_argument("-repeat", type=int, default=3, help="the number of timed runs")
+    lazy_parser.set_defaults(func=lazy_benchmark)
+
+    etree_parser = subparsers.add_parser("etree", help="Compare the time and peak Python memory it takes to "
+                                                       "build the lxml tree of documents by feeding their XML "
+                                                       "output to lxml's parser and by parsing the joined "
+                                                       "output, and time the lxml TreeBuilder calls that "
+                                                       "building the tree directly would take")
+    etree_parser.add_argument("files", nargs='*', default=["test1.sam", "docsource/language.sam"],
+                              help="the SAM files to build trees of")
+    etree_parser.add_argument("-sections", type=int, nargs='*', default=[1000, 10000],
+                              help="the numbers of sections in generated documents to build trees of")
+    etree_parser.add_argument("-repeat", type=int, default=5, help="the number of timed runs")
+    etree_parser.set_defaults(func=etree_benchmark)
+
+    args = argparser.parse_args()
+    if not hasattr(args, "func"):
+        argparser.print_help()
+        sys.exit(1)
+    sys.exit(args.func(args))
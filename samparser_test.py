@@ -0,0 +1,1344 @@
+import io
+import os
+import pathlib
+import re
+import codecs
+import functools
+import http.server
+import json
+import urllib.request
+import sys
+import time
+import queue
+import subprocess
+import unittest
+import tempfile
+import threading
+import contextlib
+
+import samparser
+from samparser import SamParser, FlowParser, DocStructure, Phrase, SAMParserError, get_idrefs
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_string(text):
+    with contextlib.redirect_stderr(io.StringIO()):
+        return SamParser().parse(io.StringIO(text))
+
+
+def parse_flow(text):
+    with contextlib.redirect_stderr(io.StringIO()):
+        return FlowParser().parse(text, DocStructure(None))
+
+
+def best_parse_time(text, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        parse_flow(text)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class FlowScalingTest(unittest.TestCase):
+    # Every kind of inline construct, so that each of them is matched at an
+    # offset into a long paragraph.
+    chunk = ('Some text {a phrase}(thing "x")[*ref] *bold* _italic_ `code`(python) '
+             '[cite] >(image foo.png) &amp; \\* ')
+
+    def test_flow_parse_time_grows_linearly(self):
+        small, large = 800, 6400
+        small_time = best_parse_time(self.chunk * small)
+        large_time = best_parse_time(self.chunk * large)
+        # Linear growth gives a ratio of about 8. Quadratic growth would give 64.
+        self.assertLess(large_time / small_time, 16,
+                        "Parsing a paragraph {0} times longer took {1:.1f} times as long".format(
+                            large // small, large_time / small_time))
+
+    def test_long_paragraph_content(self):
+        flow = parse_flow(self.chunk * 100)
+        self.assertEqual(len([x for x in flow.children if type(x).__name__ == 'Phrase']), 300)
+
+
+class AnnotationLookupTest(unittest.TestCase):
+    source = '''{mode}
+doc: Annotation lookup
+
+    A {Phrase}(one) and a {phrase}(two).
+
+    title: A {phrase}(three) in a title is not used for lookup.
+
+    Then {phrase} and {PHRASE} and {other}.
+'''
+
+    def lookups(self, mode):
+        doc = parse_string(self.source.replace('{mode}', mode))
+        last = doc.annotation_flows[-1]
+        return [[a.type for a in x.annotations] for x in last.children if type(x) is Phrase]
+
+    def test_case_insensitive(self):
+        self.assertEqual(self.lookups(''), [['two'], ['two'], []])
+
+    def test_case_sensitive(self):
+        self.assertEqual(self.lookups('!annotation-lookup: case sensitive'), [['two'], [], []])
+
+    def test_off(self):
+        self.assertEqual(self.lookups('!annotation-lookup: off'), [[], [], []])
+
+    def test_third_party_mode(self):
+        def first_letter(flow, text):
+            for x in reversed(flow.children):
+                if type(x) is Phrase and x.annotated and x.text[0] == text[0]:
+                    return x.global_annotations
+            return None
+        samparser.annotation_lookup_modes['first letter'] = first_letter
+        try:
+            self.assertEqual(self.lookups('!annotation-lookup: first letter'), [['two'], ['one'], []])
+        finally:
+            del samparser.annotation_lookup_modes['first letter']
+
+    def test_index_matches_document_search(self):
+        for mode in ('case sensitive', 'case insensitive', 'off'):
+            doc = parse_string(self.source.replace('{mode}', '!annotation-lookup: ' + mode))
+            for text in ('Phrase', 'phrase', 'PHRASE', 'other'):
+                self.assertEqual(doc.find_last_annotation(text), doc.find_last_annotation(text, doc.root))
+
+
+def parse_file(filename):
+    parser = SamParser()
+    with contextlib.redirect_stderr(io.StringIO()):
+        parser.parse_file(os.path.join(here, filename))
+    return parser.doc
+
+
+class IDRegistryTest(unittest.TestCase):
+    def test_ids_and_idrefs(self):
+        doc = parse_string('doc:(*top)\n\n    p:(*one)\n\n        A {phrase}(*two) and [*one] and >(*top).\n')
+        self.assertEqual(doc.ids, ['top', 'one', 'two'])
+        self.assertIs(doc.nodes_by_id['two'], doc.root.children[0].children[0].children[0].children[0].children[1])
+        self.assertEqual(doc.idrefs, ['one', 'top'])
+
+    def test_duplicate_id(self):
+        with self.assertRaises(SAMParserError):
+            parse_string('doc:(*top)\n\n    A {phrase}(*top).\n')
+
+    def test_unmatched_idrefs(self):
+        with self.assertRaisesRegex(SAMParserError, 'no corresponding IDs: missing'):
+            parse_string('doc:(*top)\n\n    A [*top] and [*missing] citation.\n')
+
+    def test_idrefs_match_document_search(self):
+        doc = parse_file('test1.sam')
+        self.assertEqual(set(doc.idrefs), set(doc.find_all(get_idrefs)))
+        self.assertEqual(set(doc.ids), set(doc.find_all(samparser.get_ids)))
+
+
+class ObjectIndexTest(unittest.TestCase):
+    source = 'doc:(*top)\n\n    p:(#first)\n\n        A {phrase}(*two) and {x}(#first) and {y}(#second).\n'
+
+    def test_lookups_match_tree_search(self):
+        doc = parse_string(self.source)
+        for id in ('top', 'two', 'missing'):
+            self.assertIs(doc.object_by_id(id), doc.root.object_by_id(id))
+        for name in ('first', 'second', 'missing'):
+            self.assertIs(doc.object_by_name(name), doc.root.object_by_name(name))
+        self.assertEqual(doc.object_by_name('first').block_type, 'p')
+
+    def test_renamed_object(self):
+        doc = parse_string(self.source)
+        phrase = doc.object_by_name('second')
+        phrase.name = 'third'
+        self.assertIsNone(doc.object_by_name('second'))
+        self.assertIs(doc.object_by_name('third'), phrase)
+
+    def test_removed_object(self):
+        doc = parse_string(self.source)
+        block = doc.object_by_name('first')
+        block.parent.children.remove(block)
+        self.assertIsNone(doc.object_by_id('two'))
+        self.assertEqual(doc.object_by_name('first'), None)
+
+    def test_test1_lookups(self):
+        doc = parse_file('test1.sam')
+        for id in doc.ids:
+            self.assertIs(doc.object_by_id(id), doc.root.object_by_id(id))
+        for name in doc.find_all(lambda x: [x.name] if getattr(x, 'name', None) else []):
+            self.assertIs(doc.object_by_name(name), doc.root.object_by_name(name))
+
+
+class SiblingTest(unittest.TestCase):
+    def test_positions(self):
+        doc = parse_string('doc: Siblings\n\n    1. one\n\n       more\n\n    2. two\n    3. three\n\n    data:: a\n        x\n        y\n')
+        ol, recordset = doc.root.children[0].children
+        for parent in (ol, recordset, ol.children[0]):
+            for i, x in enumerate(parent.children):
+                self.assertEqual(samparser.sibling_position(x), i)
+                self.assertIs(x.preceding_sibling(), parent.children[i - 1] if i else None)
+                self.assertIs(x.following_sibling(), parent.children[i + 1] if i + 1 < len(parent.children) else None)
+        self.assertEqual(''.join(ol.regurgitate()), '    1. one\n\n       more\n\n\n    2. two\n\n\n    3. three\n\n\n')
+
+    def test_children_changed_by_hand(self):
+        doc = parse_string('doc: Siblings\n\n    data:: a\n        x\n        y\n        z\n')
+        recordset = doc.root.children[0].children[0]
+        first, second, third = recordset.children
+        del recordset.children[0]
+        self.assertIsNone(second.preceding_sibling())
+        self.assertIs(second.following_sibling(), third)
+        with self.assertRaises(ValueError):
+            samparser.sibling_position(first)
+
+    def test_record_set_html_time_grows_linearly(self):
+        def html_time(records):
+            source = 'doc: Records\n\n    data:: a, b\n' + ''.join(
+                '        {0}, {1}\n'.format(i, i * 2) for i in range(records))
+            doc = parse_string(source)
+            times = []
+            for i in range(3):
+                start = time.perf_counter()
+                b''.join(doc.serialize_html())
+                times.append(time.perf_counter() - start)
+            return min(times)
+        small, large = 1000, 8000
+        # Linear growth gives a ratio of about 8. Quadratic growth would give 64.
+        self.assertLess(html_time(large) / html_time(small), 20)
+
+
+class NodeLayoutTest(unittest.TestCase):
+    source = ('doc: Layout\n\n    ```(python)(*code)\n        x = 1\n\n'
+              '    """(*quote)(!fr)(?print)\n        A `x`(=svg) and {y}(z)(#name)(?web) and >(*code).\n\n'
+              '    !!!(Someone)\n        Remark.\n')
+
+    def test_nodes_have_no_attribute_dictionary(self):
+        doc = parse_file('test1.sam')
+        for node in doc.find_all(lambda x: [x] if not isinstance(x, str) else []):
+            self.assertFalse(hasattr(node, '__dict__'), type(node).__name__)
+
+    def test_attributes(self):
+        doc = parse_string(self.source)
+        codeblock = doc.object_by_id('code')
+        self.assertEqual((codeblock.code_language, codeblock.citations, codeblock.conditions), ('python', [], []))
+        quote = doc.object_by_id('quote')
+        self.assertEqual((quote.language_code, quote.conditions), ('fr', ['print']))
+        self.assertEqual(doc.root.children[0].children[2].attribution, 'Someone')
+        flow = quote.children[0].children[0]
+        code, phrase, insert = [x for x in flow.children if not isinstance(x, str)]
+        self.assertIs(type(code), samparser.Embed)
+        self.assertEqual((code.encoding, code.annotations), ('svg', []))
+        self.assertEqual((phrase.name, phrase.conditions), ('name', ['web']))
+        self.assertEqual(insert.reference_parts, [('idref', 'code')])
+        self.assertIn(b'<embed encoding="svg">x</embed>', b''.join(doc.serialize_xml()))
+
+    def test_empty_list_attributes_are_lists(self):
+        doc = parse_string(self.source)
+        quote = doc.object_by_id('quote')
+        phrase = quote.children[0].children[0].children[-2]
+        quote.citations.append('citation')
+        phrase.citations.append('citation')
+        self.assertEqual(doc.object_by_id('code').citations, [])
+        self.assertEqual(samparser.Phrase('text').citations, [])
+        with self.assertRaises(AttributeError):
+            quote.undefined_attribute = 1
+
+
+class SerializationTest(unittest.TestCase):
+    def test_write_to_matches_chunks(self):
+        doc = parse_file('test1.sam')
+        for method, buffer_type in ((doc.serialize_xml, io.BytesIO), (doc.serialize_html, io.BytesIO),
+                                    (doc.regurgitate, io.StringIO)):
+            buffer = buffer_type()
+            with contextlib.redirect_stderr(io.StringIO()):
+                method().write_to(buffer, block_size=100)
+                chunks = list(method())
+            self.assertEqual(buffer.getvalue(), chunks[0][:0].join(chunks))
+            self.assertTrue(all(type(x) is type(chunks[0]) for x in chunks))
+
+    def test_nested_serializations(self):
+        doc = parse_string('doc: Nested\n\n    a:\n        b:\n            c: {text}(x)\n')
+        block = doc.root.children[0]
+        serialization = block.serialize_xml()
+        self.assertIsInstance(serialization, samparser.Serialization)
+        self.assertEqual(b''.join(serialization),
+                         b'<doc>\n<title>Nested</title>\n\n<a>\n<b>\n<c><phrase><annotation type="x">'
+                         b'text</annotation></phrase></c>\n</b>\n</a>\n</doc>\n')
+
+    def test_output_before_failure_is_written(self):
+        def failing():
+            yield b'start '
+            yield samparser.Serialization(iter([b'nested ']))
+            raise SAMParserError('failed')
+        buffer = io.BytesIO()
+        with self.assertRaises(SAMParserError):
+            samparser.Serialization(failing()).write_to(buffer)
+        self.assertEqual(buffer.getvalue(), b'start nested ')
+
+
+class EtreeTest(unittest.TestCase):
+    def test_tree_matches_parsed_output(self):
+        from lxml import etree
+        for filename in ('test1.sam', 'docsource/language.sam'):
+            doc = parse_file(filename)
+            with contextlib.redirect_stderr(io.StringIO()):
+                xml = b''.join(doc.serialize_xml())
+            self.assertEqual(etree.tostring(doc.etree), etree.tostring(etree.parse(io.BytesIO(xml))))
+
+    def test_output_file_and_url(self):
+        doc = parse_file('test1.sam')
+        output = io.BytesIO()
+        with contextlib.redirect_stderr(io.StringIO()):
+            tree = doc.build_etree(output, url='out/test1.xml')
+            xml = b''.join(doc.serialize_xml())
+        self.assertIs(doc.etree, tree)
+        self.assertEqual(output.getvalue(), xml)
+        self.assertEqual(tree.docinfo.URL, 'out/test1.xml')
+
+    def test_validated_output_to_stdout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'doc.sam'), 'w') as f:
+                f.write('doc: Title\n\n    Text.\n')
+            with open(os.path.join(directory, 'doc.xsd'), 'w') as f:
+                f.write('<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"><xs:element name="doc">'
+                        '<xs:complexType><xs:sequence><xs:element name="title" type="xs:string"/>'
+                        '</xs:sequence></xs:complexType></xs:element></xs:schema>')
+            result = subprocess.run([sys.executable, os.path.join(here, 'samparser.py'), 'xml',
+                                     os.path.join(directory, 'doc.sam'), '-xsd', os.path.join(directory, 'doc.xsd')],
+                                    capture_output=True)
+        self.assertIn(b'<p>Text.</p>', result.stdout)
+        self.assertIn("XSD SCHEMA ERROR Element 'p': This element is not expected., line 5 in <stdout>",
+                      result.stderr.decode())
+
+
+class CompiledFileCacheTest(unittest.TestCase):
+    stylesheet = ('<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">'
+                  '<xsl:template match="/"><xsl:message>{0} <xsl:value-of select="name(*)"/></xsl:message>'
+                  '<out/></xsl:template></xsl:stylesheet>')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'test.xslt')
+        self.write_stylesheet('first')
+        self.cache = samparser.CompiledFileCache(lambda path: samparser.etree.XSLT(samparser.etree.parse(path)))
+
+    def write_stylesheet(self, message):
+        with open(self.filename, 'w') as f:
+            f.write(self.stylesheet.format(message))
+
+    def messages(self, transformer, xml):
+        transformer(samparser.etree.XML(xml))
+        return [x.message for x in transformer.error_log]
+
+    def test_compiled_once(self):
+        for xml in (b'<a/>', b'<b/>', b'<c/>'):
+            with self.cache.checkout(self.filename) as transformer:
+                self.assertEqual(self.messages(transformer, xml), ['first ' + xml[1:2].decode()])
+        self.assertEqual(self.cache.compile_count, 1)
+
+    def test_changed_file_is_compiled_again(self):
+        with self.cache.checkout(self.filename) as transformer:
+            self.assertEqual(self.messages(transformer, b'<a/>'), ['first a'])
+        self.write_stylesheet('second one')
+        with self.cache.checkout(self.filename) as transformer:
+            self.assertEqual(self.messages(transformer, b'<a/>'), ['second one a'])
+        self.assertEqual(self.cache.compile_count, 2)
+
+    def test_objects_in_use_are_not_shared(self):
+        with self.cache.checkout(self.filename) as first:
+            with self.cache.checkout(self.filename) as second:
+                self.assertIsNot(first, second)
+        with self.cache.checkout(self.filename) as third:
+            self.assertIn(third, (first, second))
+        self.assertEqual(self.cache.compile_count, 2)
+
+    def test_threads(self):
+        errors = []
+
+        def transform(name):
+            try:
+                for i in range(20):
+                    with self.cache.checkout(self.filename) as transformer:
+                        xml = '<{0}{1}/>'.format(name, i).encode()
+                        self.assertEqual(self.messages(transformer, xml), ['first {0}{1}'.format(name, i)])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=transform, args=(name,)) for name in 'abcd']
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(self.cache.compile_count, 4)
+
+
+class ParseContextTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.write('shared.sam', 'shared: Shared\n\n    Shared text with "quotes".\n')
+        self.write('loop.sam', 'loop: Loop\n\n    <<<(loop.sam)\n')
+        self.docs = []
+        for i in range(8):
+            self.docs.append(self.write('doc{0}.sam'.format(i),
+                                        'doc: Document {0}\n\n    Some "text".\n\n    <<<(shared.sam)\n'
+                                        '\n    <<<(part{0}.sam)\n'.format(i)))
+            self.write('part{0}.sam'.format(i), 'part: Part {0}\n\n    <<<(shared.sam)\n'.format(i))
+
+    def write(self, name, text):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def parse_xml(self, filename, context=None):
+        parser = SamParser(context)
+        parser.parse_file(filename)
+        return b''.join(parser.doc.serialize_xml())
+
+    def test_concurrent_parses_with_includes(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            expected = {x: self.parse_xml(x) for x in self.docs}
+        errors = []
+
+        def parse(docs):
+            try:
+                for i in range(10):
+                    for filename in docs:
+                        self.assertEqual(self.parse_xml(filename), expected[filename])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=parse, args=(self.docs[i:] + self.docs[:i],)) for i in range(8)]
+        with contextlib.redirect_stderr(io.StringIO()):
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(errors, [])
+        self.assertIn(b'Shared text', expected[self.docs[0]])
+
+    def test_recursive_include(self):
+        context = samparser.ParseContext()
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaisesRegex(SAMParserError, 'Duplicate file inclusion'):
+                self.parse_xml(os.path.join(self.directory, 'loop.sam'), context)
+            self.assertEqual(context.included_files, [])
+            self.parse_xml(self.docs[0], context)
+
+    def test_smart_quote_sets(self):
+        source = '!smart-quotes: plain\ndoc: Document\n\n    Some "text".\n'
+        context = samparser.ParseContext({'plain': {re.compile('"'): "'"}})
+        with contextlib.redirect_stderr(io.StringIO()):
+            doc = SamParser(context).parse(io.StringIO(source))
+            self.assertIn(b"Some 'text'.", b''.join(doc.serialize_xml()))
+            with self.assertRaisesRegex(SAMParserError, 'Unknown smart quotes set'):
+                SamParser().parse(io.StringIO(source))
+
+    def test_module_smart_quote_sets(self):
+        source = '!smart-quotes: plain\ndoc: Document\n\n    Some "text".\n'
+        samparser.smart_quote_sets['plain'] = {re.compile('"'): "'"}
+        self.addCleanup(samparser.smart_quote_sets.pop, 'plain')
+        with contextlib.redirect_stderr(io.StringIO()):
+            doc = SamParser().parse(io.StringIO(source))
+        self.assertIn(b"Some 'text'.", b''.join(doc.serialize_xml()))
+
+
+class IncludeCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache = samparser.IncludeCache()
+        self.write('notice.sam', 'notice: Notice\n\n    <<<(terms.sam)\n')
+        self.write('terms.sam', 'terms: Terms\n\n    First terms.\n')
+        self.docs = [self.write('doc{0}.sam'.format(i), 'doc: Document {0}\n\n    <<<(notice.sam)\n'
+                                                         '\n    <<<(notice.sam)\n'.format(i))
+                     for i in range(3)]
+
+    def write(self, name, text):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def parse(self, filename, cache=None):
+        parser = SamParser(samparser.ParseContext(include_cache=cache))
+        with contextlib.redirect_stderr(io.StringIO()):
+            parser.parse_file(filename)
+        return parser.doc
+
+    def test_hits_and_misses(self):
+        for filename in self.docs:
+            self.assertEqual(b''.join(self.parse(filename, self.cache).serialize_xml()),
+                             b''.join(self.parse(filename).serialize_xml()))
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.hits, 5)
+
+    def test_changed_nested_include(self):
+        self.parse(self.docs[0], self.cache)
+        self.write('terms.sam', 'terms: Terms\n\n    Second terms, which are longer.\n')
+        xml = b''.join(self.parse(self.docs[1], self.cache).serialize_xml())
+        self.assertIn(b'Second terms', xml)
+        self.assertNotIn(b'First terms', xml)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_missing_include_turns_up(self):
+        self.write('notice.sam', 'notice: Notice\n\n    <<<(later.sam)\n')
+        self.assertNotIn(b'Later', b''.join(self.parse(self.docs[0], self.cache).serialize_xml()))
+        self.write('later.sam', 'later: Later\n')
+        self.assertIn(b'Later', b''.join(self.parse(self.docs[0], self.cache).serialize_xml()))
+
+    def test_includes_are_copies(self):
+        doc = self.parse(self.docs[0], self.cache)
+        first, second = [x for x in doc.root.children[0].children if isinstance(x, samparser.Include)]
+        self.assertIsNot(first.children[0], second.children[0])
+        self.assertIs(first.children[0].parent, first)
+        self.assertIs(second.children[0].parent, second)
+
+    def test_threads(self):
+        expected = b''.join(self.parse(self.docs[0]).serialize_xml())
+        errors = []
+
+        def parse():
+            try:
+                for i in range(10):
+                    self.assertEqual(b''.join(self.parse(self.docs[0], self.cache).serialize_xml()), expected)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=parse) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        # Threads that start together may each miss the first time.
+        self.assertLessEqual(self.cache.misses, 8)
+        self.assertGreaterEqual(self.cache.hits, 76)
+
+    def test_messages_are_printed_on_hits(self):
+        self.write('terms.sam', 'terms: Terms\n\n    A {phrase} with no annotation.\n')
+        for filename in self.docs:
+            parser = SamParser(samparser.ParseContext(include_cache=self.cache))
+            messages = io.StringIO()
+            with contextlib.redirect_stderr(messages):
+                parser.parse_file(filename)
+            self.assertEqual(messages.getvalue().count('Unannotated phrase found'), 2)
+        self.assertEqual(self.cache.hits, 5)
+
+    def test_remote_hits_are_not_downloaded(self):
+        responses = []
+
+        class RecordingRequestHandler(http.server.SimpleHTTPRequestHandler):
+            def send_response(self, code, message=None):
+                responses.append((self.path, code))
+                super().send_response(code, message)
+
+            def log_message(self, format, *args):
+                pass
+
+        handler = functools.partial(RecordingRequestHandler, directory=self.directory)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.write('remote.sam', 'doc: Remote\n\n    <<<(http://127.0.0.1:{0}/notice.sam)\n'.format(
+            server.server_address[1]))
+        for i, prefetch in enumerate((False, False, True)):
+            responses.clear()
+            parser = SamParser(samparser.ParseContext(include_cache=self.cache, prefetch=prefetch))
+            with contextlib.redirect_stderr(io.StringIO()):
+                parser.parse_file(os.path.join(self.directory, 'remote.sam'))
+            self.assertIn(b'First terms', b''.join(parser.doc.serialize_xml()))
+            if i:
+                self.assertEqual(sorted(responses), [('/notice.sam', 304), ('/terms.sam', 304)])
+        self.assertEqual(self.cache.hits, 2)
+
+
+class SlowRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files after a delay, standing in for a slow web server. It records
+    the paths requested and the largest number of requests it has been
+    handling at once.
+    """
+    delay = 0.2
+    lock = threading.Lock()
+    in_flight = 0
+    peak_in_flight = 0
+    paths = []
+
+    def do_GET(self):
+        cls = SlowRequestHandler
+        with cls.lock:
+            cls.paths.append(self.path)
+            cls.in_flight += 1
+            cls.peak_in_flight = max(cls.peak_in_flight, cls.in_flight)
+        try:
+            time.sleep(self.delay)
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PrefetchTest(unittest.TestCase):
+    chapters = 10
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        handler = functools.partial(SlowRequestHandler, directory=self.directory)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.base_url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+        for i in range(self.chapters):
+            self.write('chapter{0}.sam'.format(i), 'chapter: Chapter {0}\n\n    Text of chapter {0}.\n'.format(i))
+        self.write('book.sam', 'book: Book\n' + ''.join('\n    <<<(chapter{0}.sam)\n'.format(i)
+                                                          for i in range(self.chapters)))
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(text)
+
+    def parse(self, name, prefetch=True, context=None):
+        if context is None:
+            context = samparser.ParseContext(prefetch=prefetch)
+        messages = io.StringIO()
+        with contextlib.redirect_stderr(messages):
+            with urllib.request.urlopen(self.base_url + name) as response:
+                doc = SamParser(context).parse(codecs.getreader('utf-8')(response))
+        return b''.join(doc.serialize_xml()), messages.getvalue()
+
+    def test_includes_are_fetched_concurrently(self):
+        SlowRequestHandler.peak_in_flight = 0
+        expected = self.parse('book.sam', prefetch=False)
+        self.assertEqual(SlowRequestHandler.peak_in_flight, 1)
+        SlowRequestHandler.peak_in_flight = 0
+        self.assertEqual(self.parse('book.sam'), expected)
+        self.assertIn(b'Text of chapter 9.', expected[0])
+        self.assertGreater(SlowRequestHandler.peak_in_flight, 1)
+
+    def test_missing_include(self):
+        self.write('book.sam', 'book: Book\n\n    <<<(missing.sam)\n\n    <<<(chapter0.sam)\n')
+        result = self.parse('book.sam')
+        self.assertEqual(result, self.parse('book.sam', prefetch=False))
+        self.assertIn('SAM parser warning: HTTP Error 404', result[1])
+
+    def test_recursive_include(self):
+        self.write('chapter1.sam', 'chapter: Chapter 1\n\n    <<<(book.sam)\n')
+        for prefetch in (True, False):
+            with self.assertRaisesRegex(SAMParserError, 'Duplicate file inclusion detected with file: ' +
+                                        re.escape(self.base_url + 'chapter1.sam')):
+                self.parse('book.sam', prefetch)
+
+    def test_code_block_includes_are_not_fetched(self):
+        self.write('book.sam', 'book: Book\n\n'
+                               '    ```(sam)\n        <<<(secret.sam)\n\n        ```(sam)\n'
+                               '            <<<(secret.sam)\n\n'
+                               '    <<<(chapter0.sam)\n\n'
+                               '    ```(=base64)\n        <<<(secret.sam)\n')
+        SlowRequestHandler.paths = []
+        result = self.parse('book.sam')
+        self.assertEqual(result, self.parse('book.sam', prefetch=False))
+        self.assertIn(b'Text of chapter 0.', result[0])
+        self.assertNotIn('/secret.sam', SlowRequestHandler.paths)
+
+    def test_include_cache(self):
+        context = samparser.ParseContext(include_cache=samparser.IncludeCache())
+        expected = self.parse('book.sam', prefetch=False)
+        self.assertEqual(self.parse('book.sam', context=context), expected)
+        self.assertEqual(self.parse('book.sam', context=context), expected)
+        self.assertEqual(context.include_cache.hits, self.chapters)
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        self.write('terms.sam', 'terms: Terms\n\n    First terms.\n')
+        self.doc = self.write('doc.sam', 'doc: Document\n\n    A {phrase} with "quotes".\n\n    <<<(terms.sam)\n')
+
+    def write(self, name, text):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def parse(self, cache, smart_quote_sets=None):
+        parser = SamParser(samparser.ParseContext(smart_quote_sets, parse_cache=cache))
+        messages = io.StringIO()
+        with contextlib.redirect_stderr(messages):
+            parser.parse_file(self.doc)
+        return b''.join(parser.doc.serialize_xml()), messages.getvalue()
+
+    def test_hit(self):
+        expected = self.parse(None)
+        self.assertIn('Unannotated phrase found', expected[1])
+        self.assertEqual(self.parse(samparser.ParseCache(self.cache_directory)), expected)
+        cache = samparser.ParseCache(self.cache_directory)
+        self.assertEqual(self.parse(cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_hit_messages_are_recorded(self):
+        cache = samparser.ParseCache(self.cache_directory)
+        self.parse(cache)
+        with samparser.recorded_messages() as messages:
+            self.parse(cache)
+        self.assertEqual(cache.hits, 1)
+        self.assertTrue(any('Unannotated phrase found' in x for x in messages))
+
+    def test_changes(self):
+        cache = samparser.ParseCache(self.cache_directory)
+        self.parse(cache)
+        self.write('terms.sam', 'terms: Terms\n\n    Second terms, which are longer.\n')
+        self.assertIn(b'Second terms', self.parse(cache)[0])
+        self.parse(cache, {'plain': {re.compile('"'): "'"}})
+        self.write('doc.sam', '!smart-quotes: plain\n' + open(self.doc).read())
+        self.assertIn(b"'quotes'", self.parse(cache, {'plain': {re.compile('"'): "'"}})[0])
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+        self.parse(cache, {'plain': {re.compile('"'): "'"}})
+        self.assertEqual(cache.hits, 1)
+
+    def test_damaged_entry(self):
+        cache = samparser.ParseCache(self.cache_directory)
+        expected = self.parse(cache)
+        for name in os.listdir(self.cache_directory):
+            with open(os.path.join(self.cache_directory, name), 'wb') as f:
+                f.write(b'damaged')
+        self.assertEqual(self.parse(cache), expected)
+        self.assertEqual(cache.misses, 2)
+
+    def test_eviction(self):
+        cache = samparser.ParseCache(self.cache_directory)
+        self.parse(cache)
+        (entry,) = os.listdir(self.cache_directory)
+        size = os.path.getsize(os.path.join(self.cache_directory, entry))
+        for i in range(3):
+            with open(os.path.join(self.cache_directory, 'old{0}.samcache'.format(i)), 'wb') as f:
+                f.write(b'x' * size)
+            os.utime(f.name, (time.time() - 100 * (i + 1), time.time() - 100 * (i + 1)))
+        samparser.ParseCache(self.cache_directory, max_size=size * 2, max_age=250).evict()
+        self.assertEqual(sorted(os.listdir(self.cache_directory)), sorted([entry, 'old0.samcache']))
+
+
+class JobsTest(unittest.TestCase):
+    def run_cli(self, *arguments):
+        return subprocess.run([sys.executable, os.path.join(here, 'samparser.py')] + list(arguments),
+                              capture_output=True, cwd=here)
+
+    def test_jobs_match_serial_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sources = os.path.join(directory, 'sources')
+            os.mkdir(sources)
+            for i in range(4):
+                with open(os.path.join(sources, 'good{0}.sam'.format(i)), 'w') as f:
+                    f.write('doc: Document {0}\n\n'.format(i) + '    Some text.\n\n' * (i + 1))
+            with open(os.path.join(sources, 'bad.sam'), 'w') as f:
+                f.write('doc: Bad\n\n    A [*missing] reference.\n')
+            pattern = os.path.join(sources, '*.sam')
+            serial = self.run_cli('xml', pattern, '-od', os.path.join(directory, 'serial'))
+            jobs = self.run_cli('xml', pattern, '-od', os.path.join(directory, 'jobs'), '-jobs', '3')
+            self.assertEqual(jobs.returncode, serial.returncode)
+            self.assertEqual(serial.returncode, 1)
+            serial_messages = serial.stderr.decode().splitlines()
+            jobs_messages = jobs.stderr.decode().splitlines()
+            self.assertEqual(jobs_messages[-4:], serial_messages[-4:])
+            self.assertIn('1 SAM parser errors.', jobs_messages)
+            self.assertEqual(sorted(jobs_messages), sorted(serial_messages))
+            for name in os.listdir(os.path.join(directory, 'serial')):
+                with open(os.path.join(directory, 'serial', name), 'rb') as f:
+                    expected = f.read()
+                with open(os.path.join(directory, 'jobs', name), 'rb') as f:
+                    self.assertEqual(f.read(), expected)
+
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.sources = os.path.join(self.directory, 'sources')
+        os.mkdir(self.sources)
+        self.write('terms.sami', 'terms: Terms\n\n    <<<(notice.sami)\n')
+        self.write('notice.sami', 'notice: Notice\n')
+        self.write('a.sam', 'doc: A\n\n    <<<(terms.sami)\n')
+        self.write('b.sam', 'doc: B\n')
+        self.write('c.sam', 'doc: C\n')
+
+    def write(self, name, text):
+        with open(os.path.join(self.sources, name), 'w') as f:
+            f.write(text)
+        # Make sure the change shows even if it is made within the same clock tick.
+        os.utime(os.path.join(self.sources, name), ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+
+    def run_incremental(self, *arguments):
+        result = subprocess.run([sys.executable, os.path.join(here, 'samparser.py'), 'html',
+                                 os.path.join(self.sources, '*.sam'), '-od', os.path.join(self.directory, 'out'),
+                                 '-incremental'] + list(arguments), capture_output=True, cwd=here)
+        messages = result.stderr.decode()
+        parsed = sorted(os.path.basename(x.split()[-1]) for x in messages.splitlines()
+                        if x.startswith('SAM parser information: Parsing /'))
+        skipped = [x for x in messages.splitlines() if x.endswith('unchanged files skipped.')]
+        return result.returncode, parsed, skipped
+
+    def test_only_changed_files_are_processed(self):
+        self.assertEqual(self.run_incremental(), (0, ['a.sam', 'b.sam', 'c.sam'], ['0 unchanged files skipped.']))
+        self.assertEqual(self.run_incremental(), (0, [], ['3 unchanged files skipped.']))
+        self.write('notice.sami', 'notice: Changed notice\n')
+        self.assertEqual(self.run_incremental(), (0, ['a.sam'], ['2 unchanged files skipped.']))
+        self.write('b.sam', 'doc: B\n\n    Changed.\n')
+        os.remove(os.path.join(self.directory, 'out', 'c.html'))
+        self.assertEqual(self.run_incremental('-jobs', '2'), (0, ['b.sam', 'c.sam'], ['1 unchanged files skipped.']))
+        self.assertEqual(self.run_incremental('-css', 'style.css'), (0, ['a.sam', 'b.sam', 'c.sam'],
+                                                                     ['0 unchanged files skipped.']))
+        with open(os.path.join(self.directory, 'out', 'a.html')) as f:
+            self.assertIn('Changed notice', f.read())
+
+    def test_files_with_errors_are_processed_again(self):
+        self.write('b.sam', 'doc: B\n\n    A [*missing] reference.\n')
+        self.assertEqual(self.run_incremental()[0], 1)
+        self.assertEqual(self.run_incremental(), (1, ['b.sam'], ['2 unchanged files skipped.']))
+
+    def test_output_needed(self):
+        result = subprocess.run([sys.executable, os.path.join(here, 'samparser.py'), 'xml',
+                                 os.path.join(self.sources, 'b.sam'), '-incremental'],
+                                capture_output=True, text=True, cwd=here)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn('the -incremental option needs an output file or directory', result.stderr)
+        self.assertNotIn('Traceback', result.stderr)
+
+    def test_manifest_stamp(self):
+        self.assertEqual(samparser.manifest_stamp((1, 2)), [1, 2])
+        self.assertEqual(samparser.manifest_stamp('abc'), 'abc')
+        self.assertIsNone(samparser.manifest_stamp(None))
+
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.sources = os.path.join(self.directory, 'sources')
+        os.mkdir(self.sources)
+        self.write('notice.sami', 'notice: Notice\n')
+        self.write('a.sam', 'doc: A\n\n    <<<(notice.sami)\n')
+        self.write('b.sam', 'doc: B\n')
+
+    def write(self, name, text):
+        with open(os.path.join(self.sources, name), 'w') as f:
+            f.write(text)
+
+    def read_output(self, name):
+        with open(os.path.join(self.directory, 'out', name)) as f:
+            return f.read()
+
+    def watch(self, *arguments):
+        """
+        Starts the watch subcommand, returning a function that waits for the
+        next build and returns the files it processed and its summary.
+        """
+        watcher = subprocess.Popen([sys.executable, os.path.join(here, 'samparser.py'), 'watch', '-interval', '0.1']
+                                   + list(arguments), stderr=subprocess.PIPE, text=True, cwd=here)
+        self.addCleanup(watcher.stderr.close)
+        self.addCleanup(watcher.wait)
+        self.addCleanup(watcher.kill)
+        lines = queue.Queue()
+        threading.Thread(target=lambda: [lines.put(x) for x in watcher.stderr], daemon=True).start()
+
+        def wait_for_build():
+            processed = []
+            while True:
+                line = lines.get(timeout=30)
+                if line.startswith('SAM parser information: Processed '):
+                    processed.append(os.path.basename(line.split()[4]))
+                    self.assertRegex(line, r'after the change was saved\.$')
+                if line.startswith('Processing completed'):
+                    return sorted(processed), line.strip()
+        return wait_for_build
+
+    def test_changed_files_are_processed(self):
+        wait_for_build = self.watch('html', os.path.join(self.sources, '*.sam'),
+                                    '-od', os.path.join(self.directory, 'out'))
+        self.assertEqual(wait_for_build(), ([], 'Processing completed with 0 errors. Watching 2 files for changes.'))
+        self.write('notice.sami', 'notice: Changed notice\n')
+        self.assertEqual(wait_for_build(), (['a.sam'], 'Processing completed with 0 errors. '
+                                                       'Watching 2 files for changes.'))
+        self.assertIn('Changed notice', self.read_output('a.html'))
+        self.write('c.sam', 'doc: C\n')
+        self.assertEqual(wait_for_build()[0], ['c.sam'])
+        self.assertIn('doc', self.read_output('c.html'))
+
+    def test_deleted_option_file(self):
+        self.write('copy.xsl', '<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">'
+                               '<xsl:template match="/"><xsl:copy-of select="."/></xsl:template>'
+                               '</xsl:stylesheet>')
+        os.mkdir(os.path.join(self.directory, 'transformed'))
+        wait_for_build = self.watch('xml', os.path.join(self.sources, '*.sam'),
+                                    '-xslt', os.path.join(self.sources, 'copy.xsl'),
+                                    '-od', os.path.join(self.directory, 'out'),
+                                    '-tod', os.path.join(self.directory, 'transformed'))
+        self.assertEqual(wait_for_build(), ([], 'Processing completed with 0 errors. Watching 2 files for changes.'))
+        os.remove(os.path.join(self.sources, 'copy.xsl'))
+        self.assertEqual(wait_for_build(), (['a.sam', 'b.sam'], 'Processing completed with 2 errors. '
+                                                                'Watching 2 files for changes.'))
+
+    def test_remote_includes_are_polled_less_often(self):
+        requests = []
+
+        class CountingRequestHandler(http.server.SimpleHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                super().do_GET()
+
+            def log_message(self, format, *args):
+                pass
+
+        handler = functools.partial(CountingRequestHandler, directory=self.sources)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.write('a.sam', 'doc: A\n\n    <<<(http://127.0.0.1:{0}/notice.sami)\n'.format(server.server_address[1]))
+        wait_for_build = self.watch('-remote-interval', '60', 'html', os.path.join(self.sources, '*.sam'),
+                                    '-od', os.path.join(self.directory, 'out'))
+        self.assertEqual(wait_for_build(), ([], 'Processing completed with 0 errors. Watching 2 files for changes.'))
+        time.sleep(1)
+        self.assertEqual(requests, ['/notice.sami'])
+
+
+class ServeTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.address = os.path.join(self.directory, 'sam.sock')
+        self.server = samparser.UnixParseServer(self.address, samparser.ParseRequestHandler)
+        self.server.setup_parsers(2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_formats(self):
+        source = 'doc: Document\n\n    A {phrase} with "quotes".\n'
+        doc = parse_string(source)
+        for output_format, expected in (('xml', b''.join(doc.serialize_xml()).decode()),
+                                        ('html', b''.join(doc.serialize_html()).decode()),
+                                        ('regurgitate', ''.join(doc.regurgitate())),
+                                        ('diagnostics', None)):
+            response = samparser.request_parse(self.address, {'format': output_format, 'source': source})
+            self.assertEqual(response['output'], expected)
+            self.assertEqual(response['errors'], 0)
+            self.assertIn('Unannotated phrase found', response['messages'])
+
+    def test_errors(self):
+        response = samparser.request_parse(self.address, {'format': 'xml',
+                                                          'source': 'doc: A\n\n    A [*missing] ref.\n'})
+        self.assertEqual((response['output'], response['errors']), (None, 1))
+        self.assertIn('SAM parser ERROR: Idrefs found with no corresponding IDs: missing', response['messages'])
+        response = samparser.request_parse(self.address, {'format': 'pdf', 'source': 'doc: A\n'})
+        self.assertIn('Bad request', response['messages'])
+
+    def test_concurrent_requests(self):
+        sources = ['!smart-quotes: on\ndoc: Document {0}\n\n    "Text".\n'.format(i) if i % 2 else
+                   'doc: Document {0}\n\n    "Text".\n'.format(i) for i in range(8)]
+        expected = [b''.join(parse_string(x).serialize_xml()).decode() for x in sources]
+        errors = []
+
+        def send(i):
+            try:
+                for j in range(5):
+                    response = samparser.request_parse(self.address, {'format': 'xml', 'source': sources[i]})
+                    self.assertEqual(response['output'], expected[i])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.server.parsers.qsize(), 2)
+
+    def test_client_mode(self):
+        outputs = {}
+        for name, arguments in (('local', []), ('client', ['-server', self.address])):
+            output = os.path.join(self.directory, name + '.html')
+            result = subprocess.run([sys.executable, os.path.join(here, 'samparser.py'), 'html',
+                                     os.path.join(here, 'test1.sam'), '-o', output] + arguments,
+                                    capture_output=True, cwd=here)
+            self.assertEqual(result.returncode, 0)
+            with open(output, 'rb') as f:
+                outputs[name] = f.read()
+        self.assertEqual(outputs['client'], outputs['local'])
+
+    def test_parse_cache_hit_messages(self):
+        address = os.path.join(self.directory, 'cached.sock')
+        server = samparser.UnixParseServer(address, samparser.ParseRequestHandler)
+        cache = samparser.ParseCache(os.path.join(self.directory, 'cache'))
+        server.setup_parsers(1, parse_cache=cache)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        filename = os.path.join(self.directory, 'doc.sam')
+        with open(filename, 'w') as f:
+            f.write('doc: Document\n\n    A {phrase} with no annotation.\n')
+        server_messages = io.StringIO()
+        with contextlib.redirect_stderr(server_messages):
+            for i in range(2):
+                response = samparser.request_parse(address, {'format': 'xml', 'path': filename})
+                self.assertIn('Unannotated phrase found', response['messages'])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(server_messages.getvalue(), '')
+
+    def test_client_mode_includes(self):
+        response = samparser.request_parse(self.address, {'format': 'diagnostics',
+                                                          'path': os.path.join(here, 'test1.sam')})
+        parser = SamParser()
+        with contextlib.redirect_stderr(io.StringIO()):
+            parser.parse_file(os.path.join(here, 'test1.sam'))
+        self.assertEqual(response['includes'], json.loads(json.dumps(parser.includes)))
+        self.assertTrue(response['includes'])
+        output = os.path.join(self.directory, 'out', 'test1.html')
+        arguments = [sys.executable, os.path.join(here, 'samparser.py'), 'html', os.path.join(here, 'test1.sam'),
+                     '-o', output, '-incremental', '-server', self.address]
+        for skipped in (0, 1):
+            result = subprocess.run(arguments, capture_output=True, text=True, cwd=here)
+            self.assertEqual(result.returncode, 0)
+            self.assertIn('{0} unchanged files skipped.'.format(skipped), result.stderr)
+
+    def test_client_mode_errors(self):
+        command = [sys.executable, os.path.join(here, 'samparser.py'), 'xml', os.path.join(here, 'test1.sam')]
+        result = subprocess.run(command + ['-server', os.path.join(self.directory, 'none.sock')],
+                                capture_output=True, text=True, cwd=here)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('SAM parser ERROR: Cannot connect to the parse server', result.stderr)
+        self.assertNotIn('Traceback', result.stderr)
+        for option in (['-xslt', 'x.xsl'], ['-xsd', 'x.xsd'], ['-stream'], ['-smartquotes', 'sq.xml'],
+                       ['-expandrelativepaths'], ['-cache', self.directory]):
+            result = subprocess.run(command + ['-server', self.address] + option,
+                                    capture_output=True, text=True, cwd=here)
+            self.assertEqual(result.returncode, 2)
+            self.assertIn('cannot be used with -server', result.stderr)
+
+
+class StartupTest(unittest.TestCase):
+    def test_deferred_imports(self):
+        result = subprocess.run([sys.executable, '-c', 'import sys, samparser\n'
+                                 'samparser.SamParser().parse_file("test1.sam")\n'
+                                 'print(" ".join(sorted(sys.modules)))'],
+                                capture_output=True, text=True, cwd=here)
+        modules = result.stdout.split()
+        for name in ('lxml.etree', 'argparse', 'json', 'pickle', 'socketserver'):
+            self.assertNotIn(name, modules)
+        # test1.sam includes a file, so the module for reading URLs is needed.
+        self.assertIn('urllib.request', modules)
+
+    def test_server_classes(self):
+        self.assertIs(samparser.UnixParseServer, samparser.parse_server_classes()[1])
+        self.assertTrue(issubclass(samparser.TCPParseServer, samparser.ParseServerMixin))
+        with self.assertRaises(AttributeError):
+            samparser.NoSuchClass
+
+    def test_lazy_patterns(self):
+        patterns = samparser.LazyPatterns({'a': (r'a+', 0)})
+        self.assertEqual(len(patterns), 0)
+        self.assertEqual(patterns['a'].match('aab').group(0), 'aa')
+        self.assertIs(patterns['a'], patterns['a'])
+        self.assertEqual(list(samparser.smart_quote_subs.values())[:2], ['”', '“'])
+
+    def test_block_names(self):
+        from lxml import etree
+        for name in ('para', 'a.b-c_d1', '_x', 'été', 'Ω', '名前', 'a·b', '1a', 'a:b', 'a\u00d7b', 'a\u0300'):
+            try:
+                etree.Element(name)
+                valid = True
+            except ValueError:
+                valid = False
+            source = '{0}: Title\n'.format(name)
+            if valid:
+                self.assertEqual(parse_string(source).root.children[0].block_type, name)
+            else:
+                with self.assertRaisesRegex(samparser.SAMParserError, 'Invalid block name'):
+                    parse_string(source)
+
+def stream_events(source, handler=None):
+    parser = SamParser()
+    with contextlib.redirect_stderr(io.StringIO()):
+        if handler is not None:
+            return parser.push_events(io.StringIO(source), handler)
+        return list(parser.events(io.StringIO(source)))
+
+
+class EventsTest(unittest.TestCase):
+    def describe(self, events):
+        return [(event, node if type(node) is str else type(node).__name__) for event, node in events]
+
+    def test_event_sequence(self):
+        source = ('doc: Title [*ref]\n\n'
+                  '    A {phrase}(x)[*ref] and >(image foo.png).\n\n'
+                  '    * item\n\n'
+                  '    ```(python)\n'
+                  '        code\n\n'
+                  '    table:: a, b\n'
+                  '        1, 2\n\n'
+                  '    section:(*ref) End\n')
+        self.assertEqual(self.describe(stream_events(source)), [
+            ('start-document', 'StreamingDocStructure'),
+            ('start-block', 'Block'), ('flow-text', 'Title '), ('citation', 'Citation'),
+            ('start-block', 'Paragraph'), ('start-flow', 'Flow'),
+            ('flow-text', 'A '), ('phrase', 'Phrase'), ('annotation', 'Annotation'), ('citation', 'Citation'),
+            ('flow-text', ' and '), ('insert', 'InlineInsert'), ('flow-text', '.'),
+            ('end-flow', 'Flow'), ('end-block', 'Paragraph'),
+            ('start-block', 'UnorderedList'), ('start-block', 'UnorderedListItem'),
+            ('start-block', 'Paragraph'), ('start-flow', 'Flow'), ('flow-text', 'item'), ('end-flow', 'Flow'),
+            ('end-block', 'Paragraph'), ('end-block', 'UnorderedListItem'), ('end-block', 'UnorderedList'),
+            ('start-block', 'Codeblock'), ('start-flow', 'Pre'), ('codeblock-line', 'code\n'),
+            ('end-flow', 'Pre'), ('end-block', 'Codeblock'),
+            ('start-block', 'RecordSet'), ('record', 'Record'), ('flow-text', '1'), ('flow-text', '2'),
+            ('end-block', 'RecordSet'),
+            ('start-block', 'Block'), ('flow-text', 'End'), ('end-block', 'Block'),
+            ('end-block', 'Block'),
+            ('end-document', 'StreamingDocStructure')])
+
+    def stream_file(self, filename, handler=None):
+        path = os.path.join(here, filename)
+        url = pathlib.Path(path).as_uri()
+        parser = SamParser()
+        with open(path, encoding='utf-8-sig') as source, contextlib.redirect_stderr(io.StringIO()):
+            if handler is not None:
+                return parser.push_events(source, handler, url)
+            return [(event, node if type(node) is str else (type(node).__name__, getattr(node, 'position', None)))
+                    for event, node in parser.events(source, url)]
+
+    def test_events_match_tree(self):
+        doc = parse_file('test1.sam')
+        walked = [(event, node if type(node) is str else (type(node).__name__, getattr(node, 'position', None)))
+                  for event, node in samparser.tree_events(doc)]
+        # Only the type of the document differs.
+        walked[0] = ('start-document', ('StreamingDocStructure', None))
+        walked[-1] = ('end-document', ('StreamingDocStructure', None))
+        self.assertEqual(self.stream_file('test1.sam'), walked)
+
+    def test_tree_builder(self):
+        builder = self.stream_file('test1.sam', samparser.TreeBuilder())
+        doc = parse_file('test1.sam')
+        self.assertEqual(b''.join(builder.doc.serialize_xml()), b''.join(doc.serialize_xml()))
+        self.assertEqual(''.join(builder.doc.regurgitate()), ''.join(doc.regurgitate()))
+
+    def test_bounded_tree(self):
+        source = 'doc: Title\n\n' + ''.join('    section: S{0}\n\n        Para {0}.\n\n'.format(i)
+                                              for i in range(200))
+        parser = SamParser()
+        sizes = []
+        with contextlib.redirect_stderr(io.StringIO()):
+            for event, node in parser.events(io.StringIO(source)):
+                sizes.append(len(list(parser.doc.root.children[0].children)) if parser.doc.root.children else 0)
+        self.assertLessEqual(max(sizes), 1)
+        self.assertEqual(parser.doc.root.children, [])
+
+    def test_push_events(self):
+        class PhraseCounter(samparser.EventHandler):
+            count = 0
+
+            def phrase(self, node):
+                self.count += 1
+
+        handler = stream_events('doc: Title\n\n    A {b}(x) and {c}(y).\n', PhraseCounter())
+        self.assertEqual(handler.count, 2)
+
+
+class StreamingOutputTest(unittest.TestCase):
+    source = ('# A comment before the root\n\n'
+              'doc:(#top) Title [*s2]\n\n'
+              '    $name=SAM\n\n'
+              '    section:(*s1) One\n\n'
+              '        Text about >($name) with a {phrase}(x).\n\n'
+              '        * item\n\n'
+              '    section:(*s2) Two\n\n'
+              '        ```(python)\n'
+              '            code\n\n'
+              '        table:: a, b\n'
+              '            1, 2\n\n'
+              '# A comment after the root\n')
+
+    def serialize(self, source, method):
+        parser = SamParser()
+        with contextlib.redirect_stderr(io.StringIO()):
+            return b''.join(samparser.serialize_events(parser.events(io.StringIO(source)), method))
+
+    def test_output_matches(self):
+        for method in ('xml', 'html'):
+            with contextlib.redirect_stderr(io.StringIO()):
+                expected = b''.join(getattr(parse_string(self.source), 'serialize_' + method)())
+            self.assertEqual(self.serialize(self.source, method), expected)
+        for source in ('doc: Title\n', 'p: A paragraph at the root.\n'):
+            self.assertEqual(self.serialize(source, 'xml'), b''.join(parse_string(source).serialize_xml()))
+
+    def test_blocks_are_released(self):
+        parser = SamParser()
+        sizes = []
+        with contextlib.redirect_stderr(io.StringIO()):
+            for chunk in samparser.serialize_events(parser.events(io.StringIO(self.source)), 'xml'):
+                if parser.doc.root.children:
+                    sizes.append(len(parser.doc.root.children[-1].children))
+        # Only the variable definition and the section being parsed are kept.
+        self.assertLessEqual(max(sizes), 3)
+        self.assertEqual(parser.doc.nodes_by_id['s1'].children, [])
+
+    def test_html_insert_by_id(self):
+        source = 'doc: Title\n\n    p:(*target) Target\n\n    >>>(*target)\n'
+        self.assertTrue(self.serialize(source, 'xml').endswith(b'<insert idref="target"/>\n</doc>\n'))
+        with self.assertRaisesRegex(SAMParserError, 'Streamed HTML output cannot resolve inserts by ID'):
+            self.serialize(source, 'html')
+
+    def test_stream_option(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outputs = []
+            for arguments in ((), ('-stream',)):
+                output = os.path.join(directory, 'output.html')
+                result = subprocess.run([sys.executable, os.path.join(here, 'samparser.py'), 'html',
+                                         os.path.join(here, 'docsource', 'quickstart.sam'), '-o', output]
+                                        + list(arguments), capture_output=True, cwd=here)
+                self.assertEqual(result.returncode, 0)
+                with open(output, 'rb') as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[1], outputs[0])
+            self.assertIn('SAM parser information: Peak memory use:', result.stderr.decode())
+
+    def test_failure_leaves_no_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'doc.sam'), 'w') as f:
+                f.write('doc: Title\n\n    Text.\n\n    >>>(#a)\n')
+            output = os.path.join(directory, 'out', 'doc.html')
+            result = subprocess.run([sys.executable, os.path.join(here, 'samparser.py'), 'html',
+                                     os.path.join(directory, 'doc.sam'), '-stream', '-o', output],
+                                    capture_output=True)
+            self.assertEqual(result.returncode, 1)
+            self.assertEqual(os.listdir(os.path.join(directory, 'out')), [])
+
+
+class ReadLinesTest(unittest.TestCase):
+    cases = ['', 'doc: Title', 'a\r\nb\rc\n', '\ufeffdoc: Title\n', 'a\fb\n c\x85d\n\x1ce\r', '\u00e9\n\n\nlast']
+
+    def test_binary_source(self):
+        for text in self.cases:
+            data = text.encode('utf-8')
+            source = io.BytesIO(data)
+            self.assertEqual(samparser.read_lines(source), io.TextIOWrapper(io.BytesIO(data), 'utf-8-sig').readlines())
+            self.assertFalse(source.closed)
+            source = io.BytesIO(data)
+            self.assertEqual(list(samparser.text_lines(source)), samparser.read_lines(io.BytesIO(data)))
+            self.assertFalse(source.closed)
+
+    def test_source_closed_before_lines(self):
+        source = io.BytesIO(b'doc: Title\n\n    Text.\n')
+        lines = samparser.text_lines(source)
+        self.assertEqual(next(lines), 'doc: Title\n')
+        source.close()
+        lines.close()
+
+    def test_line_push_back(self):
+        source = samparser.StringSource(io.BytesIO('\ufeffdoc: Title\r\n\r\n    Text.\r\n'.encode('utf-8')))
+        self.assertEqual(source.next_line, 'doc: Title\n')
+        self.assertEqual(source.next_line, '\n')
+        source.return_line()
+        self.assertEqual((source.current_line, source.current_line_number), ('doc: Title\n', 1))
+        self.assertEqual(source.next_line, '\n')
+        self.assertEqual((source.next_line, source.current_line_number), ('    Text.\n', 3))
+
+    def test_include_with_byte_order_mark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'notice.sami'), 'wb') as f:
+                f.write('\ufeffnotice: Notice\r\n\r\n    Text\fwith a form feed.\r\n'.encode('utf-8'))
+            with open(os.path.join(directory, 'doc.sam'), 'w') as f:
+                f.write('doc: Title\n\n    <<<(notice.sami)\n')
+            doc = parse_file(os.path.join(directory, 'doc.sam'))
+        self.assertEqual(b''.join(doc.serialize_xml()),
+                         b'<?xml version="1.0" encoding="UTF-8"?>\n<doc>\n<title>Title</title>\n\n'
+                         b'<notice>\n<title>Notice</title>\n\n<p>Text\x0cwith a form feed.</p>\n</notice>\n</doc>\n')
+
+
+class PreTest(unittest.TestCase):
+    source = 'doc: Title\n\n    ```(python)\n        if a < b:\n\n          b = "&"\n'
+
+    def test_lines_share_source(self):
+        parser = SamParser()
+        with contextlib.redirect_stderr(io.StringIO()):
+            doc = parser.parse(io.StringIO(self.source))
+        pre = doc.find_first(lambda x: [x] if isinstance(x, samparser.Pre) else [])[0]
+        for line in pre.source_lines:
+            self.assertTrue(any(line is x for x in parser.source.lexer.lines))
+        self.assertEqual(pre.lines, ['if a < b:\n', '\n', '  b = "&"\n'])
+        self.assertEqual(pre.text, 'if a < b:\n\n  b = "&"\n')
+
+    def test_serialize_whole_block(self):
+        doc = parse_string(self.source)
+        self.assertIn(b'<codeblock language="python">\nif a &lt; b:\n\n  b = "&amp;"\n</codeblock>', b''.join(doc.serialize_xml()))
+        self.assertIn(b'if a &lt; b:\n\n  b = "&amp;"\n</code></pre>', b''.join(doc.serialize_html()))
+
+    def test_escape(self):
+        self.assertEqual(samparser.escape_for_xml('<a & "b">'), '&lt;a &amp; "b"&gt;')
+        self.assertEqual(samparser.escape_for_xml_attribute('<a & "b">'), '&lt;a &amp; &quot;b&quot;&gt;')
+        self.assertIsNone(samparser.escape_for_xml(None))
+        self.assertIsNone(samparser.escape_for_xml_attribute(None))
+
+
+class LazyParseTest(unittest.TestCase):
+    def parse_lazily(self, source):
+        with contextlib.redirect_stderr(io.StringIO()):
+            return SamParser().parse(source, lazy=True)
+
+    def test_same_output(self):
+        doc = parse_file('test1.sam')
+        with open(os.path.join(here, 'test1.sam'), 'rb') as f:
+            lazy_doc = self.parse_lazily(f)
+        flows = []
+        blocks = [lazy_doc.root]
+        while blocks:
+            block = blocks.pop()
+            flows.extend(x for x in [block.content, getattr(block, 'label', None)] if x is not None)
+            flows.extend(getattr(block, 'field_values', ()))
+            flows.extend(x for x in block.children if not isinstance(x, samparser.Block))
+            blocks.extend(x for x in block.children if isinstance(x, samparser.Block))
+        self.assertIn(samparser.LazyFlow, [type(x) for x in flows])
+        # Annotation lookup gives the same results whatever order the flows are used in.
+        with contextlib.redirect_stderr(io.StringIO()):
+            for flow in reversed(flows):
+                str(flow)
+        self.assertEqual(b''.join(lazy_doc.serialize_xml()), b''.join(doc.serialize_xml()))
+        self.assertEqual(str(lazy_doc), str(doc))
+        self.assertEqual(sorted(lazy_doc.ids), sorted(doc.ids))
+
+    def test_flows_parsed_when_used(self):
+        doc = self.parse_lazily(io.StringIO('doc: Title\n\n    First {one}(x).\n\n    Text {one}.\n\n'
+                                            '    section:(*s) Section\n'))
+        first, paragraph, section = doc.root.children[0].children
+        self.assertEqual(section.ID, 's')
+        self.assertIsInstance(paragraph.children[0], samparser.Flow)
+        self.assertIs(type(paragraph.children[0]), samparser.LazyFlow)
+        # Using a flow parses the flows it can look annotations up in first.
+        self.assertEqual([x.annotations[0].type for x in paragraph.children[0].children if isinstance(x, Phrase)], ['x'])
+        self.assertIs(type(first.children[0]), samparser.Flow)
+        self.assertIs(type(section.content), samparser.LazyFlow)
+        self.assertEqual(str(section.content), 'Section')
+        self.assertIs(type(section.content), samparser.Flow)
+
+    def test_unmatched_idrefs(self):
+        doc = self.parse_lazily(io.StringIO('doc: Title\n\n    See [*missing].\n'))
+        with self.assertRaises(SAMParserError):
+            b''.join(doc.serialize_xml())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -28,3 +28,20 @@ class StateMachine:
             else:
                 handler = self.handlers[newState.upper()]
 
+    def steps(self, cargo):
+        # Like run, but yields the name of each new state as the machine
+        # enters it, so that the caller can do something between states.
+        try:
+            handler = self.handlers[self.startState]
+        except:
+            raise Exception("InitializationError: must call .set_start() before .run()")
+        if not self.endStates:
+            raise Exception("InitializationError: at least one state must be an end_state")
+
+        while 1:
+            (newState, cargo) = handler(cargo)
+            yield newState
+            if newState.upper() in self.endStates:
+                break
+            else:
+                handler = self.handlers[newState.upper()]